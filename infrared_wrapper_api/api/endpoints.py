@@ -2,15 +2,20 @@ import logging
 import os
 
 from celery.result import GroupResult
+from celery.utils import uuid
 from fastapi import APIRouter, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from fastapi.encoders import jsonable_encoder
 from fastapi.openapi.utils import get_openapi
 
 from infrared_wrapper_api import tasks
 from infrared_wrapper_api.api.documentation import get_processes, get_conformance, get_landingpage_json
-from infrared_wrapper_api.api.utils import unify_group_result
-from infrared_wrapper_api.dependencies import celery_app
-from infrared_wrapper_api.models.calculation_input import WindSimulationInput, SunSimulationInput
+from infrared_wrapper_api.api.utils import get_job_result_key, update_job_info, get_job_info, get_cache_hit_ratio
+from infrared_wrapper_api.dependencies import cache, celery_app
+from infrared_wrapper_api.infrared_wrapper.infrared.models import SimType, JobPhase
+from infrared_wrapper_api.models.calculation_input import WindSimulationInput, SunSimulationInput, SimulationScenario, \
+    SimulationDelta
 from infrared_wrapper_api.models.ogc_job_status import StatusInfo
 
 logger = logging.getLogger(__name__)
@@ -55,6 +60,24 @@ async def get_processes_json(process_id: str = None) -> dict:
 
     return processes
 
+async def submit_simulation_job(calculation_task: SimulationScenario, sim_type: SimType) -> str:
+    """
+    Registers a new job and leaves splitting and dispatching its simulations to a worker.
+    Does not wait for the worker, the job id is generated here.
+    """
+    job_id = uuid()
+    simulation_input = jsonable_encoder(calculation_task)
+
+    # keep blocking redis calls off the event loop
+    await run_in_threadpool(update_job_info, job_id, phase=JobPhase.PREPARING.value, sim_type=sim_type)
+    await run_in_threadpool(
+        tasks.task__compute.apply_async,
+        kwargs={"simulation_input": simulation_input, "sim_type": sim_type, "job_id": job_id}
+    )
+
+    return job_id
+
+
 @router.post(
     path="/processes/wind-comfort/execution",
     tags=["process"],
@@ -66,8 +89,7 @@ async def execute_wind(
         response: Response
 ):
     calculation_task = WindSimulationInput(**calculation_input.dict())
-    result = tasks.task__compute.delay(simulation_input=jsonable_encoder(calculation_task), sim_type="wind")
-    job_id = result.get()
+    job_id = await submit_simulation_job(calculation_task, "wind")
 
     # OGC Processes Requirement 34 | /req/core/process-execute-success-async
     response.headers["Location"] = f"/infrared/jobs/{job_id}"
@@ -91,8 +113,7 @@ async def execute_sun(
         response: Response
 ):
     calculation_task = SunSimulationInput(**calculation_input.dict())
-    result = tasks.task__compute.delay(jsonable_encoder(calculation_task), "sun")
-    job_id = result.get()
+    job_id = await submit_simulation_job(calculation_task, "sun")
 
     # OGC Processes Requirement 34 | /req/core/process-execute-success-async
     response.headers["Location"] = f"/infrared/jobs/{job_id}"
@@ -105,36 +126,107 @@ async def execute_sun(
     }
 
 
+@router.post(
+    path="/jobs/{job_id}/delta",
+    status_code=201,
+    summary="Simulation of an earlier job's scenario with changed buildings"
+)
+async def execute_delta(
+        job_id: str,
+        delta: SimulationDelta,
+        response: Response
+):
+    """
+    Only the tiles affected by the changed buildings are simulated again,
+    the other tiles are taken from the cached results of the base job.
+    """
+    base_job_info = await run_in_threadpool(get_job_info, job_id)
+
+    if not base_job_info:
+        raise HTTPException(status_code=404, detail="no such job")
+
+    delta_job_id = uuid()
+    await run_in_threadpool(
+        update_job_info,
+        delta_job_id,
+        phase=JobPhase.PREPARING.value,
+        sim_type=base_job_info.get("sim_type"),
+        base_job_id=job_id
+    )
+    await run_in_threadpool(
+        tasks.task__compute_delta.apply_async,
+        kwargs={"delta": jsonable_encoder(delta), "base_job_id": job_id, "job_id": delta_job_id}
+    )
+
+    # OGC Processes Requirement 34 | /req/core/process-execute-success-async
+    response.headers["Location"] = f"/infrared/jobs/{delta_job_id}"
+
+    return {
+            "type": "process",
+            "jobID": delta_job_id,
+            "status": StatusInfo.ACCEPTED.value
+    }
+
+
 @router.get("/jobs/{job_id}/results")
 def get_job_results(job_id: str):
+    job_result_key = get_job_result_key(job_id)
+
+    # results of finished jobs are unified once and served as stored
+    if cache.exists(key=job_result_key):
+        return StreamingResponse(cache.iter_bytes(key=job_result_key), media_type="application/json")
+
     group_result = GroupResult.restore(job_id, app=celery_app)
 
     if not group_result:
-        raise HTTPException(status_code=404, detail="no such job")
+        job_info = get_job_info(job_id)
+
+        if not job_info:
+            raise HTTPException(status_code=404, detail="no such job")
+
+        if job_info.get("phase") == JobPhase.FAILED.value:
+            raise HTTPException(status_code=500, detail=job_info.get("error", "job failed"))
+
+        # simulation tasks are still being prepared
+        raise HTTPException(status_code=404, detail="result not ready")
 
     if group_result.failed():
         # OGC 7.13.3 Requirement 46 | https://docs.ogc.org/is/18-062r2/18-062r2.html#toc34
         raise HTTPException(status_code=500, detail=str(group_result.get()))
 
-    if not group_result.successful():
-        # OGC 7.13.3 Requirement 45 | https://docs.ogc.org/is/18-062r2/18-062r2.html#toc34
-        raise HTTPException(status_code=404, detail="result not ready")
-
-    return {"result": {"geojson": unify_group_result(group_result)}}
+    # the group finished, but its result is stored once unified by the chord callback (task__unify_job_result)
+    # OGC 7.13.3 Requirement 45 | https://docs.ogc.org/is/18-062r2/18-062r2.html#toc34
+    raise HTTPException(status_code=404, detail="result not ready")
 
 
 @router.get("/jobs/{job_id}")
 async def get_job_status(job_id: str):
-    group_result = GroupResult.restore(job_id, app=celery_app)
-
-    if not group_result:
-        raise HTTPException(status_code=404, detail="no such job")
+    group_result = await run_in_threadpool(GroupResult.restore, job_id, app=celery_app)
 
     response = {
         "type": "process",
         "jobID": job_id,
     }
 
+    if not group_result:
+        # the group of simulation tasks does not exist before the job is prepared
+        job_info = await run_in_threadpool(get_job_info, job_id)
+
+        if not job_info:
+            raise HTTPException(status_code=404, detail="no such job")
+
+        if job_info.get("phase") == JobPhase.FAILED.value:
+            response["status"] = StatusInfo.FAILURE.value
+        else:
+            response["status"] = StatusInfo.ACCEPTED.value
+        response["phase"] = job_info.get("phase")
+        response["progress"] = 0
+
+        return response
+
+    # share of tiles served from the result cache
+    response["cache_hit_ratio"] = await run_in_threadpool(get_cache_hit_ratio, job_id)
+
     # successful() returns true if all tasks successful.
     if group_result.successful():
         response["status"] = StatusInfo.SUCCESS.value
@@ -2,8 +2,10 @@ import uvicorn
 from fastapi import FastAPI
 from fastapi_utils.tasks import repeat_every
 
+from infrared_wrapper_api import tasks
 from infrared_wrapper_api.api.endpoints import router as tasks_router
 from infrared_wrapper_api.config import settings
+from infrared_wrapper_api.dependencies import metrics
 from infrared_wrapper_api.infrared_wrapper.infrared.setup.setup_infrared import setup_infrared, cleanup_infrared_projects
 
 
@@ -24,12 +26,18 @@ async def health_check():
     return "ok"
 
 
+@app.get(f"{API_PREFIX}/metrics", tags=["ROOT"])
+def get_metrics():
+    return metrics.report()
+
+
 @app.on_event("startup")
-@repeat_every(seconds=60, wait_first=True)  # every minute
+@repeat_every(seconds=settings.infrared_communication.cleanup_reconcile_seconds, wait_first=True)
 @app.get(f"{API_PREFIX}/cleanup_infrared", tags=["ROOT"])
 def clean_up_infrared():
-    print("Cleaning up infrared projects...")
-    return cleanup_infrared_projects()
+    # projects are cleaned up by a task after failed simulations, this only catches lost cleanups
+    print("Reconciling infrared projects...")
+    return cleanup_infrared_projects(cleanup=tasks.enqueue_cleanup)
 
 
 app.include_router(tasks_router, prefix=API_PREFIX)
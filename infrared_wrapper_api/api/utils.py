@@ -1,52 +1,143 @@
-from celery.result import GroupResult
-import geopandas as gpd
 import json
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+import time
+from typing import Dict, List, Optional, Tuple
 
-from infrared_wrapper_api.infrared_wrapper.infrared.models import ProjectStatus
-from infrared_wrapper_api.dependencies import cache
+from infrared_wrapper_api.config import settings
+from infrared_wrapper_api.infrared_wrapper.infrared.models import ProjectStatus, SimType
+from infrared_wrapper_api.infrared_wrapper.infrared.result_grid import ResultGrid, mosaic_result_grids, \
+    result_grid_to_geojson
+from infrared_wrapper_api.dependencies import cache, metrics, project_pool, project_registry
 
 
-class NoIdleProjectException(Exception):
-    "Raised when no idle project found"
-    pass
-
-
-@retry(
-    stop=stop_after_attempt(5),  # Maximum number of attempts
-    wait=wait_exponential(multiplier=1, max=30),  # Exponential backoff with a maximum wait time of 20 seconds
-    retry=retry_if_exception_type(NoIdleProjectException)  # Retry only on APIError exceptions
-)
-def find_idle_infrared_project(all_project_uuids) -> str:
-    for project_uuid in all_project_uuids:
-        project_info = cache.get(key=project_uuid)
-        print(f"project info: {project_info}")
-        if not project_info or project_info.get("status", None) == ProjectStatus.IDLE.value:
-            update_infrared_project_status_in_redis(project_uuid=project_uuid, status=ProjectStatus.BUSY.value)
-            print(f" using infrared project {project_uuid}")
-            return project_uuid
+def lease_idle_infrared_project(building_hashes: List[str] = None, capability: str = None) -> Tuple[str, str]:
+    """
+    Atomically claims an idle project from the project pool, waiting for one to be released if all are in use.
+    Prefers projects with the given capability, then the project that needs the fewest building updates
+    to load the given buildings.
+    Returns the project and the token of its lease.
+    Raises NoIdleProjectException if none becomes available in time.
+    """
+    start_time = time.monotonic()
+    project_uuid, lease_token = project_pool.acquire(
+        timeout=settings.infrared_communication.project_lease_wait_seconds,
+        rank=lambda idle_projects: project_registry.rank_projects(idle_projects, building_hashes or [], capability)
+    )
+    metrics.observe("project_lease_wait_seconds", time.monotonic() - start_time)
+    cache.put(key=project_uuid, value={"status": ProjectStatus.BUSY.value})
+    print(f" using infrared project {project_uuid}")
 
-    raise NoIdleProjectException("All infrared projects seem to be in use!")
+    return project_uuid, lease_token
 
 
-def update_infrared_project_status_in_redis(project_uuid: str, status: str):
+def update_infrared_project_status_in_redis(project_uuid: str, status: str, lease_token: str = None) -> bool:
     """
     marks whether a infrared project can be used or is busy with some other simulation
+    idle projects are returned to the project pool,
+    projects to be cleaned stay leased until their cleanup is done, so they are cleaned up only once.
+    lease_token is the lease of the caller, projects without lease (e.g. new projects) are added to the pool.
+    Returns False and leaves the project alone, if the caller's lease is lost (expired and reclaimed).
     """
+    # the lease is checked before the status is written, a lost lease must not mark a reclaimed project idle
+    if lease_token is None:
+        if status == ProjectStatus.IDLE.value:
+            project_pool.register(project_uuid)
+    elif status == ProjectStatus.IDLE.value:
+        if not project_pool.release(project_uuid, lease_token):
+            return False
+    elif status == ProjectStatus.TO_BE_CLEANED.value:
+        if not project_pool.renew_lease(project_uuid, lease_token):
+            return False
+
     cache.put(key=project_uuid, value={"status": status})
 
+    return True
+
 
-def unify_group_result(group_result: GroupResult) -> dict:
-    # list of geojsons
-    all_results = [result.get() for result in group_result.results]
+def get_job_key(job_id: str) -> str:
+    return f"job_{job_id}"
+
+
+def get_job_info(job_id: str) -> dict:
+    return cache.get(key=get_job_key(job_id))
+
+
+def update_job_info(job_id: str, **job_info):
+    """
+    keeps track of a job (e.g. its phase) before and while its simulation tasks exist
+    """
+    cache.put(key=get_job_key(job_id), value={**(get_job_info(job_id) or {}), **job_info})
 
-    # flatten all features to one list
-    all_features = []
-    for result in all_results:
-        all_features.extend(result.get("features", []))
 
-    # dissolve neighboring polygons with same value
-    gdf = gpd.GeoDataFrame.from_features(all_features)
-    gdf = gdf.dissolve(by='value').reset_index()
+def get_job_input_key(job_id: str) -> str:
+    return f"job_input_{job_id}"
 
-    return json.loads(gdf.to_json())
+
+def store_job_input(job_id: str, simulation_input: dict, sim_type: SimType):
+    """
+    Keeps the scenario of a job as submitted, so later jobs can be submitted as delta to it.
+    """
+    cache.put(key=get_job_input_key(job_id), value={"simulation_input": simulation_input, "sim_type": sim_type})
+
+
+def get_job_input(job_id: str) -> dict:
+    return cache.get(key=get_job_input_key(job_id))
+
+
+def get_job_tile_keys_key(job_id: str) -> str:
+    return f"job_tile_keys_{job_id}"
+
+
+def store_tile_key(job_id: str, tile_index: int, celery_key: str):
+    """
+    Keeps the cache key of a job's tile, once the tile is prepared.
+    """
+    cache.put_field(key=get_job_tile_keys_key(job_id), field=str(tile_index), value=celery_key)
+
+
+def get_tile_keys(job_id: str) -> Dict[int, str]:
+    tile_keys = cache.get_fields(key=get_job_tile_keys_key(job_id))
+
+    return {int(tile_index): celery_key for tile_index, celery_key in tile_keys.items()}
+
+
+def get_job_cache_stats_key(job_id: str) -> str:
+    return f"job_cache_{job_id}"
+
+
+def record_tile_cache_lookup(job_id: str, hit: bool):
+    outcome = "hits" if hit else "misses"
+    cache.increment(key=get_job_cache_stats_key(job_id), field=outcome)
+    metrics.increment(f"tile_cache_{outcome}")
+
+
+def get_cache_hit_ratio(job_id: str) -> Optional[float]:
+    """
+    Share of the job's tiles served from the result cache so far, None before any tile was looked up.
+    """
+    counts = cache.get_counts(key=get_job_cache_stats_key(job_id))
+    lookups = counts.get("hits", 0) + counts.get("misses", 0)
+
+    return round(counts.get("hits", 0) / lookups, 3) if lookups else None
+
+
+def unify_tile_results(tile_results: List[dict]) -> dict:
+    # cropped result grids of all tiles, failed tiles deliver no grid
+    result_grids = [ResultGrid.from_dict(result) for result in tile_results if result.get("grid")]
+
+    if not result_grids:
+        return {"type": "FeatureCollection", "features": []}
+
+    # stitch tiles into one grid and polygonize once, neighboring cells with same value are merged on the grid
+    return result_grid_to_geojson(mosaic_result_grids(result_grids))
+
+
+def get_job_result_key(job_id: str) -> str:
+    return f"job_result_{job_id}"
+
+
+def store_job_result(job_id: str, result_geojson: dict):
+    """
+    Stores the serialized response body for the job's result, so it can be streamed as is.
+    """
+    serialized_result = json.dumps({"result": {"geojson": result_geojson}})
+    cache.put_bytes(key=get_job_result_key(job_id), value=serialized_result.encode())
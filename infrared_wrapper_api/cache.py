@@ -1,4 +1,5 @@
 import json
+from typing import Dict, Iterator
 
 from fastapi.encoders import jsonable_encoder
 
@@ -6,19 +7,23 @@ import redis
 from infrared_wrapper_api.config import RedisConnectionConfig
 
 
+def create_redis_client(connection_config: RedisConnectionConfig, decode_responses: bool = False) -> redis.Redis:
+    return redis.Redis(
+        host=connection_config.host,
+        port=connection_config.port,
+        db=connection_config.db,
+        username=connection_config.username,
+        password=connection_config.password,
+        ssl=connection_config.ssl,
+        decode_responses=decode_responses,
+    )
+
+
 class Cache:
     def __init__(
         self, connection_config: RedisConnectionConfig, key_prefix: str, ttl_days: int
     ):
-        self._redis = redis.Redis(
-            host=connection_config.host,
-            port=connection_config.port,
-            db=connection_config.db,
-            username=connection_config.username,
-            password=connection_config.password,
-            ssl=connection_config.ssl,
-            decode_responses=True,
-        )
+        self._redis = create_redis_client(connection_config)
         self._key_prefix = key_prefix
         self._ttl_days = ttl_days
 
@@ -34,6 +39,55 @@ class Cache:
         ttl = self._ttl_days * 86400
         self._redis.setex(key, ttl, serialized_value)
 
+    def get_bytes(self, *, key: str) -> bytes:
+        key = self._make_key(key)
+        return self._redis.get(key)
+
+    def put_bytes(self, *, key: str, value: bytes) -> None:
+        key = self._make_key(key)
+        ttl = self._ttl_days * 86400
+        self._redis.setex(key, ttl, value)
+
+    def iter_bytes(self, *, key: str, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+        """
+        Reads a value chunk by chunk, without loading it as a whole.
+        """
+        key = self._make_key(key)
+        length = self._redis.strlen(key)
+        for start in range(0, length, chunk_size):
+            yield self._redis.getrange(key, start, start + chunk_size - 1)
+
+    def increment(self, *, key: str, field: str, amount: int = 1) -> None:
+        """
+        Counts in a hash, e.g. to keep statistics of a job.
+        """
+        key = self._make_key(key)
+        pipeline = self._redis.pipeline()
+        pipeline.hincrby(key, field, amount)
+        pipeline.expire(key, self._ttl_days * 86400)
+        pipeline.execute()
+
+    def get_counts(self, *, key: str) -> Dict[str, int]:
+        return {field: int(count) for field, count in self.get_fields(key=key).items()}
+
+    def put_field(self, *, key: str, field: str, value: str) -> None:
+        """
+        Sets a field of a hash, so concurrent writers of different fields do not overwrite each other.
+        """
+        key = self._make_key(key)
+        pipeline = self._redis.pipeline()
+        pipeline.hset(key, field, value)
+        pipeline.expire(key, self._ttl_days * 86400)
+        pipeline.execute()
+
+    def get_fields(self, *, key: str) -> Dict[str, str]:
+        key = self._make_key(key)
+        return {field.decode(): value.decode() for field, value in self._redis.hgetall(key).items()}
+
+    def exists(self, *, key: str) -> bool:
+        key = self._make_key(key)
+        return bool(self._redis.exists(key))
+
     def delete(self, *, key: str) -> None:
         key = self._make_key(key)
         self._redis.delete(key)
@@ -0,0 +1,33 @@
+import redis
+
+from infrared_wrapper_api.infrared_wrapper.infrared.models import SimType
+
+
+class CompletionTimes:
+    """
+    Learns how long infrared takes to complete a simulation, per sim type and building count of the tile.
+    Keeps an exponentially weighted moving average in redis, shared by all workers.
+    """
+
+    def __init__(self, redis_client: redis.Redis, key_prefix: str, default_seconds: float, weight: float = 0.3):
+        self._redis = redis_client
+        self._key = f"{key_prefix}:completion_times"
+        self._default_seconds = default_seconds
+        self._weight = weight
+
+    def expected_seconds(self, sim_type: SimType, building_count: int) -> float:
+        expected_seconds = self._redis.hget(self._key, self._field(sim_type, building_count))
+
+        return self._default_seconds if expected_seconds is None else float(expected_seconds)
+
+    def record(self, sim_type: SimType, building_count: int, seconds: float):
+        expected_seconds = self._redis.hget(self._key, self._field(sim_type, building_count))
+        if expected_seconds is not None:
+            seconds = self._weight * seconds + (1 - self._weight) * float(expected_seconds)
+
+        self._redis.hset(self._key, self._field(sim_type, building_count), seconds)
+
+    @staticmethod
+    def _field(sim_type: SimType, building_count: int) -> str:
+        # buckets of similar building counts: 0, 1, 2-3, 4-7, 8-15, ...
+        return f"{sim_type}:{building_count.bit_length()}"
@@ -36,13 +36,41 @@ class BrokerCelery(BaseSettings):
     result_persistent: bool = True
     enable_utc: bool = True
     task_default_queue: str = Field(..., env="CELERY_DEFAULT_QUEUE")
+    io_queue: str = Field("infrared_io", env="CELERY_IO_QUEUE")  # waiting for infrared, many concurrent tasks
+    cpu_queue: str = Field("infrared_cpu", env="CELERY_CPU_QUEUE")  # processing results, concurrency = cores
+    cleanup_queue: str = Field("infrared_cleanup", env="CELERY_CLEANUP_QUEUE")  # cleaning up and scaling projects
 
 
 class InfraredCommunication(BaseSettings):
     url: str = Field(..., env="INFRARED_URL")
     user: str = Field(..., env="INFRARED_USERNAME")
     password: str = Field(..., env="INFRARED_PASSWORD")
-    infrared_projects_count: int = Field(default=5)
+    infrared_projects_count: int = Field(default=5)  # min. size of the project pool
+    max_infrared_projects_count: int = Field(default=20)  # the pool grows up to this size while tiles wait
+    pool_autoscale_seconds: int = Field(default=30)  # interval of scaling the pool
+    pool_scale_step: int = Field(default=5)  # max. projects created or retired per scaling
+    pool_scale_down_seconds: int = Field(default=900)  # surplus projects are retired after this time without demand
+    sun_activated_projects_share: float = Field(default=0.5)  # share of the pool kept with sunlight hours activated
+    project_lease_seconds: int = Field(default=900)  # leases of crashed workers expire and get cleaned up
+    project_lease_wait_seconds: int = Field(default=120)  # max. time to wait for an idle project
+    http_pool_size: int = Field(default=20)  # kept-alive connections to infrared, ~ concurrent queries per process
+    connect_timeout: float = Field(default=10)  # seconds
+    read_timeout: float = Field(default=120)  # seconds, building uploads can take long
+    max_concurrent_queries: int = Field(default=4)  # concurrent queries per tile, to let AIT's servers breathe
+    batch_initial_size: int = Field(default=10)  # buildings per mutation query, adapted to infrared's response times
+    batch_max_size: int = Field(default=100)
+    batch_max_bytes: int = Field(default=100_000)  # max. size of a mutation query
+    batch_increase: int = Field(default=5)  # growth of batch size after fast and successful batches
+    batch_target_seconds: float = Field(default=5)  # slower batches halve the batch size
+    batch_max_attempts: int = Field(default=3)  # failed mutations are sent again in smaller batches
+    delete_batch_initial_size: int = Field(default=50)  # deletions are small mutations, sent in bigger batches
+    delete_batch_max_size: int = Field(default=500)
+    expected_result_seconds: float = Field(default=3)  # until completion times of simulations are learned
+    first_poll_share: float = Field(default=0.9)  # first poll for a result after this share of the expected time
+    poll_interval_seconds: float = Field(default=1)
+    result_timeout_seconds: float = Field(default=60)
+    cleanup_reconcile_seconds: int = Field(default=300)  # safety net for projects whose cleanup task got lost
+    cleanup_pending_seconds: int = Field(default=3600)  # max. time a cleanup waits in the queue, until enqueued again
 
 
 class InfraredCalculation(BaseSettings):
@@ -50,6 +78,7 @@ class InfraredCalculation(BaseSettings):
     simulation_area_buffer: int = Field(default=50)  # buffer will be trimmed from result as results at bbox edges are faulty
     infrared_sim_area_size: int = Field(default=500)  # cropped_simulation_area_size + 2*simulation_area_buffer
     analysis_resolution: int = Field(default=10)  # resolution of analysis in meters
+    aligned_tiling: bool = Field(default=False)  # snap bboxes to a fixed grid of cropped_simulation_area_size
 
 
 class Settings(BaseSettings):
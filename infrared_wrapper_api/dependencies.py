@@ -1,7 +1,11 @@
 from celery import Celery
 
-from infrared_wrapper_api.cache import Cache
+from infrared_wrapper_api.cache import Cache, create_redis_client
+from infrared_wrapper_api.completion_times import CompletionTimes
 from infrared_wrapper_api.config import settings
+from infrared_wrapper_api.metrics import Metrics
+from infrared_wrapper_api.project_pool import ProjectPool
+from infrared_wrapper_api.project_registry import ProjectRegistry
 
 cache = Cache(
     connection_config=settings.cache.connection,
@@ -9,6 +13,49 @@ cache = Cache(
     ttl_days=settings.cache.ttl_days,
 )
 
+project_pool = ProjectPool(
+    redis_client=create_redis_client(settings.cache.connection, decode_responses=True),
+    key_prefix=settings.cache.key_prefix,
+    lease_seconds=settings.infrared_communication.project_lease_seconds,
+)
+
+project_registry = ProjectRegistry(
+    redis_client=create_redis_client(settings.cache.connection, decode_responses=True),
+    key_prefix=settings.cache.key_prefix,
+)
+
+metrics = Metrics(
+    redis_client=create_redis_client(settings.cache.connection, decode_responses=True),
+    key_prefix=settings.cache.key_prefix,
+)
+
+completion_times = CompletionTimes(
+    redis_client=create_redis_client(settings.cache.connection, decode_responses=True),
+    key_prefix=settings.cache.key_prefix,
+    default_seconds=settings.infrared_communication.expected_result_seconds,
+)
+
 celery_app = Celery(
     __name__, broker=settings.cache.broker_url, backend=settings.cache.result_backend
-)
\ No newline at end of file
+)
+
+celery_app.conf.update(
+    task_default_queue=settings.broker.task_default_queue,
+    task_routes={
+        "infrared_wrapper_api.tasks.task__prepare_simulation_task": {"queue": settings.broker.cpu_queue},
+        "infrared_wrapper_api.tasks.task__run_simulation": {"queue": settings.broker.io_queue},
+        "infrared_wrapper_api.tasks.task__format_simulation_result": {"queue": settings.broker.cpu_queue},
+        "infrared_wrapper_api.tasks.task__load_cached_tile_result": {"queue": settings.broker.cpu_queue},
+        "infrared_wrapper_api.tasks.task__unify_job_result": {"queue": settings.broker.cpu_queue},
+        "infrared_wrapper_api.tasks.task__cleanup_project": {"queue": settings.broker.cleanup_queue},
+        "infrared_wrapper_api.tasks.task__autoscale_project_pool": {"queue": settings.broker.cleanup_queue},
+    },
+    beat_schedule={
+        "autoscale-project-pool": {
+            "task": "infrared_wrapper_api.tasks.task__autoscale_project_pool",
+            "schedule": settings.infrared_communication.pool_autoscale_seconds,
+            # runs that could not start in time are dropped, the next one follows anyway
+            "options": {"expires": settings.infrared_communication.pool_autoscale_seconds},
+        },
+    },
+)
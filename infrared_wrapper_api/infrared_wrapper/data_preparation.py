@@ -1,53 +1,77 @@
 import math
-from typing import List
+from typing import List, Tuple
 import json
 
 import geopandas as gpd
+import numpy as np
+import shapely
 from shapely.geometry import box
 from infrared_wrapper_api.config import settings
+from infrared_wrapper_api.infrared_wrapper.infrared.building_interchange import read_buildings, encode_buildings
 from infrared_wrapper_api.infrared_wrapper.infrared.models import SimType
 from infrared_wrapper_api.models.calculation_input import WindSimulationTask, SunSimulationTask
 
 
 def create_simulation_tasks(
         task_def: dict,
-        sim_type: SimType
+        sim_type: SimType,
+        bbox_matrix: List[gpd.GeoDataFrame] = None
 ) -> List[WindSimulationTask | SunSimulationTask]:
-    buildings_gdf = gpd.GeoDataFrame.from_features(task_def["buildings"]["features"], crs="EPSG:25832")
+    """
+    bbox_matrix are the bboxes to simulate, by default the bboxes covering all buildings
+    """
+    return [create_simulation_task(tile_def, sim_type) for tile_def in create_tile_definitions(task_def, bbox_matrix)]
+
+
+def create_tile_definitions(task_def: dict, bbox_matrix: List[gpd.GeoDataFrame] = None) -> List[dict]:
+    """
+    Splits a request into its tiles: the task_def with the simulation area of a bbox and the buildings intersecting it.
+    Buildings are only selected via spatial index, preparing them is left to create_simulation_task for each tile.
+    The buildings of a tile are encoded compactly, the buildings of the task_def may be geojson or encoded.
+    """
+    buildings_gdf = read_buildings(task_def["buildings"])
 
     # subdivide the region with all buildings into simulation area sized bboxes
-    matrix = create_bbox_matrix(buildings_gdf)
+    matrix = create_bbox_matrix(buildings_gdf) if bbox_matrix is None else bbox_matrix
 
-    return [create_simulation_task(task_def, buildings_gdf, bbox, sim_type) for bbox in matrix]
+    return [
+        {
+            **task_def,
+            "buildings": encode_buildings(
+                buildings_gdf.iloc[np.sort(buildings_gdf.sindex.query(bbox.geometry.iloc[0], predicate="intersects"))]
+            ),
+            "simulation_area": json.loads(bbox.to_json()),
+        }
+        for bbox in matrix
+    ]
 
 
-def create_simulation_task(
-        task_def: dict,
-        buildings_gdf: gpd.GeoDataFrame,
-        bbox: box,
-        sim_type: SimType
-) -> WindSimulationTask | SunSimulationTask:
-    columns = list(buildings_gdf.columns)
-    buildings_gdf = buildings_gdf.drop(columns=[col for col in columns if not col in ["geometry", "building_height", "index"]])
+def create_simulation_task(tile_def: dict, sim_type: SimType) -> WindSimulationTask | SunSimulationTask:
+    """
+    Clips and simplifies the buildings of a tile, as defined by create_tile_definitions
+    """
+    buildings_gdf = read_buildings(tile_def["buildings"])
+    bbox = gpd.GeoDataFrame.from_features(tile_def["simulation_area"]["features"], crs="EPSG:25832")
+
     buildings_gdf = buildings_gdf.clip(bbox)
     buildings_gdf = simplify_building_input(buildings_gdf)
-    buildings_json = json.loads(buildings_gdf.to_json())
+    buildings_encoded = encode_buildings(buildings_gdf)
 
-    simulation_area_json = json.loads(bbox.to_json())
+    simulation_area_json = tile_def["simulation_area"]
 
     if sim_type == "wind":
         return WindSimulationTask(
             simulation_area=simulation_area_json,
-            buildings=buildings_json,
-            wind_speed=task_def["wind_speed"],
-            wind_direction=task_def["wind_direction"],
+            buildings=buildings_encoded,
+            wind_speed=tile_def["wind_speed"],
+            wind_direction=tile_def["wind_direction"],
             # TODO add original calculation area here. and when task finished - clip to it.
         )
 
     if sim_type == "sun":
         return SunSimulationTask(
             simulation_area=simulation_area_json,
-            buildings=buildings_json
+            buildings=buildings_encoded
         )
 
     raise NotImplementedError(f"Simulation type {sim_type} not known.")
@@ -56,17 +80,25 @@ def create_simulation_task(
 def create_bbox_matrix(buildings: gpd.GeoDataFrame) -> List[gpd.GeoDataFrame]:
     """
     creates a matrix of overlapping bboxes covering the area containing buildings (EPSG:25832)
+    With aligned tiling, bboxes snap to a fixed grid, so the same area always yields the same bbox
+    and overlapping requests share the cached results of bboxes whose buildings did not change.
     """
-    total_area = buildings.unary_union.convex_hull
+    # convex hull of all buildings, without the costly union of their geometries
+    total_area = shapely.GeometryCollection(list(buildings.geometry)).convex_hull
     min_x, min_y, max_x, max_y = total_area.bounds
     size = settings.infrared_calculation.cropped_simulation_area_size
     buffer = settings.infrared_calculation.simulation_area_buffer
+    aligned = settings.infrared_calculation.aligned_tiling
 
     print("INPUT SIZE BOUNDARIES")
     print(max_x - min_x)
     print(max_y - min_y)
 
-    if max_x - min_x <= 510 >= max_y - min_y:
+    if aligned:
+        # anchor the matrix at multiples of the bbox size instead of the buildings' extent
+        min_x = math.floor(min_x / size) * size
+        min_y = math.floor(min_y / size) * size
+    elif max_x - min_x <= 510 >= max_y - min_y:
         # return a single bbox for requests that fit into a single 500*500m bounding box. (few meters more are ok)
         print("Single bbox simulation")
         return [gpd.GeoDataFrame(geometry=[box(min_x, min_y, max_x, max_y)], crs="EPSG:25832")]
@@ -96,6 +128,83 @@ def create_bbox_matrix(buildings: gpd.GeoDataFrame) -> List[gpd.GeoDataFrame]:
     return bbox_matrix
 
 
+def apply_building_delta(buildings: dict, delta: dict, added_id_prefix: str) -> Tuple[dict, dict, dict]:
+    """
+    Applies added, modified and removed buildings to the buildings of a scenario.
+    Buildings are identified by their feature id (see assign_building_ids), modified buildings need one.
+    Added buildings without id get one, prefixed with added_id_prefix.
+    Returns the resulting buildings, the buildings that were removed or replaced and the new buildings.
+    """
+    features = {building_id(feature, index): feature for index, feature in enumerate(buildings["features"])}
+    modified = (delta.get("modified") or {}).get("features", [])
+    added = assign_building_ids(delta.get("added") or {"features": []}, prefix=added_id_prefix)["features"]
+
+    if any("id" not in feature for feature in modified):
+        raise ValueError("modified buildings need the id of the building they replace")
+
+    replaced_ids = [str(feature_id) for feature_id in delta.get("removed", [])]
+    replaced_ids += [building_id(feature, None) for feature in modified]
+    if unknown_ids := [feature_id for feature_id in replaced_ids if feature_id not in features]:
+        raise ValueError(f"buildings {unknown_ids} are not part of the base scenario")
+
+    kept = {feature_id: feature for feature_id, feature in features.items() if feature_id not in replaced_ids}
+    if duplicate_ids := {building_id(feature, None) for feature in added} & kept.keys():
+        raise ValueError(f"added buildings {sorted(duplicate_ids)} are already part of the base scenario")
+
+    return (
+        {**buildings, "features": list(kept.values()) + modified + added},
+        {"type": "FeatureCollection", "features": [features[feature_id] for feature_id in set(replaced_ids)]},
+        {"type": "FeatureCollection", "features": modified + added},
+    )
+
+
+def assign_building_ids(buildings: dict, prefix: str = "") -> dict:
+    """
+    Gives buildings without feature id a stable id: their position in the submitted buildings (with prefix).
+    Scenarios are stored with ids, so a building keeps its id in scenarios derived by deltas.
+    """
+    features = [
+        feature if "id" in feature else {**feature, "id": f"{prefix}{index}" if prefix else index}
+        for index, feature in enumerate(buildings["features"])
+    ]
+    ids = [building_id(feature, None) for feature in features]
+    if len(set(ids)) < len(ids):
+        raise ValueError("building ids are not unique")
+
+    return {**buildings, "features": features}
+
+
+def building_id(feature: dict, index: int | None) -> str:
+    # scenarios stored before ids were assigned identify their buildings by position
+    return str(feature.get("id", index))
+
+
+def find_affected_bboxes(bboxes_bounds: List[List[float]], changed_buildings: gpd.GeoDataFrame) -> List[bool]:
+    """
+    Whether changed buildings are within a bbox, including its buffer.
+    """
+    changed_area = changed_buildings.unary_union
+
+    return [box(*bounds).intersects(changed_area) for bounds in bboxes_bounds]
+
+
+def create_bbox_matrix_for_uncovered(
+        buildings: gpd.GeoDataFrame,
+        bboxes_bounds: List[List[float]]
+) -> List[gpd.GeoDataFrame]:
+    """
+    creates bboxes for the buildings that are not covered by the given bboxes (without their buffer)
+    """
+    buffer = settings.infrared_calculation.simulation_area_buffer
+    covered_area = gpd.GeoSeries(
+        [box(minx + buffer, miny + buffer, maxx - buffer, maxy - buffer) for minx, miny, maxx, maxy in bboxes_bounds],
+        crs="EPSG:25832"
+    ).unary_union
+    uncovered_buildings = buildings[~buildings.within(covered_area)]
+
+    return create_bbox_matrix(uncovered_buildings) if len(uncovered_buildings) else []
+
+
 def simplify_building_input(buildings_in_bbox: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     buildings_in_bbox["building_height"] = round(buildings_in_bbox["building_height"], -1)  # round to next 10
     buildings_in_bbox["building_height_dissolve"] = buildings_in_bbox["building_height"]
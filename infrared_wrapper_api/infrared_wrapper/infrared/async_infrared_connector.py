@@ -0,0 +1,99 @@
+import asyncio
+import time
+from typing import List
+
+import httpx
+from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
+
+from infrared_wrapper_api.config import settings
+from infrared_wrapper_api.infrared_wrapper.infrared import queries
+from infrared_wrapper_api.infrared_wrapper.infrared.infrared_connector import InfraredConnector, InfraredException, \
+    parse_root_snapshot_id, check_mutations_succeeded
+
+"""
+Async variant of the infrared communication, to send independent queries concurrently.
+Shares the login of the synchronous connector.
+"""
+
+
+class AsyncInfraredConnector:
+    """
+    Sends queries concurrently, but never more than max_concurrent_queries at a time.
+    Lives within one event loop, use as async context manager.
+    """
+
+    def __init__(self, connector: InfraredConnector, max_concurrent_queries: int = None):
+        max_concurrent_queries = max_concurrent_queries or settings.infrared_communication.max_concurrent_queries
+
+        self.connector = connector
+        self._semaphore = asyncio.Semaphore(max_concurrent_queries)
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                settings.infrared_communication.read_timeout,
+                connect=settings.infrared_communication.connect_timeout
+            ),
+            limits=httpx.Limits(max_connections=max_concurrent_queries),
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._client.aclose()
+
+    async def execute_query(self, query: str) -> dict:
+        start_time = time.time()
+
+        url = self.connector.url + '/api'
+        token = self.connector.token
+        headers = {'Cookie': token, 'origin': self.connector.url}
+        async with self._semaphore:
+            request = await self._client.post(url, json={'query': query}, headers=headers)
+
+        if request.status_code == 401:
+            # cookies expire after 1hour - reauthenticate (once for all queries) and try again
+            await asyncio.to_thread(self.connector.refresh_login, expired_token=token)
+            return await self.execute_query(query)
+
+        if request.status_code != 200:
+            raise InfraredException(
+                f"Query failed to run by returning code of {request.status_code}. URL: {url} , Query: {query}"
+            )
+        print(f"Query: {query.split('(')[0]} ||| execution time: {time.time() - start_time}")
+        return request.json()
+
+
+async def get_root_snapshot_id(async_connector: AsyncInfraredConnector, project_uuid: str) -> str:
+    query = queries.get_snapshot_query(project_uuid)
+
+    return parse_root_snapshot_id(
+        await async_connector.execute_query(query),
+        async_connector.connector.user_uuid,
+        project_uuid
+    )
+
+
+@retry(
+    stop=stop_after_attempt(2),  # Maximum number of attempts
+    wait=wait_fixed(2),
+    retry=retry_if_exception_type(InfraredException)  # Retry only on APIError exceptions
+)
+async def execute_mutations(async_connector: AsyncInfraredConnector, mutations: List[str], alias: str) -> List[dict]:
+    """
+    Executes a batch of mutations in one query. Returns the results in order of the mutations.
+    """
+    query = queries.batch_mutations(mutations, alias)
+    response = await async_connector.execute_query(query)
+    check_mutations_succeeded(response, query)
+
+    return [response["data"].get(f"{alias}{count}") or {} for count in range(len(mutations))]
+
+
+async def activate_sunlight_analysis_capability(async_connector: AsyncInfraredConnector, project_uuid: str) -> bool:
+    query = queries.activate_sun_service_query(
+        async_connector.connector.user_uuid, project_uuid
+    )
+    response = await async_connector.execute_query(query)
+    print("activate sunlight hours calc service", response)
+
+    return check_mutations_succeeded(response, query)
@@ -0,0 +1,142 @@
+import asyncio
+import threading
+import time
+from collections import Counter, deque
+from typing import Awaitable, Callable, List
+
+from infrared_wrapper_api.config import settings
+from infrared_wrapper_api.metrics import Metrics
+
+"""
+Adaptive sizing of mutation batches sent to infrared.
+Bigger batches save round trips, but infrared gets slow or fails for too big queries.
+"""
+
+
+class AdaptiveBatchSize:
+    """
+    AIMD batch size: grows additively while batches are fast and successful, is halved on errors or slow batches.
+    Batches are capped by the byte size of their query, so few big buildings do not make a huge query.
+    Shared by all uploads of a process, so a learned size carries over to the next tile.
+    Failed mutations are sent again in the next (smaller) batches, each at most max_attempts times.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            metrics: Metrics,
+            initial_size: int,
+            max_size: int,
+            max_bytes: int,
+            increase: int,
+            target_seconds: float,
+            max_attempts: int = 3,
+    ):
+        self.name = name
+        self.metrics = metrics
+        self.size = initial_size
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.increase = increase
+        self.target_seconds = target_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(
+            cls,
+            name: str,
+            metrics: Metrics,
+            initial_size: int = None,
+            max_size: int = None
+    ) -> "AdaptiveBatchSize":
+        config = settings.infrared_communication
+        return AdaptiveBatchSize(
+            name=name,
+            metrics=metrics,
+            initial_size=initial_size or config.batch_initial_size,
+            max_size=max_size or config.batch_max_size,
+            max_bytes=config.batch_max_bytes,
+            increase=config.batch_increase,
+            target_seconds=config.batch_target_seconds,
+            max_attempts=config.batch_max_attempts,
+        )
+
+    def take_batch(self, mutations: deque) -> List[str]:
+        """
+        Takes the next batch of mutations from the queue
+        """
+        with self._lock:
+            size = self.size
+
+        batch = []
+        batch_bytes = 0
+        while mutations and len(batch) < size:
+            mutation_bytes = len(mutations[0].encode())
+            # always take at least one mutation
+            if batch and batch_bytes + mutation_bytes > self.max_bytes:
+                break
+
+            batch.append(mutations.popleft())
+            batch_bytes += mutation_bytes
+
+        return batch
+
+    def record(self, batch_size: int, seconds: float, success: bool):
+        with self._lock:
+            if success and seconds <= self.target_seconds:
+                self.size = min(self.max_size, max(self.size, batch_size) + self.increase)
+            else:
+                self.size = max(1, batch_size // 2)
+
+        self.metrics.observe(f"{self.name}_batch_size", batch_size)
+        self.metrics.observe(f"{self.name}_batch_seconds", seconds)
+        if not success:
+            self.metrics.increment(f"{self.name}_batch_failures")
+
+    def requeue_failed(self, mutations: deque, failed: List[str], attempts: Counter) -> bool:
+        """
+        Puts the failed mutations back in front of the queue, unless they were sent max_attempts times.
+        Returns whether all failed mutations are sent again.
+        """
+        attempts.update(failed)
+        retried = [mutation for mutation in failed if attempts[mutation] < self.max_attempts]
+        mutations.extendleft(reversed(retried))
+
+        if len(retried) < len(failed):
+            self.metrics.increment(f"{self.name}_failed_mutations", len(failed) - len(retried))
+            return False
+
+        return True
+
+
+async def send_in_batches_concurrently(
+        batch_size: AdaptiveBatchSize,
+        mutations: List[str],
+        send: Callable[[List[str]], Awaitable[List[str]]],
+        concurrency: int
+) -> bool:
+    """
+    Sends the mutations in batches, with several batches in flight. The next batch is taken once a batch completes,
+    its size is adapted to the previous ones.
+    send returns the mutations of the batch that failed, they are sent again in later batches.
+    Returns whether all mutations succeeded.
+    """
+    queue = deque(mutations)
+    attempts = Counter()
+
+    async def send_batches() -> bool:
+        all_success = True
+        while queue:
+            batch = batch_size.take_batch(queue)
+            start_time = time.perf_counter()
+            failed = batch
+            try:
+                failed = await send(batch)
+            finally:
+                batch_size.record(len(batch), time.perf_counter() - start_time, not failed)
+            all_success = batch_size.requeue_failed(queue, failed, attempts) and all_success
+
+        return all_success
+
+    return all(await asyncio.gather(*[send_batches() for _ in range(concurrency)]))
@@ -0,0 +1,50 @@
+"""
+Compact representation of buildings passed between tasks (EPSG:25832).
+Geometries are WKB, heights a float array, both base64 encoded to stay json serializable for celery messages.
+GeoJSON is only read at the API boundary and written for infrared.
+"""
+import base64
+
+import geopandas as gpd
+import numpy as np
+
+HEIGHT_DTYPE = np.float64
+LENGTH_DTYPE = np.uint32
+
+
+def encode_buildings(buildings: gpd.GeoDataFrame) -> dict:
+    wkbs = buildings.geometry.to_wkb()
+
+    return {
+        "wkb": encode_array(b"".join(wkbs)),
+        "wkb_lengths": encode_array(np.fromiter(map(len, wkbs), dtype=LENGTH_DTYPE, count=len(wkbs)).tobytes()),
+        "building_height": encode_array(buildings["building_height"].to_numpy(dtype=HEIGHT_DTYPE).tobytes()),
+    }
+
+
+def decode_buildings(buildings: dict) -> gpd.GeoDataFrame:
+    data = base64.b64decode(buildings["wkb"])
+    ends = np.cumsum(np.frombuffer(base64.b64decode(buildings["wkb_lengths"]), dtype=LENGTH_DTYPE), dtype=np.int64)
+    starts = np.concatenate([[0], ends[:-1]])
+
+    return gpd.GeoDataFrame(
+        {"building_height": np.frombuffer(base64.b64decode(buildings["building_height"]), dtype=HEIGHT_DTYPE)},
+        geometry=gpd.GeoSeries.from_wkb([data[start:end] for start, end in zip(starts, ends)]),
+        crs="EPSG:25832"
+    )
+
+
+def read_buildings(buildings: dict) -> gpd.GeoDataFrame:
+    """
+    Geometries and heights of buildings given as geojson (EPSG:25832) or encoded by encode_buildings
+    """
+    if "wkb" in buildings:
+        return decode_buildings(buildings)
+
+    return gpd.GeoDataFrame.from_features(
+        buildings["features"], crs="EPSG:25832", columns=["geometry", "building_height"]
+    )
+
+
+def encode_array(data: bytes) -> str:
+    return base64.b64encode(data).decode()
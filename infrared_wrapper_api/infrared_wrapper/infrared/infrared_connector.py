@@ -1,9 +1,11 @@
 import os
-import requests
+import threading
 import time
-from typing import List
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type, wait_chain, wait_fixed, \
-    stop_after_delay
+
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Dict, List
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 
 from infrared_wrapper_api.infrared_wrapper.infrared import queries
 from infrared_wrapper_api.infrared_wrapper.infrared.queries import run_wind_simulation_query, get_analysis_output_query, \
@@ -19,10 +21,21 @@ class InfraredException(Exception):
 
 
 class InfraredConnector:
+    """
+    Holds the login to infrared and a pooled session, so queries reuse kept-alive connections.
+    Safe to share between threads.
+    """
 
-    def __init__(self):
+    def __init__(self, url: str = None):
+        self.url = url or settings.infrared_communication.url
         self.user_uuid = ""
         self.token = ""
+        self.timeout = (
+            settings.infrared_communication.connect_timeout,
+            settings.infrared_communication.read_timeout
+        )
+        self._login_lock = threading.Lock()
+        self.session = create_session()
         self.infrared_user_login()
 
     def infrared_user_login(self) -> tuple[str]:
@@ -30,7 +43,7 @@ class InfraredConnector:
             "username": settings.infrared_communication.user,
             "password": settings.infrared_communication.password
         }
-        request = requests.post(os.getenv("INFRARED_URL"), json=user_creds)
+        request = self.session.post(self.url, json=user_creds, timeout=self.timeout)
 
         if request.status_code != 200:
             raise Exception(
@@ -44,6 +57,19 @@ class InfraredConnector:
         self.user_uuid = request.cookies.get("InFraReDClientUuid")
         self.token = "InFraReD=" + request.cookies.get("InFraReD")
 
+    def refresh_login(self, expired_token: str):
+        """
+        Logs in again, unless another thread already did so since the token expired.
+        """
+        with self._login_lock:
+            if self.token == expired_token:
+                print("COOKIE EXPIRED - LOGGING IN AGAIN")
+                self.infrared_user_login()
+
+    def reset_session(self):
+        # connections must not be shared with forked processes
+        self.session = create_session()
+
     def execute_query(self, query: str):
         """
             Make query response
@@ -52,14 +78,14 @@ class InfraredConnector:
         start_time = time.time()
 
         # AIT requested a sleep between the requests. To let their servers breath a bit.
-        url = os.getenv("INFRARED_URL") + '/api'
-        headers = {'Cookie': self.token, 'origin': os.getenv('INFRARED_URL')}
-        request = requests.post(url, json={'query': query}, headers=headers)
+        url = self.url + '/api'
+        token = self.token
+        headers = {'Cookie': token, 'origin': self.url}
+        request = self.session.post(url, json={'query': query}, headers=headers, timeout=self.timeout)
 
         if request.status_code == 401:
             # cookies expire after 1hour - reauthenticate and try again
-            print("COOKIE EXPIRED - LOGGING IN AGAIN")
-            self.infrared_user_login()
+            self.refresh_login(expired_token=token)
             return self.execute_query(query)
 
         if request.status_code != 200:
@@ -70,7 +96,17 @@ class InfraredConnector:
         return request.json()
 
 
+def create_session() -> requests.Session:
+    pool_size = settings.infrared_communication.http_pool_size
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+    session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    return session
+
+
 connector = InfraredConnector()
+os.register_at_fork(after_in_child=connector.reset_session)
 
 """
 PROJECT CREATION / DELETION / IDS
@@ -123,8 +159,11 @@ def get_all_cut_prototype_projects_uuids() -> List[str]:
 def get_root_snapshot_id(project_uuid) -> str:
     query = queries.get_snapshot_query(project_uuid)
 
-    snapshot = connector.execute_query(query)
-    graph_snapshots_path = ["data", "getSnapshotsByProjectUuid", "infraredSchema", "clients", connector.user_uuid,
+    return parse_root_snapshot_id(connector.execute_query(query), connector.user_uuid, project_uuid)
+
+
+def parse_root_snapshot_id(snapshot: dict, user_uuid: str, project_uuid: str) -> str:
+    graph_snapshots_path = ["data", "getSnapshotsByProjectUuid", "infraredSchema", "clients", user_uuid,
                             "projects", project_uuid, "snapshots"]
 
     return list(get_value(snapshot, graph_snapshots_path).keys())[0]  # root snapshot is the first (and only) one.
@@ -134,13 +173,28 @@ def get_root_snapshot_id(project_uuid) -> str:
 def get_project_name(project_uuid) -> str:
     query = queries.get_snapshot_query(project_uuid)
 
-    snapshot = connector.execute_query(query)
-    name_path = ["data", "getSnapshotsByProjectUuid", "infraredSchema", "clients", connector.user_uuid,
+    return parse_project_name(connector.execute_query(query), connector.user_uuid, project_uuid)
+
+
+def parse_project_name(snapshot: dict, user_uuid: str, project_uuid: str) -> str:
+    name_path = ["data", "getSnapshotsByProjectUuid", "infraredSchema", "clients", user_uuid,
                  "projects", project_uuid, "projectName"]
 
     return get_value(snapshot, name_path)
 
 
+def query_project_metadata(project_uuid) -> Dict[str, str]:
+    """
+    Root snapshot uuid and name of the project, from a single query
+    """
+    snapshot = connector.execute_query(queries.get_snapshot_query(project_uuid))
+
+    return {
+        "snapshot_uuid": parse_root_snapshot_id(snapshot, connector.user_uuid, project_uuid),
+        "name": parse_project_name(snapshot, connector.user_uuid, project_uuid),
+    }
+
+
 def delete_project(project_uuid):
     query = queries.delete_project(project_uuid, connector.user_uuid)
     connector.execute_query(query)
@@ -153,23 +207,17 @@ BUILDINGS AND STREETS
 """
 
 
-@retry(
-    stop=stop_after_attempt(2),  # Maximum number of attempts
-    wait=wait_fixed(2),  # Exponential backoff with a maximum wait time of 10 seconds
-    retry=retry_if_exception_type(InfraredException)  # Retry only on APIError exceptions
-)
-def create_new_buildings(snapshot_uuid: str, new_buildings: dict):
-    query = queries.create_buildings(snapshot_uuid, new_buildings["features"])
-    new_bld_response = connector.execute_query(query)
-
-    all_success = all(entry.get("success", False) for entry in new_bld_response["data"].values())
+def check_mutations_succeeded(response: dict, query: str) -> bool:
+    all_success = all((entry or {}).get("success", False) for entry in response["data"].values())
 
     if not all_success:
         print(
-            f"could not create buildings! {new_bld_response}",
+            f"mutations failed! {response}",
         )
         print(f"Query {query}")
 
+    return all_success
+
 
 def get_all_project_geometry_objects(project_uuid: str, snapshot_uuid: str) -> dict:
     snapshot_geometries = connector.execute_query(
@@ -241,13 +289,15 @@ SIMULATIONS
 """
 
 
-def activate_sunlight_analysis_capability(project_uuid: str):
+def activate_sunlight_analysis_capability(project_uuid: str) -> bool:
     query = activate_sun_service_query(
         connector.user_uuid, project_uuid
     )
     response = connector.execute_query(query)
     print("activate sunlight hours calc service", response)
 
+    return check_mutations_succeeded(response, query)
+
 
 def trigger_wind_simulation(snapshot_uuid, wind_direction, wind_speed) -> str:
     query = run_wind_simulation_query(
@@ -277,15 +327,10 @@ def trigger_sun_simulation(snapshot_uuid) -> str:
         print(f"calculation for SUN FAILS! for snapshot {snapshot_uuid} with exception {exception}")
 
 
-@retry(
-    stop=stop_after_delay(60),  # Maximum number of attempts
-    wait=wait_chain(*[wait_fixed(3) for i in range(1)] +
-                     [wait_fixed(2) for j in range(5)] +
-                     [wait_fixed(1) for k in range(50)]
-                    ),  # Wait 3 seconds first then retry faster.
-    retry=retry_if_exception_type(KeyError)  # Retry only on APIError exceptions
-)
-def get_analysis_output(project_uuid: str, snapshot_uuid: str, result_uuid: str) -> dict:
+def read_analysis_output(project_uuid: str, snapshot_uuid: str, result_uuid: str) -> dict:
+    """
+    Raises KeyError if the result is not ready yet.
+    """
     query = get_analysis_output_query(
         snapshot_uuid=snapshot_uuid,
         result_uuid=result_uuid
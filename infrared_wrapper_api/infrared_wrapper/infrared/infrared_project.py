@@ -1,63 +1,104 @@
+import asyncio
 import geopandas
 import json
+from typing import Dict, List
 
-from infrared_wrapper_api.infrared_wrapper.infrared.infrared_connector import get_root_snapshot_id, \
-    get_all_building_uuids_for_project, delete_buildings, delete_streets, create_new_buildings, \
-    get_all_street_uuids_for_project, delete_project
+from infrared_wrapper_api.config import settings
+from infrared_wrapper_api.dependencies import metrics, project_registry
+from infrared_wrapper_api.infrared_wrapper.infrared import async_infrared_connector, queries
+from infrared_wrapper_api.infrared_wrapper.infrared.async_infrared_connector import AsyncInfraredConnector
+from infrared_wrapper_api.infrared_wrapper.infrared.batching import AdaptiveBatchSize, send_in_batches_concurrently
+from infrared_wrapper_api.infrared_wrapper.infrared.building_interchange import read_buildings
+from infrared_wrapper_api.infrared_wrapper.infrared.infrared_connector import connector, query_project_metadata, \
+    get_all_building_uuids_for_project, delete_streets, get_all_street_uuids_for_project, delete_project, \
+    InfraredException
+from infrared_wrapper_api.infrared_wrapper.infrared.models import ProjectCapability
+from infrared_wrapper_api.utils import hash_dict
 
 config = None
 
+# batch sizes learned from previous uploads / deletions of this process
+create_batch_size = AdaptiveBatchSize.from_settings("create_buildings", metrics)
+delete_batch_size = AdaptiveBatchSize.from_settings(
+    "delete_buildings",
+    metrics,
+    initial_size=settings.infrared_communication.delete_batch_initial_size,
+    max_size=settings.infrared_communication.delete_batch_max_size
+)
+
 """Class to handle Infrared communication for a InfraredProject (one bbox to analyze)"""
 
 
+class BuildingsNotLoadedException(InfraredException):
+    """
+    The project does not hold exactly the buildings of the tile, a simulation would be wrong.
+    """
+
+
 class InfraredProject:
     def __init__(
             self,
             # project_data: InfraredProjectModel
             project_uuid: str,
+            snapshot_uuid: str = None,
     ):
         # set properties
         self.project_uuid = project_uuid
 
-        self.snapshot_uuid = get_root_snapshot_id(project_uuid)
-
-    def update_buildings_at_infrared(self, buildings: dict, simulation_area: dict):
-        # await self.delete_all_buildings()   # loosing too much time here. Remember to delete buildings after sim!
-
-        print("updating buildings for project")
-        buildings_gdf = geopandas.GeoDataFrame.from_features(buildings["features"], crs="EPSG:25832")
-        simulation_area_gdf = geopandas.GeoDataFrame.from_features(simulation_area["features"], crs="EPSG:25832")
+        self.snapshot_uuid = snapshot_uuid or get_project_metadata(project_uuid)["snapshot_uuid"]
 
-        # translate to local coord. system at 0,0
-        minx, miny, _, _ = simulation_area_gdf.total_bounds
-        buildings_gdf["geometry"] = buildings_gdf.translate(-minx, -miny)
+    @classmethod
+    def with_buildings(
+            cls,
+            project_uuid: str,
+            tile_buildings: Dict[str, dict],
+            activate_sun: bool = False
+    ) -> "InfraredProject":
+        """
+        Looks up the snapshot of the project, then loads the tile's buildings (see prepare_buildings) into it.
+        """
+        snapshot_uuid = asyncio.run(
+            load_buildings(
+                project_uuid,
+                tile_buildings,
+                snapshot_uuid=get_project_metadata(project_uuid)["snapshot_uuid"],
+                activate_sun=activate_sun
+            )
+        )
 
-        buildings_gdf = buildings_gdf.explode(ignore_index=True).reset_index()  # Infrared doesnt like MultiGeoms
-        building_chunks = [buildings_gdf.loc[i:i + 10 - 1, :] for i in range(0, len(buildings_gdf), 10)]
+        return InfraredProject(project_uuid, snapshot_uuid)
 
-        for buildings in building_chunks:
-            # send max. 10 buildings per request to INFRARED
-            print(f"sending chunk with {len(buildings)} buildings")
-            create_new_buildings(
-                snapshot_uuid=self.snapshot_uuid,
-                new_buildings=json.loads(buildings.to_json())  # creating multipolygons fails
+    def update_buildings_at_infrared(self, buildings: dict, simulation_area: dict):
+        asyncio.run(
+            load_buildings(
+                self.project_uuid,
+                prepare_buildings(buildings, simulation_area),
+                snapshot_uuid=self.snapshot_uuid
             )
+        )
 
     # deletes all buildings for project on endpoint
     def delete_all_buildings(self):
-        building_uuids = get_all_building_uuids_for_project(self.project_uuid, self.snapshot_uuid)
+        """
+        Deletes the buildings recorded in the project registry.
+        Only if the buildings of the project are unknown, they are listed at infrared.
+        """
+        loaded_buildings = project_registry.loaded_buildings(self.project_uuid)
+        project_registry.forget(self.project_uuid)
+
+        if loaded_buildings is None:
+            print(f"buildings of project {self.project_uuid} unknown, listing them at infrared")
+            building_uuids = get_all_building_uuids_for_project(self.project_uuid, self.snapshot_uuid)
+        else:
+            building_uuids = list(loaded_buildings.values())
 
         if not building_uuids:
             print(f"no buildings to delete for project {self.project_uuid}")
+            project_registry.mark_empty(self.project_uuid)
             return
 
-        building_chunks = [building_uuids[i:i + 10] for i in range(0, len(building_uuids), 10)]
-
-        for chunk in building_chunks:
-            delete_buildings(
-                self.snapshot_uuid,
-                chunk
-            )
+        if asyncio.run(delete_buildings_at_infrared(self.snapshot_uuid, building_uuids)):
+            project_registry.mark_empty(self.project_uuid)
 
     # deletes all streets for project on endpoint
     def delete_all_streets(self):
@@ -75,3 +116,164 @@ class InfraredProject:
     def delete_this_project(self):
         # delete project at infrared.
         delete_project(self.project_uuid)
+        project_registry.remove(self.project_uuid)
+
+
+def get_project_metadata(project_uuid: str) -> Dict[str, str]:
+    """
+    Root snapshot uuid and name of the project. Only queried from infrared if the project is not registered yet.
+    """
+    metadata = project_registry.project_metadata(project_uuid)
+    if metadata is None:
+        metadata = query_project_metadata(project_uuid)
+        project_registry.set_project_metadata(project_uuid, **metadata)
+
+    return metadata
+
+
+async def load_buildings(
+        project_uuid: str,
+        tile_buildings: Dict[str, dict],
+        snapshot_uuid: str = None,
+        activate_sun: bool = False
+) -> str:
+    """
+    Makes the tile's buildings the only buildings in the root snapshot of the project.
+    Buildings already loaded (see project_registry) are kept, only the delta is deleted/created.
+    Batches are adaptively sized and sent concurrently.
+    Raises BuildingsNotLoadedException if not all outdated buildings were deleted and all buildings created.
+    The sunlight hours service is only activated if the project does not have it yet.
+    Returns the uuid of the snapshot.
+    """
+    async with AsyncInfraredConnector(connector) as async_connector:
+        if not snapshot_uuid:
+            snapshot_uuid = await async_infrared_connector.get_root_snapshot_id(async_connector, project_uuid)
+
+        loaded_buildings = project_registry.loaded_buildings(project_uuid)
+        # buildings change from now on, the project is in an unknown state until all changes are done
+        project_registry.forget(project_uuid)
+
+        if loaded_buildings is None:
+            print(f"buildings of project {project_uuid} unknown, replacing all buildings")
+            building_uuids = await asyncio.to_thread(get_all_building_uuids_for_project, project_uuid, snapshot_uuid)
+            loaded_buildings = {f"unknown_{building_uuid}": building_uuid for building_uuid in building_uuids}
+
+        kept_buildings = {
+            building_hash: building_uuid
+            for building_hash, building_uuid in loaded_buildings.items()
+            if building_hash in tile_buildings
+        }
+        outdated_building_uuids = [
+            building_uuid
+            for building_hash, building_uuid in loaded_buildings.items()
+            if building_hash not in tile_buildings
+        ]
+        create_mutations = {
+            queries.create_building_mutation(snapshot_uuid, building): building_hash
+            for building_hash, building in tile_buildings.items()
+            if building_hash not in kept_buildings
+        }
+        print(
+            f"updating buildings for project: keeping {len(kept_buildings)}, "
+            f"deleting {len(outdated_building_uuids)}, creating {len(create_mutations)}"
+        )
+
+        created_buildings = {}
+
+        async def create_buildings(batch: List[str]) -> List[str]:
+            results = await async_infrared_connector.execute_mutations(async_connector, batch, alias="createObject")
+            for mutation, result in zip(batch, results):
+                if result.get("success"):
+                    created_buildings[create_mutations[mutation]] = result["uuid"]
+
+            return failed_mutations(batch, results)
+
+        pending_queries = [
+            delete_buildings(async_connector, snapshot_uuid, outdated_building_uuids),
+            send_in_batches_concurrently(
+                create_batch_size,
+                list(create_mutations),
+                send=create_buildings,
+                concurrency=settings.infrared_communication.max_concurrent_queries
+            ),
+        ]
+        sun_capability = ProjectCapability.SUNLIGHT_HOURS.value
+        activate_sun = activate_sun and sun_capability not in project_registry.capabilities(project_uuid)
+        if activate_sun:
+            # independent of the buildings, runs alongside the uploads
+            pending_queries.append(
+                async_infrared_connector.activate_sunlight_analysis_capability(async_connector, project_uuid)
+            )
+        all_deleted, _, *sun_activated = await asyncio.gather(*pending_queries)
+
+    if any(sun_activated):
+        project_registry.add_capability(project_uuid, sun_capability)
+
+    if not all_deleted:
+        # the buildings of the project stay unknown, its cleanup lists them at infrared
+        raise BuildingsNotLoadedException(f"could not delete outdated buildings of project {project_uuid}")
+
+    project_registry.set_loaded_buildings(project_uuid, {**kept_buildings, **created_buildings})
+    if len(created_buildings) < len(create_mutations):
+        raise BuildingsNotLoadedException(
+            f"could not create {len(create_mutations) - len(created_buildings)} buildings in project {project_uuid}"
+        )
+
+    return snapshot_uuid
+
+
+async def delete_buildings(
+        async_connector: AsyncInfraredConnector,
+        snapshot_uuid: str,
+        building_uuids: List[str]
+) -> bool:
+    """
+    Deletes the buildings in adaptively sized batches, sent concurrently. Returns whether all were deleted.
+    """
+    async def send_deletions(batch: List[str]) -> List[str]:
+        results = await async_infrared_connector.execute_mutations(async_connector, batch, alias="delObject")
+
+        return failed_mutations(batch, results)
+
+    return await send_in_batches_concurrently(
+        delete_batch_size,
+        [queries.delete_building_mutation(snapshot_uuid, building_uuid) for building_uuid in building_uuids],
+        send=send_deletions,
+        concurrency=settings.infrared_communication.max_concurrent_queries
+    )
+
+
+def failed_mutations(batch: List[str], results: List[dict]) -> List[str]:
+    return [mutation for mutation, result in zip(batch, results) if not result.get("success")]
+
+
+async def delete_buildings_at_infrared(snapshot_uuid: str, building_uuids: List[str]) -> bool:
+    async with AsyncInfraredConnector(connector) as async_connector:
+        return await delete_buildings(async_connector, snapshot_uuid, building_uuids)
+
+
+def prepare_buildings(buildings: dict, simulation_area: dict) -> Dict[str, dict]:
+    """
+    Buildings in the local coord. system of the simulation area, as loaded to infrared, by their content hash.
+    """
+    buildings_gdf = read_buildings(buildings)
+    simulation_area_gdf = geopandas.GeoDataFrame.from_features(simulation_area["features"], crs="EPSG:25832")
+
+    # translate to local coord. system at 0,0
+    minx, miny, _, _ = simulation_area_gdf.total_bounds
+    buildings_gdf["geometry"] = buildings_gdf.translate(-minx, -miny)
+
+    buildings_gdf = buildings_gdf.explode(ignore_index=True).reset_index()  # Infrared doesnt like MultiGeoms
+
+    return {
+        hash_building(building): building
+        for building in json.loads(buildings_gdf.to_json())["features"]  # creating multipolygons fails
+    }
+
+
+def hash_building(building: dict) -> str:
+    # everything that is sent to infrared for a building
+    return hash_dict({
+        "geometry": building["geometry"],
+        "building_height": building["properties"]["building_height"]
+    })
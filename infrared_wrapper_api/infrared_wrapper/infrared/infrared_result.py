@@ -1,11 +1,13 @@
-import json
 import numpy as np
 from typing import List, Tuple
 import geopandas as gpd
+from affine import Affine
 from shapely.geometry import box
-import topojson as tp
 
 from infrared_wrapper_api.config import settings
+from infrared_wrapper_api.infrared_wrapper.infrared.models import PolygonizeMethod
+from infrared_wrapper_api.infrared_wrapper.infrared.result_grid import ResultGrid, polygonize_grid, \
+    simplify_result_to_geojson
 
 
 class InfraredResult:
@@ -80,6 +82,46 @@ class InfraredResult:
 
         return geojson
 
+    def result_to_array(self) -> np.ndarray:
+        """
+        Returns the result as a north-up grid of cell values.
+        Like result_to_geojson, the last row/column of the output only closes the grid and carries no cell.
+        """
+        grid = np.asarray(self.result_data, dtype=float)[:self.resolution_y - 1, :self.resolution_x - 1]
+
+        # infrared delivers the southern-most row first
+        return np.flipud(grid)
+
+    def georeferenced_grid(self, total_bounds_simulation_area: Tuple[float, ...]) -> ResultGrid:
+        """
+        Drops the buffer cells from each side of the result grid by index
+        and returns the cropped grid positioned in EPSG:25832 by an affine transform.
+        """
+        resolution = settings.infrared_calculation.analysis_resolution
+        buffer_cells = settings.infrared_calculation.simulation_area_buffer // resolution
+        minx, miny = cropped_grid_origin(total_bounds_simulation_area)
+
+        grid = self.result_to_array()
+        rows, cols = grid.shape
+        cropped_grid = grid[buffer_cells:rows - buffer_cells, buffer_cells:cols - buffer_cells]
+
+        # the first row of the grid is the northern edge of the simulation area
+        transform = Affine(
+            resolution, 0, minx,
+            0, -resolution, miny + cropped_grid.shape[0] * resolution
+        )
+
+        return ResultGrid.from_transform(cropped_grid, transform)
+
+    def result_to_polygons(self, total_bounds_simulation_area: Tuple[float, ...]) -> gpd.GeoDataFrame:
+        """
+        Polygonizes the cropped result grid without building a feature per cell.
+        Polygons are already positioned in the simulation area (EPSG:25832).
+        """
+        result_grid = self.georeferenced_grid(total_bounds_simulation_area)
+
+        return polygonize_grid(result_grid.grid, result_grid.transform).set_crs("EPSG:25832")
+
     def check_result_dimensions(self):
         expected_sim_size = settings.infrared_calculation.infrared_sim_area_size
 
@@ -90,40 +132,58 @@ class InfraredResult:
             raise ValueError("sizes of simulation area and result do not match")
 
 
+def cropped_grid_origin(total_bounds_simulation_area: Tuple[float, ...]) -> Tuple[float, float]:
+    """
+    South-western corner of the result grid of a simulation area, once the buffer is cropped.
+    """
+    resolution = settings.infrared_calculation.analysis_resolution
+    buffer = settings.infrared_calculation.simulation_area_buffer // resolution * resolution
+    geo_minx, geo_miny, _, _ = total_bounds_simulation_area
+
+    return geo_minx + buffer, geo_miny + buffer
+
+
+def crop_infrared_result(raw_result: dict, total_bounds_simulation_area: Tuple[float, ...]) -> ResultGrid:
+    """
+    Crops the buffer from the raw result and positions the remaining grid in the simulation area.
+    """
+    return InfraredResult.from_raw_result(raw_result).georeferenced_grid(total_bounds_simulation_area)
+
+
 def georeference_infrared_result(
         raw_result: dict,
-        total_bounds_simulation_area: Tuple[float, ...]
+        total_bounds_simulation_area: Tuple[float, ...],
+        method: PolygonizeMethod = "raster"
     ) -> dict:
     """
     Converts the result to a polygonized geojson
     Crops the buffer from the result, as values towards results' edges get unreliable.
     Dissolves pixels with same values into polygons
+
+    method "raster" polygonizes the result grid directly,
+    "per_cell" builds a feature per cell and is kept as reference.
     """
     result = InfraredResult.from_raw_result(raw_result)
 
-    result_geojson = result.result_to_geojson()
-    result_gdf = gpd.GeoDataFrame.from_features(result_geojson["features"])
-    geo_minx, geo_miny, _, _ = total_bounds_simulation_area
-
-    # translate to position of simulation area
-    result_gdf["geometry"] = result_gdf.translate(geo_minx, geo_miny)
-    result_gdf = result_gdf.set_crs("EPSG:25832", allow_override=True)
-
-    # crop the buffer area
-    result_gdf = crop_buffer(result_gdf)
+    if method == "per_cell":
+        result_geojson = result.result_to_geojson()
+        result_gdf = gpd.GeoDataFrame.from_features(result_geojson["features"])
+        geo_minx, geo_miny, _, _ = total_bounds_simulation_area
 
-    # merge neighboring fields with same value
-    result_gdf = result_gdf.dissolve(by="value").reset_index()
+        # translate to position of simulation area
+        result_gdf["geometry"] = result_gdf.translate(geo_minx, geo_miny)
+        result_gdf = result_gdf.set_crs("EPSG:25832", allow_override=True)
 
-    # simplify the geometries with topojson (does not create gaps between simplified geoms)
-    topo = tp.Topology(result_gdf, prequantize=False)
-    result_gdf = topo.toposimplify(3).to_gdf()  # tolerance of 3 just delivered prettiest results
-    result_gdf.geometry = result_gdf.geometry.buffer(0)  # fix invalid geoms
+        # crop the buffer area
+        result_gdf = crop_buffer(result_gdf)
 
-    # reproject and return geojson dict
-    result_json = json.loads(result_gdf.to_crs("EPSG:4326").to_json())
+        # merge neighboring fields with same value
+        result_gdf = result_gdf.dissolve(by="value").reset_index()
+    else:
+        # buffer is cropped, cells are positioned and same values merged on the grid already
+        result_gdf = result.result_to_polygons(total_bounds_simulation_area)
 
-    return result_json
+    return simplify_result_to_geojson(result_gdf)
 
 
 def crop_buffer(gdf_with_metric_crs: gpd.GeoDataFrame):
@@ -3,9 +3,20 @@ from typing import Literal
 from enum import Enum
 
 SimType = Literal["wind", "sun"]
+PolygonizeMethod = Literal["raster", "per_cell"]
 
 
 class ProjectStatus(Enum):
     IDLE = "idle"
     BUSY = "busy"
     TO_BE_CLEANED = "to_be_cleaned"
+
+
+class ProjectCapability(Enum):
+    SUNLIGHT_HOURS = "sunlight_hours"  # sunlight hours service activated in the project
+
+
+class JobPhase(Enum):
+    PREPARING = "preparing"  # job accepted, simulation tasks are being created
+    DISPATCHED = "dispatched"  # simulation tasks exist
+    FAILED = "failed"
@@ -0,0 +1,67 @@
+import time
+from typing import Callable
+
+from celery.utils.log import get_task_logger
+
+from infrared_wrapper_api.config import settings
+from infrared_wrapper_api.dependencies import completion_times, metrics
+from infrared_wrapper_api.infrared_wrapper.infrared.infrared_connector import InfraredException, \
+    read_analysis_output
+from infrared_wrapper_api.infrared_wrapper.infrared.models import SimType
+
+logger = get_task_logger(__name__)
+
+"""
+Waits for simulation results at infrared.
+The first poll is scheduled shortly before the simulation is expected to complete (learned from previous simulations),
+then the result is polled at a short interval. Infrared has no status that tells whether the result is written,
+so each poll reads the result.
+"""
+
+
+def wait_for_analysis_output(
+        project_uuid: str,
+        snapshot_uuid: str,
+        result_uuid: str,
+        sim_type: SimType,
+        building_count: int,
+        triggered_at: float,
+        renew_lease: Callable[[], None] = None,
+) -> dict:
+    """
+    triggered_at is the time.monotonic() when the simulation was triggered.
+    renew_lease keeps the lease of the project while waiting, it is called before each poll.
+    """
+    polling = settings.infrared_communication
+    deadline = triggered_at + polling.result_timeout_seconds
+
+    expected_seconds = completion_times.expected_seconds(sim_type, building_count)
+    time.sleep(max(0.0, triggered_at + polling.first_poll_share * expected_seconds - time.monotonic()))
+
+    polls = 0
+    while True:
+        polls += 1
+        if renew_lease:
+            renew_lease()
+        try:
+            result = read_analysis_output(project_uuid, snapshot_uuid, result_uuid)
+        except KeyError:
+            # result not written yet
+            pass
+        else:
+            record_polling(sim_type, building_count, polls, time.monotonic() - triggered_at)
+            return result
+
+        if time.monotonic() + polling.poll_interval_seconds > deadline:
+            metrics.increment(f"{sim_type}_result_timeouts")
+            raise InfraredException(f"result {result_uuid} not ready after {polls} polls")
+
+        time.sleep(polling.poll_interval_seconds)
+
+
+def record_polling(sim_type: SimType, building_count: int, polls: int, seconds_to_result: float):
+    logger.info(f"Result ready after {seconds_to_result:.1f}s and {polls} polls ({building_count} buildings)")
+
+    completion_times.record(sim_type, building_count, seconds_to_result)
+    metrics.observe(f"{sim_type}_polls_per_tile", polls)
+    metrics.observe(f"{sim_type}_seconds_to_result", seconds_to_result)
@@ -50,7 +50,24 @@ def delete_project(user_uuid, project_uuid):
     return template.safe_substitute({"project_uuid": project_uuid, "user_uuid": user_uuid})
 
 
-def create_buildings(snapshot_uuid, buildings: List[dict]):
+def batch_mutations(mutations: List[str], alias: str) -> str:
+    """
+    Combines single mutations into one query, each mutation gets an alias like createObject0, createObject1, ...
+    """
+    aliased_mutations = "".join(
+        f"{alias}{count}: {mutation}"
+        for count, mutation in enumerate(mutations)
+    )
+
+    return Template("""
+        mutation {
+            $all_mutations
+            }
+        """
+                    ).safe_substitute({"all_mutations": aliased_mutations})
+
+
+def create_building_mutation(snapshot_uuid, building: dict) -> str:
     def get_building_geom(bld):
         """
         call json.dumps twice to create double escape characters \\
@@ -59,8 +76,7 @@ def create_buildings(snapshot_uuid, buildings: List[dict]):
         """
         return json.dumps(json.dumps(mapping(Polygon(bld["geometry"]["coordinates"][0]))))[1:-1]
 
-    single_building_create_template = Template("""
-            createObject$count: createNewBuilding(
+    template = Template("""createNewBuilding(
             use: "$building_use"
             height: $building_height
             category: "site"
@@ -72,26 +88,14 @@ def create_buildings(snapshot_uuid, buildings: List[dict]):
             }
             """)
 
-    all_buildings_queries = "".join(
-        single_building_create_template.safe_substitute(
-            {
-                "count": key,
-                "building_use": "some use",
-                "building_height": building["properties"]["building_height"],
-                "building_geom": get_building_geom(building),
-                "snapshot_uuid": snapshot_uuid
-            }
-        )
-        for key, building in enumerate(buildings)
+    return template.safe_substitute(
+        {
+            "building_use": "some use",
+            "building_height": building["properties"]["building_height"],
+            "building_geom": get_building_geom(building),
+            "snapshot_uuid": snapshot_uuid
+        }
     )
-    final_query = Template("""
-        mutation {
-            $all_building_queries
-            }
-        """
-                           ).safe_substitute({"all_building_queries": all_buildings_queries})
-
-    return final_query
 
 
 # unused for now
@@ -267,12 +271,11 @@ def get_geometry_objects_in_snapshot_query(snapshot_uuid):
     return template.safe_substitute({"snapshot_uuid": snapshot_uuid})
 
 
-def delete_buildings(snapshot_uuid, building_uuids: List[str]):
+def delete_building_mutation(snapshot_uuid, building_uuid: str) -> str:
     """
     delObject0: deleteBuilding ||| execution time: 2.350510597229004
     """
-    single_building_delete_template = Template("""
-                delObject$count: deleteBuilding(
+    template = Template("""deleteBuilding(
                 uuid: "$building_uuid",
                 snapshotUuid:"$snapshot_uuid"
                 ){
@@ -281,22 +284,14 @@ def delete_buildings(snapshot_uuid, building_uuids: List[str]):
 
             """)
 
-    all_buildings_queries = "".join(
-        single_building_delete_template.safe_substitute(
-            {
-                "count": key,
-                "snapshot_uuid": snapshot_uuid,
-                "building_uuid": building_uuid,
-            }
-        )
-        for key, building_uuid in enumerate(building_uuids)
+    return template.safe_substitute({"snapshot_uuid": snapshot_uuid, "building_uuid": building_uuid})
+
+
+def delete_buildings(snapshot_uuid, building_uuids: List[str]):
+    return batch_mutations(
+        [delete_building_mutation(snapshot_uuid, building_uuid) for building_uuid in building_uuids],
+        alias="delObject"
     )
-    return Template("""
-        mutation {
-            $all_building_queries
-            }
-        """
-                    ).safe_substitute({"all_building_queries": all_buildings_queries})
 
 
 def delete_streets(snapshot_uuid: str, street_uuids: List[str]):
@@ -0,0 +1,155 @@
+import base64
+import struct
+from dataclasses import dataclass
+from typing import List
+
+import geopandas as gpd
+import numpy as np
+import topojson as tp
+from affine import Affine
+from rasterio import features
+from shapely.geometry import shape
+
+from infrared_wrapper_api.infrared_wrapper.infrared.utils import reproject_gdf
+
+"""
+Compact raster representation of (cropped) simulation results.
+Tiles are cached and passed between tasks as ResultGrids and only polygonized once per job.
+"""
+
+# rows, cols, minx, maxy, resolution
+HEADER = struct.Struct("<IIddd")
+GRID_DTYPE = np.float32
+VALUE_DECIMALS = 6  # float32 precision, values are rounded to this when reading a grid
+
+
+@dataclass
+class ResultGrid:
+    grid: np.ndarray  # north-up, NaN where there is no result
+    minx: float
+    maxy: float
+    resolution: float
+
+    @classmethod
+    def from_transform(cls, grid: np.ndarray, transform: Affine):
+        return ResultGrid(grid=grid, minx=transform.c, maxy=transform.f, resolution=transform.a)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        rows, cols, minx, maxy, resolution = HEADER.unpack_from(data)
+        grid = np.frombuffer(data, dtype=GRID_DTYPE, count=rows * cols, offset=HEADER.size)
+
+        return ResultGrid(
+            grid=np.round(grid.astype(float), VALUE_DECIMALS).reshape(rows, cols),
+            minx=minx,
+            maxy=maxy,
+            resolution=resolution,
+        )
+
+    @classmethod
+    def from_dict(cls, result: dict):
+        return ResultGrid.from_bytes(base64.b64decode(result["grid"]))
+
+    def to_bytes(self) -> bytes:
+        rows, cols = self.grid.shape
+        header = HEADER.pack(rows, cols, self.minx, self.maxy, self.resolution)
+
+        return header + np.ascontiguousarray(self.grid, dtype=GRID_DTYPE).tobytes()
+
+    def to_dict(self) -> dict:
+        # json serializable for celery results
+        return encode_result_grid(self.to_bytes())
+
+    @property
+    def maxx(self) -> float:
+        return self.minx + self.grid.shape[1] * self.resolution
+
+    @property
+    def miny(self) -> float:
+        return self.maxy - self.grid.shape[0] * self.resolution
+
+    @property
+    def transform(self) -> Affine:
+        return Affine(self.resolution, 0, self.minx, 0, -self.resolution, self.maxy)
+
+
+def encode_result_grid(result_grid_bytes: bytes) -> dict:
+    return {"grid": base64.b64encode(result_grid_bytes).decode()}
+
+
+def move_result_grid_bytes(result_grid_bytes: bytes, minx: float, miny: float) -> bytes:
+    """
+    Moves a serialized grid to another south-western corner, without decoding the grid.
+    """
+    rows, cols, _, _, resolution = HEADER.unpack_from(result_grid_bytes)
+
+    return HEADER.pack(rows, cols, minx, miny + rows * resolution, resolution) + result_grid_bytes[HEADER.size:]
+
+
+def mosaic_result_grids(result_grids: List[ResultGrid]) -> ResultGrid:
+    """
+    Stitches the cropped result grids of all tiles into one grid (EPSG:25832).
+    Tiles share their resolution and are aligned to the same cell lattice.
+    """
+    resolution = result_grids[0].resolution
+    minx = min(result_grid.minx for result_grid in result_grids)
+    maxy = max(result_grid.maxy for result_grid in result_grids)
+    maxx = max(result_grid.maxx for result_grid in result_grids)
+    miny = min(result_grid.miny for result_grid in result_grids)
+
+    rows = int(round((maxy - miny) / resolution))
+    cols = int(round((maxx - minx) / resolution))
+    mosaic = np.full((rows, cols), np.nan)
+
+    for result_grid in result_grids:
+        row_offset = int(round((maxy - result_grid.maxy) / resolution))
+        col_offset = int(round((result_grid.minx - minx) / resolution))
+        tile_rows, tile_cols = result_grid.grid.shape
+
+        window = mosaic[row_offset:row_offset + tile_rows, col_offset:col_offset + tile_cols]
+        # keep values of tiles placed first, where tiles overlap
+        window[np.isnan(window)] = result_grid.grid[np.isnan(window)]
+
+    return ResultGrid(grid=mosaic, minx=minx, maxy=maxy, resolution=resolution)
+
+
+def polygonize_grid(grid: np.ndarray, transform: Affine) -> gpd.GeoDataFrame:
+    """
+    Polygonizes connected cells of same value of a north-up grid in one pass.
+    Returns a gdf with one (multi-)polygon per value. NaN cells are left out.
+    """
+    # polygonize integer labels, so float values survive unchanged
+    values, labels = np.unique(grid, return_inverse=True)
+    labels = labels.reshape(grid.shape).astype("int32")
+
+    polygons = []
+    polygon_values = []
+    for geometry, label in features.shapes(labels, mask=~np.isnan(grid), transform=transform):
+        polygons.append(shape(geometry))
+        polygon_values.append(float(values[int(label)]))
+
+    gdf = gpd.GeoDataFrame({"value": polygon_values}, geometry=polygons)
+
+    return gdf.dissolve(by="value").reset_index()
+
+
+def simplify_result_to_geojson(result_gdf: gpd.GeoDataFrame) -> dict:
+    """
+    Simplifies the polygonized result (EPSG:25832) and returns it as geojson in EPSG:4326
+    """
+    if result_gdf.empty:
+        return {"type": "FeatureCollection", "features": []}
+
+    # simplify the geometries with topojson (does not create gaps between simplified geoms)
+    topo = tp.Topology(result_gdf, prequantize=False)
+    result_gdf = topo.toposimplify(3).to_gdf()  # tolerance of 3 just delivered prettiest results
+    result_gdf.geometry = result_gdf.geometry.buffer(0)  # fix invalid geoms
+
+    # reproject and return geojson dict
+    return reproject_gdf(result_gdf, "EPSG:4326").to_geo_dict()
+
+
+def result_grid_to_geojson(result_grid: ResultGrid) -> dict:
+    result_gdf = polygonize_grid(result_grid.grid, result_grid.transform).set_crs("EPSG:25832")
+
+    return simplify_result_to_geojson(result_gdf)
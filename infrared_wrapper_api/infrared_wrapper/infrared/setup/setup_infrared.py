@@ -1,19 +1,26 @@
+import math
 import random
-from typing import List
+import time
+from typing import Callable, List
 
-from infrared_wrapper_api.dependencies import cache
+from infrared_wrapper_api.dependencies import cache, metrics, project_pool, project_registry
 from infrared_wrapper_api.infrared_wrapper.infrared.infrared_connector import get_all_building_uuids_for_project, \
-    create_new_project, get_project_name, get_all_cut_prototype_projects_uuids
-from infrared_wrapper_api.infrared_wrapper.infrared.infrared_project import InfraredProject
-from infrared_wrapper_api.infrared_wrapper.infrared.models import ProjectStatus
+    create_new_project, get_all_cut_prototype_projects_uuids, activate_sunlight_analysis_capability
+from infrared_wrapper_api.infrared_wrapper.infrared.infrared_project import InfraredProject, get_project_metadata
+from infrared_wrapper_api.infrared_wrapper.infrared.models import ProjectStatus, ProjectCapability
+from infrared_wrapper_api.project_pool import NoIdleProjectException
 from infrared_wrapper_api.utils import is_cut_prototype_project
 from infrared_wrapper_api.api.utils import update_infrared_project_status_in_redis
 from infrared_wrapper_api.config import settings
 
 MIN_EMPTY_PROJECT_COUNT = settings.infrared_communication.infrared_projects_count
+MAX_PROJECT_COUNT = settings.infrared_communication.max_infrared_projects_count
 
 
-def cleanup_project(project_uuid: str):
+def cleanup_project(project_uuid: str, lease_token: str) -> bool:
+    """
+    Cleans up a project leased for its cleanup, returns it to the project pool or replaces it if the cleanup fails.
+    """
     infrared_project = InfraredProject(project_uuid)
 
     try:
@@ -23,27 +30,40 @@ def cleanup_project(project_uuid: str):
     except Exception as e:
         print(f"cleaning up failed. creating a new project instead. Error: {e}")
         infrared_project.delete_this_project()
+        project_pool.remove(project_uuid)
         create_new_empty_project()
     else:
         # set project to be not busy again.
-        update_infrared_project_status_in_redis(project_uuid=project_uuid, status=ProjectStatus.IDLE.value)
+        update_infrared_project_status_in_redis(
+            project_uuid=project_uuid, status=ProjectStatus.IDLE.value, lease_token=lease_token
+        )
         print(f"cleanup complete {project_uuid}")
 
+    return True
 
-def get_count_empty_projects(all_project_uuids: List[str]) -> int:
-    count_empty_projects = 0
+
+def adopt_projects_without_status(all_project_uuids: List[str]) -> List[str]:
+    """
+    Projects without status (e.g. after the cache was flushed) are added to the project pool as idle.
+    Their buildings are unknown, unless they are empty. Returns the adopted projects.
+    """
+    adopted_project_uuids = []
 
     for project_uuid in all_project_uuids:
-        if is_cut_prototype_project(get_project_name(project_uuid)):
+        if cache.get(key=project_uuid):
+            continue
+
+        if is_cut_prototype_project(get_project_metadata(project_uuid)["name"]):
             project = InfraredProject(project_uuid)
             bld_uuids = get_all_building_uuids_for_project(project_uuid, project.snapshot_uuid)
 
             if len(bld_uuids) == 0:
-                count_empty_projects += 1
-                # make sure its marked as idle
-                update_infrared_project_status_in_redis(project_uuid=project_uuid, status=ProjectStatus.IDLE.value)
+                project_registry.mark_empty(project_uuid)
+            # make sure its marked as idle
+            update_infrared_project_status_in_redis(project_uuid=project_uuid, status=ProjectStatus.IDLE.value)
+            adopted_project_uuids.append(project_uuid)
 
-    return count_empty_projects
+    return adopted_project_uuids
 
 
 def create_new_empty_project():
@@ -61,44 +81,152 @@ def create_new_empty_project():
     print("created new empty project")
 
 
-def cleanup_infrared_projects():
+def retire_idle_project() -> bool:
+    """
+    Deletes an idle project of the pool. Returns False if no project is idle.
+    """
+    try:
+        project_uuid, _ = project_pool.acquire(timeout=0)
+    except NoIdleProjectException:
+        return False
+
+    InfraredProject(project_uuid).delete_this_project()
+    project_pool.remove(project_uuid)
+    print(f"retired project {project_uuid}")
+
+    return True
+
+
+def autoscale_project_pool(pending_tiles: int) -> int:
+    """
+    Scales the project pool with the demand for projects: tiles waiting for a project and pending tile tasks.
+    Creates projects for the demand the idle projects cannot meet, up to MAX_PROJECT_COUNT.
+    Retires idle projects above MIN_EMPTY_PROJECT_COUNT once there was no demand for a cool-down time.
+    Returns the change of the pool size.
+    """
+    config = settings.infrared_communication
+    idle_count = len(project_pool.idle_projects())
+    pool_size = idle_count + len(project_pool.leased_projects())
+    demand = pending_tiles + project_pool.waiting_claims()
+
+    metrics.observe("project_pool_size", pool_size)
+    metrics.observe("project_pool_utilisation", (pool_size - idle_count) / pool_size if pool_size else 1)
+    metrics.observe("project_pool_demand", demand)
+
+    last_demand = project_pool.last_demand()
+    if demand or last_demand is None:
+        project_pool.record_demand()
+
+    if demand > idle_count:
+        created = max(0, min(demand - idle_count, MAX_PROJECT_COUNT - pool_size, config.pool_scale_step))
+        for _ in range(created):
+            create_new_empty_project()
+        return created
+
+    if demand or last_demand is None or time.time() - last_demand < config.pool_scale_down_seconds:
+        return 0
+
+    surplus = min(pool_size - MIN_EMPTY_PROJECT_COUNT, config.pool_scale_step)
+    retired = 0
+    while retired < surplus and retire_idle_project():
+        retired += 1
+
+    return -retired
+
+
+def preactivate_sun_projects() -> int:
+    """
+    Activates the sunlight hours service in idle projects, until SUN_ACTIVATED_PROJECTS_SHARE of the pool has it.
+    Sun tiles prefer these projects and skip the activation. Returns the number of activated projects.
+    """
+    sun_capability = ProjectCapability.SUNLIGHT_HOURS.value
+    pool_projects = project_pool.idle_projects() + project_pool.leased_projects()
+    sun_projects = set(project_registry.with_capability(pool_projects, sun_capability))
+    target_count = math.ceil(settings.infrared_communication.sun_activated_projects_share * len(pool_projects))
+
+    metrics.observe("project_pool_sun_activated", len(sun_projects))
+
+    activated = 0
+    while len(sun_projects) < target_count:
+        try:
+            project_uuid, lease_token = project_pool.acquire(
+                timeout=0,
+                rank=lambda idle_projects: [uuid for uuid in idle_projects if uuid not in sun_projects]
+            )
+        except NoIdleProjectException:
+            break
+
+        try:
+            # falls back to any idle project, if all idle projects have the service activated already
+            if project_uuid in sun_projects or not activate_sunlight_analysis_capability(project_uuid):
+                break
+            project_registry.add_capability(project_uuid, sun_capability)
+            sun_projects.add(project_uuid)
+            activated += 1
+        finally:
+            # the activation does not change the buildings, the project is still idle
+            project_pool.release(project_uuid, lease_token)
+
+    return activated
+
+
+def cleanup_infrared_projects(cleanup: Callable[[str, str], bool] = cleanup_project) -> List[str]:
+    """
+    Reconciles the projects with the project pool. Projects are cleaned up by a task right after a failed simulation,
+    this catches projects whose cleanup got lost (e.g. expired leases of crashed workers).
+    Projects to be cleaned are leased for their cleanup, cleanup runs the cleanup itself or enqueues it
+    and returns whether it did.
+    """
+    # projects of expired leases (e.g. crashed workers) are in an unknown state
+    for project_uuid in project_pool.reclaim_expired_leases():
+        print(f"lease of project {project_uuid} expired.")
+        update_infrared_project_status_in_redis(project_uuid=project_uuid, status=ProjectStatus.TO_BE_CLEANED.value)
+
     all_project_uuids = get_all_cut_prototype_projects_uuids()
     idle_project_ids = []
     for project_uuid in all_project_uuids:
         project_info = cache.get(key=project_uuid)
         if project_info and project_info.get("status") == ProjectStatus.IDLE.value:
+            # make sure idle projects are in the project pool
+            project_pool.register(project_uuid)
             idle_project_ids.append(project_uuid)
-        if project_info and project_info.get("status") == ProjectStatus.TO_BE_CLEANED.value:
-            cleanup_project(project_uuid=project_uuid)
-            idle_project_ids.append(project_uuid)
+        # leased projects are being cleaned up already
+        if project_info and project_info.get("status") == ProjectStatus.TO_BE_CLEANED.value \
+                and (lease_token := project_pool.lease(project_uuid)):
+            if cleanup(project_uuid, lease_token):
+                idle_project_ids.append(project_uuid)
+            else:
+                # the cleanup of an expired lease is still pending, it skips the project. Leased again next time.
+                project_pool.end_lease(project_uuid, lease_token)
 
     return idle_project_ids
 
 
 def setup_infrared() -> List[dict]:
     """
-    Cleans buildings from all completed infrared projects
+    Cleans up failed infrared projects
     and ensures that we have enough idle projects waiting at infrared.
     """
-    cleanup_infrared_projects()
     all_project_uuids = get_all_cut_prototype_projects_uuids()
-
-    # check how many empty projects we have
-    count_empty = get_count_empty_projects(all_project_uuids)
+    # idle projects keep the buildings of their last simulation, they are usable all the same
+    idle_project_uuids = set(cleanup_infrared_projects() + adopt_projects_without_status(all_project_uuids))
     print(f"Currently {len(all_project_uuids)} CUT-PROTOTYPE projects at infrared for our user.")
-    print(f"Of which {count_empty} are empty and ready to be used.")
-    if count_empty < MIN_EMPTY_PROJECT_COUNT:
-        print(f"We should have a minimum of {MIN_EMPTY_PROJECT_COUNT} empty projects.")
-
-    # create more empty projects if needed
-    if count_empty < MIN_EMPTY_PROJECT_COUNT:
-        for _ in range(MIN_EMPTY_PROJECT_COUNT - count_empty):
+    print(f"Of which {len(idle_project_uuids)} are idle and ready to be used.")
+
+    # create more projects if needed, within the max. size of the pool
+    missing_count = min(
+        MIN_EMPTY_PROJECT_COUNT - len(idle_project_uuids),
+        MAX_PROJECT_COUNT - len(all_project_uuids)
+    )
+    if missing_count > 0:
+        print(f"We should have a minimum of {MIN_EMPTY_PROJECT_COUNT} idle projects.")
+        for _ in range(missing_count):
             create_new_empty_project()
 
     # list of all projects' status
     return [
         {
-            "name": get_project_name(project_uuid),
+            "name": get_project_metadata(project_uuid)["name"],
             "status": cache.get(key=project_uuid).get("status", None)
         }
         for project_uuid in get_all_cut_prototype_projects_uuids()
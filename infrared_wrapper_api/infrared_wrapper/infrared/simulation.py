@@ -1,9 +1,14 @@
+import time
+from typing import Callable, Dict, Tuple
+
 import geopandas as gpd
 
 from infrared_wrapper_api.infrared_wrapper.infrared.infrared_connector import trigger_wind_simulation, \
-    get_analysis_output, activate_sunlight_analysis_capability, trigger_sun_simulation
-from infrared_wrapper_api.infrared_wrapper.infrared.infrared_project import InfraredProject
-from infrared_wrapper_api.infrared_wrapper.infrared.infrared_result import georeference_infrared_result
+    trigger_sun_simulation
+from infrared_wrapper_api.infrared_wrapper.infrared.infrared_project import InfraredProject, prepare_buildings
+from infrared_wrapper_api.infrared_wrapper.infrared.infrared_result import crop_infrared_result, cropped_grid_origin
+from infrared_wrapper_api.infrared_wrapper.infrared.polling import wait_for_analysis_output
+from infrared_wrapper_api.infrared_wrapper.infrared.result_grid import ResultGrid, move_result_grid_bytes
 
 from celery.utils.log import get_task_logger
 
@@ -15,10 +20,31 @@ logger = get_task_logger(__name__)
 def do_simulation(
     project_uuid: str,
     sim_task: dict
+) -> ResultGrid:
+    return format_result(run_simulation(project_uuid, sim_task), sim_task)
+
+
+def run_simulation(
+    project_uuid: str,
+    sim_task: dict,
+    tile_buildings: Dict[str, dict] = None,
+    renew_lease: Callable[[], None] = None
 ) -> dict:
-    infrared_project = update_buildings_at_infrared(project_uuid, sim_task)
+    """
+    Runs the simulation at infrared and returns its raw result.
+    This is the only part of a simulation that needs the infrared project.
+    tile_buildings are the prepared buildings of the sim_task, if they were prepared already.
+    renew_lease keeps the lease of the project, it is called after the upload and while waiting for the result.
+    """
+    if tile_buildings is None:
+        tile_buildings = prepare_buildings(sim_task["buildings"], sim_task["simulation_area"])
+
+    infrared_project = update_buildings_at_infrared(project_uuid, sim_task, tile_buildings)
+    if renew_lease:
+        renew_lease()
     sim_type = sim_task["sim_type"]
 
+    triggered_at = time.monotonic()
     if sim_type == "wind":
         result_uuid = trigger_wind_simulation(
             snapshot_uuid=infrared_project.snapshot_uuid,
@@ -37,33 +63,51 @@ def do_simulation(
     # increase the logged sim requests by 1
     log_request(sim_type)
 
-    return collect_and_format_result(infrared_project, sim_task, result_uuid)
+    return collect_result(infrared_project, result_uuid, sim_type, len(tile_buildings), triggered_at, renew_lease)
 
 
-def update_buildings_at_infrared(project_uuid, task: dict) -> InfraredProject:
+def update_buildings_at_infrared(project_uuid, task: dict, tile_buildings: Dict[str, dict]) -> InfraredProject:
     logger.info(f"Updating buildings at infrared for project {project_uuid}")
-    infrared_project = InfraredProject(project_uuid)
-    infrared_project.update_buildings_at_infrared(
-        task["buildings"],
-        task["simulation_area"]
+    return InfraredProject.with_buildings(
+        project_uuid,
+        tile_buildings,
+        activate_sun=task["sim_type"] == "sun"
     )
 
-    if task["sim_type"] == "sun":
-        activate_sunlight_analysis_capability(project_uuid)
 
-    return infrared_project
-
-
-def collect_and_format_result(infrared_project: InfraredProject, sim_task: dict, result_uuid: str) -> dict:
-    logger.info("Trying to collect result now (waiting to be ready)")
-    result_raw = get_analysis_output(
+def collect_result(
+    infrared_project: InfraredProject,
+    result_uuid: str,
+    sim_type: str,
+    building_count: int,
+    triggered_at: float,
+    renew_lease: Callable[[], None] = None
+) -> dict:
+    logger.info("Waiting for result to be ready")
+    return wait_for_analysis_output(
         infrared_project.project_uuid,
         infrared_project.snapshot_uuid,
-        result_uuid
+        result_uuid,
+        sim_type=sim_type,
+        building_count=building_count,
+        triggered_at=triggered_at,
+        renew_lease=renew_lease,
     )
 
-    logger.info("Converting raw result into geojson")
-    return georeference_infrared_result(
-        result_raw,
-        gpd.GeoDataFrame.from_features(sim_task["simulation_area"]["features"]).total_bounds
-    )
\ No newline at end of file
+
+def format_result(result_raw: dict, sim_task: dict) -> ResultGrid:
+    logger.info("Cropping raw result to georeferenced grid")
+    return crop_infrared_result(result_raw, get_simulation_area_bounds(sim_task))
+
+
+def move_cached_result(result_grid_bytes: bytes, total_bounds_simulation_area: Tuple[float, ...]) -> bytes:
+    """
+    Tiles with the same buildings share their cached result, wherever they are. Moves the result to this tile.
+    """
+    minx, miny = cropped_grid_origin(total_bounds_simulation_area)
+
+    return move_result_grid_bytes(result_grid_bytes, minx, miny)
+
+
+def get_simulation_area_bounds(sim_task: dict) -> Tuple[float, ...]:
+    return tuple(gpd.GeoDataFrame.from_features(sim_task["simulation_area"]["features"]).total_bounds)
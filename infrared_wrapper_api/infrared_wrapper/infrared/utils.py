@@ -1,5 +1,16 @@
 import geopandas as gpd
 import json
+from functools import lru_cache
+
+import numpy as np
+import shapely
+from pyproj import Transformer
+from shapely.geometry import shape
+
+from infrared_wrapper_api.config import settings
+from infrared_wrapper_api.infrared_wrapper.infrared.building_interchange import read_buildings
+from infrared_wrapper_api.utils import hash_dict
+
 
 # gets a values from a nested object
 def get_value(data, path):
@@ -13,7 +24,69 @@ def get_value(data, path):
 
 
 def reproject_geojson(geojson_in: dict, source_crs, target_crs) -> dict:
-    gdf = gpd.GeoDataFrame.from_features(geojson_in)
-    gdf = gdf.set_crs(source_crs, allow_override=True)
+    features = geojson_in["features"]
+    geometries = reproject_geometries([shape(feature["geometry"]) for feature in features], source_crs, target_crs)
+
+    return {
+        **geojson_in,
+        "features": [
+            {**feature, "geometry": json.loads(geometry)}
+            for feature, geometry in zip(features, shapely.to_geojson(geometries))
+        ]
+    }
+
+
+def reproject_gdf(gdf: gpd.GeoDataFrame, target_crs) -> gpd.GeoDataFrame:
+    return gdf.set_geometry(reproject_geometries(gdf.geometry.values, gdf.crs, target_crs), crs=target_crs)
+
+
+def reproject_geometries(geometries, source_crs, target_crs) -> np.ndarray:
+    """
+    Reprojects the vertices of all geometries in one vectorized call
+    """
+    transformer = get_transformer(str(source_crs), str(target_crs))
+
+    return shapely.transform(
+        np.asarray(geometries, dtype=object),
+        lambda coords: np.column_stack(transformer.transform(coords[:, 0], coords[:, 1]))
+    )
+
+
+@lru_cache(maxsize=None)
+def get_transformer(source_crs: str, target_crs: str) -> Transformer:
+    # creating a transformer takes longer than transforming thousands of buildings
+    return Transformer.from_crs(source_crs, target_crs, always_xy=True)
+
+
+def canonical_tile_hash(buildings: dict, simulation_area: dict) -> str:
+    """
+    Hash of the buildings of a tile, the same for physically identical tiles wherever they are.
+    Buildings are translated to the tile's local coord. system and their vertices are rounded to a tenth of the
+    analysis resolution, so neither the tile's origin, the order of features nor floating point noise change the hash.
+    Every building counts, small ones (e.g. kiosks) do not collapse on this grid.
+    Heights are rounded to 10m, like simplify_building_input does.
+    """
+    resolution = settings.infrared_calculation.analysis_resolution
+    grid_size = resolution / 10
+    minx, miny, maxx, maxy = gpd.GeoDataFrame.from_features(simulation_area["features"]).total_bounds
+
+    canonical_buildings = []
+    buildings_gdf = read_buildings(buildings).explode(ignore_index=True)
+    if len(buildings_gdf):
+        # vertices in grid units, + 0.0 turns -0.0 into 0.0
+        polygons = shapely.normalize(
+            shapely.transform(
+                np.asarray(buildings_gdf.translate(-minx, -miny).values, dtype=object),
+                lambda coords: np.round(coords / grid_size) + 0.0
+            )
+        )
+
+        canonical_buildings = sorted(
+            (polygon.wkt, float(round(height, -1)))
+            for polygon, height in zip(polygons, buildings_gdf["building_height"])
+        )
 
-    return json.loads(gdf.to_crs(target_crs).to_json())
\ No newline at end of file
+    return hash_dict({
+        "tile_size": [round((maxx - minx) / resolution), round((maxy - miny) / resolution)],
+        "buildings": canonical_buildings,
+    })
@@ -0,0 +1,75 @@
+import logging
+from typing import Dict, List
+
+import numpy as np
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics:
+    """
+    Collects metrics of all api and worker processes in redis.
+    Observations keep the latest values of a metric, counters are summed up.
+    Recording a metric never fails the calling code.
+    """
+
+    def __init__(self, redis_client: redis.Redis, key_prefix: str, max_observations: int = 1000):
+        self._redis = redis_client
+        self._key_prefix = f"{key_prefix}:metrics"
+        self._max_observations = max_observations
+
+    def observe(self, name: str, value: float):
+        try:
+            key = self._observations_key(name)
+            pipeline = self._redis.pipeline()
+            pipeline.lpush(key, value)
+            pipeline.ltrim(key, 0, self._max_observations - 1)
+            pipeline.sadd(f"{self._key_prefix}:observed", name)
+            pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning(f"could not record metric {name}: {e}")
+
+    def increment(self, name: str, amount: float = 1):
+        try:
+            self._redis.hincrbyfloat(f"{self._key_prefix}:counters", name, amount)
+        except redis.RedisError as e:
+            logger.warning(f"could not record metric {name}: {e}")
+
+    def observations(self, name: str) -> List[float]:
+        return [float(value) for value in self._redis.lrange(self._observations_key(name), 0, -1)]
+
+    def summary(self, name: str) -> dict:
+        values = self.observations(name)
+
+        if not values:
+            return {"count": 0}
+
+        return {
+            "count": len(values),
+            "mean": float(np.mean(values)),
+            "p50": float(np.percentile(values, 50)),
+            "p95": float(np.percentile(values, 95)),
+            "max": float(np.max(values)),
+        }
+
+    def counters(self) -> Dict[str, float]:
+        return {
+            name: float(value)
+            for name, value in self._redis.hgetall(f"{self._key_prefix}:counters").items()
+        }
+
+    def report(self) -> dict:
+        """
+        Summaries of the latest observations and all counters
+        """
+        return {
+            "observations": {
+                name: self.summary(name)
+                for name in sorted(self._redis.smembers(f"{self._key_prefix}:observed"))
+            },
+            "counters": self.counters(),
+        }
+
+    def _observations_key(self, name: str) -> str:
+        return f"{self._key_prefix}:observations:{name}"
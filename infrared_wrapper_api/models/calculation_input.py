@@ -1,9 +1,11 @@
 from abc import abstractmethod
 from pathlib import Path
+from typing import List, Union
 
-from pydantic import Field
+from pydantic import Field, validator
 
 from infrared_wrapper_api.infrared_wrapper.infrared.models import SimType
+from infrared_wrapper_api.infrared_wrapper.infrared.utils import canonical_tile_hash
 from infrared_wrapper_api.models.base import BaseModelStrict
 from infrared_wrapper_api.utils import hash_dict, load_json_file
 
@@ -46,6 +48,32 @@ class SunSimulationInput(SimulationScenario):
         }
 
 
+class SimulationDelta(BaseModelStrict):
+    """
+    Changes to the scenario of an earlier job. Buildings are identified by their feature id.
+    Buildings submitted without id are identified by their position in the submitted buildings,
+    buildings added by a delta without id by "<delta job id>:<position in added>".
+    """
+    added: dict = Field(default=None, description="geojson of buildings to add")
+    modified: dict = Field(default=None, description="geojson of buildings replacing the buildings with the same id")
+    removed: List[Union[int, str]] = Field(default=[], description="ids of buildings to remove")
+
+    @validator("modified")
+    def modified_buildings_have_ids(cls, modified):
+        if modified and any("id" not in feature for feature in modified.get("features", [])):
+            raise ValueError("modified buildings need the id of the building they replace")
+        return modified
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "added": {"type": "FeatureCollection", "features": []},
+                "modified": {"type": "FeatureCollection", "features": []},
+                "removed": [0, 1],
+            }
+        }
+
+
 # put project area there?
 class InfraredSimulationTask(BaseModelStrict):
     simulation_area: dict  # geojson with area bbox
@@ -71,7 +99,7 @@ class WindSimulationTask(InfraredSimulationTask, WindSimulationInput):
 
     @property
     def hash(self) -> str:
-        return hash_dict({"buildings": self.buildings})
+        return canonical_tile_hash(self.buildings, self.simulation_area)
 
     @property
     def settings_hash(self) -> str:
@@ -95,7 +123,7 @@ class SunSimulationTask(InfraredSimulationTask, SunSimulationInput):
 
     @property
     def hash(self) -> str:
-        return hash_dict({"buildings": self.buildings})
+        return canonical_tile_hash(self.buildings, self.simulation_area)
 
     @property
     def celery_key(self) -> str:
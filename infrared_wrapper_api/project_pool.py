@@ -0,0 +1,256 @@
+import time
+import uuid
+from typing import Callable, List, Optional, Tuple
+
+import redis
+
+
+class NoIdleProjectException(Exception):
+    "Raised when no idle project found"
+    pass
+
+
+class LeaseLostException(Exception):
+    "Raised when the lease of a project expired and was reclaimed"
+    pass
+
+
+# KEYS: idle projects, leases, lease tokens | ARGV: lease expiry, lease token, preferred projects...
+CLAIM_SCRIPT = """
+for i = 3, #ARGV do
+    if redis.call('LREM', KEYS[1], 1, ARGV[i]) == 1 then
+        redis.call('ZADD', KEYS[2], ARGV[1], ARGV[i])
+        redis.call('HSET', KEYS[3], ARGV[i], ARGV[2])
+        return ARGV[i]
+    end
+end
+local project_uuid = redis.call('LPOP', KEYS[1])
+if project_uuid then
+    redis.call('ZADD', KEYS[2], ARGV[1], project_uuid)
+    redis.call('HSET', KEYS[3], project_uuid, ARGV[2])
+end
+return project_uuid
+"""
+
+# KEYS: idle projects, leases, release signals, lease tokens | ARGV: project uuid, lease token
+RELEASE_SCRIPT = """
+if redis.call('HGET', KEYS[4], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+redis.call('LREM', KEYS[1], 0, ARGV[1])
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('RPUSH', KEYS[3], 1)
+redis.call('LTRIM', KEYS[3], 0, redis.call('LLEN', KEYS[1]) - 1)
+return 1
+"""
+
+# KEYS: idle projects, leases, release signals | ARGV: project uuid
+REGISTER_SCRIPT = """
+if redis.call('ZSCORE', KEYS[2], ARGV[1]) or redis.call('LPOS', KEYS[1], ARGV[1]) then
+    return 0
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('RPUSH', KEYS[3], 1)
+return 1
+"""
+
+# KEYS: idle projects, leases, lease tokens | ARGV: lease expiry, project uuid, lease token
+LEASE_SCRIPT = """
+if redis.call('ZSCORE', KEYS[2], ARGV[2]) or redis.call('LPOS', KEYS[1], ARGV[2]) then
+    return 0
+end
+redis.call('ZADD', KEYS[2], ARGV[1], ARGV[2])
+redis.call('HSET', KEYS[3], ARGV[2], ARGV[3])
+return 1
+"""
+
+# KEYS: leases, lease tokens | ARGV: lease expiry, project uuid, lease token
+RENEW_SCRIPT = """
+if redis.call('HGET', KEYS[2], ARGV[2]) ~= ARGV[3] then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
+# KEYS: leases, lease tokens | ARGV: project uuid, lease token
+END_LEASE_SCRIPT = """
+if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+return 1
+"""
+
+# KEYS: leases, lease tokens | ARGV: now
+RECLAIM_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if #expired > 0 then
+    redis.call('ZREM', KEYS[1], unpack(expired))
+    redis.call('HDEL', KEYS[2], unpack(expired))
+end
+return expired
+"""
+
+
+class ProjectPool:
+    """
+    Leases INFRARED projects to simulations.
+    Idle projects wait in a redis list and are claimed atomically.
+    Claimed projects are leased with an expiry, so projects of crashed workers can be reclaimed.
+    Each lease has a token, only its holder can renew, end or release it. Once a lease expired and was reclaimed,
+    its former holder cannot return the project to the idle projects anymore.
+    """
+
+    def __init__(self, redis_client: redis.Redis, key_prefix: str, lease_seconds: int):
+        self._redis = redis_client
+        self._idle_key = f"{key_prefix}:projects:idle"
+        self._leases_key = f"{key_prefix}:projects:leases"
+        self._lease_tokens_key = f"{key_prefix}:projects:lease_tokens"
+        self._released_key = f"{key_prefix}:projects:released"
+        self._waiting_key = f"{key_prefix}:projects:waiting"
+        self._demand_key = f"{key_prefix}:projects:last_demand"
+        self._lock_key_prefix = f"{key_prefix}:projects:lock"
+        self._lease_seconds = lease_seconds
+
+        self._claim = self._redis.register_script(CLAIM_SCRIPT)
+        self._release = self._redis.register_script(RELEASE_SCRIPT)
+        self._register = self._redis.register_script(REGISTER_SCRIPT)
+        self._lease = self._redis.register_script(LEASE_SCRIPT)
+        self._renew = self._redis.register_script(RENEW_SCRIPT)
+        self._end_lease = self._redis.register_script(END_LEASE_SCRIPT)
+        self._reclaim = self._redis.register_script(RECLAIM_SCRIPT)
+
+    def acquire(self, timeout: float, rank: Callable[[List[str]], List[str]] = None) -> Tuple[str, str]:
+        """
+        Claims an idle project. Waits for a project to be released, if all are leased.
+        rank orders the idle projects by preference, the first one still idle is claimed.
+        Returns the project and the token of its lease.
+        """
+        deadline = time.monotonic() + timeout
+        waiting_claim = None
+
+        try:
+            while True:
+                lease_expiry = time.time() + self._lease_seconds
+                lease_token = uuid.uuid4().hex
+                preferred = rank(self.idle_projects()) if rank else []
+                if project_uuid := self._claim(
+                        keys=[self._idle_key, self._leases_key, self._lease_tokens_key],
+                        args=[lease_expiry, lease_token, *preferred]
+                ):
+                    return project_uuid, lease_token
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise NoIdleProjectException("All infrared projects seem to be in use!")
+
+                if waiting_claim is None:
+                    # waiting claims show the demand for more projects, they expire with their timeout
+                    waiting_claim = uuid.uuid4().hex
+                    self._redis.zadd(self._waiting_key, {waiting_claim: time.time() + remaining})
+
+                # block until a project is released, then compete for it
+                self._redis.blpop([self._released_key], timeout=max(1, int(min(remaining, 5))))
+        finally:
+            if waiting_claim is not None:
+                self._redis.zrem(self._waiting_key, waiting_claim)
+
+    def release(self, project_uuid: str, lease_token: str) -> bool:
+        """
+        Returns a (cleaned) project to the idle projects and wakes up a waiting claim.
+        Returns False if the lease is not held anymore (e.g. expired and reclaimed), the project is left alone then.
+        """
+        return bool(
+            self._release(
+                keys=[self._idle_key, self._leases_key, self._released_key, self._lease_tokens_key],
+                args=[project_uuid, lease_token]
+            )
+        )
+
+    def register(self, project_uuid: str) -> bool:
+        """
+        Adds an idle project to the pool, unless it is in the pool or leased already.
+        """
+        return bool(
+            self._register(keys=[self._idle_key, self._leases_key, self._released_key], args=[project_uuid])
+        )
+
+    def lease(self, project_uuid: str) -> Optional[str]:
+        """
+        Leases a project that is neither idle nor leased (e.g. to clean it up). Only one caller succeeds.
+        Returns the token of the lease, None if the project is idle or leased already.
+        """
+        lease_token = uuid.uuid4().hex
+        leased = self._lease(
+            keys=[self._idle_key, self._leases_key, self._lease_tokens_key],
+            args=[time.time() + self._lease_seconds, project_uuid, lease_token]
+        )
+
+        return lease_token if leased else None
+
+    def renew_lease(self, project_uuid: str, lease_token: str) -> bool:
+        """
+        Extends the lease by lease_seconds from now. Returns False if the lease is not held anymore.
+        """
+        return bool(
+            self._renew(
+                keys=[self._leases_key, self._lease_tokens_key],
+                args=[time.time() + self._lease_seconds, project_uuid, lease_token]
+            )
+        )
+
+    def end_lease(self, project_uuid: str, lease_token: str) -> bool:
+        """
+        Ends the lease of a project without returning it to the idle projects (e.g. as it needs a cleanup first)
+        """
+        return bool(self._end_lease(keys=[self._leases_key, self._lease_tokens_key], args=[project_uuid, lease_token]))
+
+    def reclaim_expired_leases(self) -> List[str]:
+        """
+        Ends all expired leases and returns their projects. Their state is unknown, they need a cleanup.
+        """
+        return self._reclaim(keys=[self._leases_key, self._lease_tokens_key], args=[time.time()])
+
+    def remove(self, project_uuid: str):
+        self._redis.lrem(self._idle_key, 0, project_uuid)
+        self._redis.zrem(self._leases_key, project_uuid)
+        self._redis.hdel(self._lease_tokens_key, project_uuid)
+
+    def waiting_claims(self) -> int:
+        """
+        Number of claims waiting for a project to be released
+        """
+        # claims of crashed workers expire
+        self._redis.zremrangebyscore(self._waiting_key, "-inf", time.time())
+
+        return self._redis.zcard(self._waiting_key)
+
+    def record_demand(self):
+        self._redis.set(self._demand_key, time.time())
+
+    def last_demand(self) -> Optional[float]:
+        """
+        Time of the last recorded demand for projects, None if never recorded
+        """
+        last_demand = self._redis.get(self._demand_key)
+
+        return None if last_demand is None else float(last_demand)
+
+    def try_lock(self, name: str, seconds: int) -> bool:
+        """
+        Lock for maintenance of the pool (e.g. scaling), expires after seconds. Only one holder at a time.
+        """
+        return bool(self._redis.set(f"{self._lock_key_prefix}:{name}", 1, nx=True, ex=seconds))
+
+    def unlock(self, name: str):
+        self._redis.delete(f"{self._lock_key_prefix}:{name}")
+
+    def idle_projects(self) -> List[str]:
+        return self._redis.lrange(self._idle_key, 0, -1)
+
+    def leased_projects(self) -> List[str]:
+        return self._redis.zrange(self._leases_key, 0, -1)
@@ -0,0 +1,135 @@
+from typing import Dict, List, Optional, Set
+
+import redis
+
+
+class ProjectRegistry:
+    """
+    Remembers which buildings (by content hash) are loaded in each INFRARED project, with their uuids at INFRARED.
+    A project can then be updated with the delta to the buildings of the next tile, instead of a full re-upload.
+    The buildings of projects without registry entry are unknown.
+    Also keeps the metadata of each project (root snapshot uuid, name), which does not change while the project exists.
+    Metadata is kept in redis and in-process, so it is only queried from INFRARED once.
+    Service capabilities activated in a project (e.g. sunlight hours) are kept until the project is removed.
+    """
+
+    def __init__(self, redis_client: redis.Redis, key_prefix: str):
+        self._redis = redis_client
+        self._key_prefix = f"{key_prefix}:projects"
+        self._known_key = f"{self._key_prefix}:known"
+        self._metadata = {}
+
+    def loaded_buildings(self, project_uuid: str) -> Optional[Dict[str, str]]:
+        """
+        Returns the uuids of the loaded buildings by content hash, None if the buildings of the project are unknown.
+        """
+        pipeline = self._redis.pipeline()
+        pipeline.sismember(self._known_key, project_uuid)
+        pipeline.hgetall(self._buildings_key(project_uuid))
+        known, buildings = pipeline.execute()
+
+        return buildings if known else None
+
+    def set_loaded_buildings(self, project_uuid: str, buildings: Dict[str, str]):
+        pipeline = self._redis.pipeline()
+        pipeline.delete(self._buildings_key(project_uuid))
+        if buildings:
+            pipeline.hset(self._buildings_key(project_uuid), mapping=buildings)
+        pipeline.sadd(self._known_key, project_uuid)
+        pipeline.execute()
+
+    def mark_empty(self, project_uuid: str):
+        self.set_loaded_buildings(project_uuid, {})
+
+    def forget(self, project_uuid: str):
+        """
+        Marks the buildings of a project as unknown, e.g. while they are being changed.
+        """
+        pipeline = self._redis.pipeline()
+        pipeline.srem(self._known_key, project_uuid)
+        pipeline.delete(self._buildings_key(project_uuid))
+        pipeline.execute()
+
+    def project_metadata(self, project_uuid: str) -> Optional[Dict[str, str]]:
+        """
+        Returns snapshot_uuid and name of the project, None if not registered.
+        """
+        if project_uuid not in self._metadata:
+            metadata = self._redis.hgetall(self._metadata_key(project_uuid))
+            if not metadata:
+                return None
+            self._metadata[project_uuid] = metadata
+
+        return self._metadata[project_uuid]
+
+    def set_project_metadata(self, project_uuid: str, snapshot_uuid: str, name: str):
+        metadata = {"snapshot_uuid": snapshot_uuid, "name": name}
+        self._redis.hset(self._metadata_key(project_uuid), mapping=metadata)
+        self._metadata[project_uuid] = metadata
+
+    def capabilities(self, project_uuid: str) -> Set[str]:
+        return self._redis.smembers(self._capabilities_key(project_uuid))
+
+    def add_capability(self, project_uuid: str, capability: str):
+        self._redis.sadd(self._capabilities_key(project_uuid), capability)
+
+    def with_capability(self, project_uuids: List[str], capability: str) -> List[str]:
+        """
+        The given projects that have the capability, in their order.
+        """
+        pipeline = self._redis.pipeline()
+        for project_uuid in project_uuids:
+            pipeline.sismember(self._capabilities_key(project_uuid), capability)
+
+        return [project_uuid for project_uuid, capable in zip(project_uuids, pipeline.execute()) if capable]
+
+    def remove(self, project_uuid: str):
+        """
+        Removes buildings, metadata and capabilities of a deleted project.
+        """
+        self.forget(project_uuid)
+        self._redis.delete(self._metadata_key(project_uuid), self._capabilities_key(project_uuid))
+        self._metadata.pop(project_uuid, None)
+
+    def rank_projects(
+            self,
+            project_uuids: List[str],
+            building_hashes: List[str],
+            capability: str = None
+    ) -> List[str]:
+        """
+        Orders projects by the number of buildings to delete and create to load the given buildings.
+        Projects with unknown buildings come last.
+        If a capability is given, projects that have it come first - activating it costs a query on the critical path.
+        """
+        if not project_uuids:
+            return []
+
+        pipeline = self._redis.pipeline()
+        for project_uuid in project_uuids:
+            pipeline.sismember(self._known_key, project_uuid)
+            pipeline.hlen(self._buildings_key(project_uuid))
+            if building_hashes:
+                pipeline.hmget(self._buildings_key(project_uuid), building_hashes)
+            if capability:
+                pipeline.sismember(self._capabilities_key(project_uuid), capability)
+        results = iter(pipeline.execute())
+
+        rank_keys = {}
+        for project_uuid in project_uuids:
+            known, loaded_count = next(results), next(results)
+            kept_count = sum(uuid is not None for uuid in next(results)) if building_hashes else 0
+            lacks_capability = not next(results) if capability else False
+            delta_size = (loaded_count - kept_count) + (len(building_hashes) - kept_count) if known else 0
+            rank_keys[project_uuid] = (not known, lacks_capability, delta_size)
+
+        return sorted(project_uuids, key=rank_keys.get)
+
+    def _buildings_key(self, project_uuid: str) -> str:
+        return f"{self._key_prefix}:{project_uuid}:buildings"
+
+    def _metadata_key(self, project_uuid: str) -> str:
+        return f"{self._key_prefix}:{project_uuid}:metadata"
+
+    def _capabilities_key(self, project_uuid: str) -> str:
+        return f"{self._key_prefix}:{project_uuid}:capabilities"
@@ -1,94 +1,440 @@
-from celery import group
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Tuple
+
+import geopandas as gpd
+from celery import chain, chord, Signature
+from celery.utils import uuid
 from celery.utils.log import get_task_logger
 from fastapi.encoders import jsonable_encoder
+from shapely.geometry import box
 
-from infrared_wrapper_api.dependencies import cache, celery_app
-from infrared_wrapper_api.infrared_wrapper.data_preparation import create_simulation_tasks
-from infrared_wrapper_api.infrared_wrapper.infrared.infrared_connector import get_all_cut_prototype_projects_uuids
-from infrared_wrapper_api.infrared_wrapper.infrared.models import SimType, ProjectStatus
-from infrared_wrapper_api.infrared_wrapper.infrared.utils import reproject_geojson
-from infrared_wrapper_api.api.utils import find_idle_infrared_project, update_infrared_project_status_in_redis
-from infrared_wrapper_api.infrared_wrapper.infrared.simulation import do_simulation
+from infrared_wrapper_api.config import settings
+from infrared_wrapper_api.dependencies import cache, celery_app, metrics, project_pool
+from infrared_wrapper_api.infrared_wrapper.data_preparation import create_tile_definitions, create_simulation_task, \
+    apply_building_delta, find_affected_bboxes, create_bbox_matrix_for_uncovered, assign_building_ids
+from infrared_wrapper_api.infrared_wrapper.infrared.building_interchange import encode_buildings
+from infrared_wrapper_api.infrared_wrapper.infrared.models import SimType, ProjectStatus, JobPhase, ProjectCapability
+from infrared_wrapper_api.infrared_wrapper.infrared.result_grid import encode_result_grid
+from infrared_wrapper_api.infrared_wrapper.infrared.utils import reproject_gdf
+from infrared_wrapper_api.api.utils import lease_idle_infrared_project, update_infrared_project_status_in_redis, \
+    unify_tile_results, store_job_result, update_job_info, record_tile_cache_lookup, store_job_input, \
+    get_job_input, get_job_info, store_tile_key, get_tile_keys
+from infrared_wrapper_api.infrared_wrapper.infrared.infrared_project import prepare_buildings, \
+    BuildingsNotLoadedException
+from infrared_wrapper_api.infrared_wrapper.infrared.simulation import run_simulation, format_result, \
+    move_cached_result, get_simulation_area_bounds
+from infrared_wrapper_api.infrared_wrapper.infrared.setup.setup_infrared import cleanup_project, \
+    autoscale_project_pool, preactivate_sun_projects
+from infrared_wrapper_api.project_pool import NoIdleProjectException, LeaseLostException
 
 logger = get_task_logger(__name__)
 
 
 """
-This task is triggered by the endpoint.
+This task is triggered by the endpoint, which does not wait for it.
 It will create a split the simulation into several simulations of 500*500meters areas.
 It will create a list of simulation_tasks with a simulation task for each area.
-It will create a group task for all simulation_tasks
+It will create a group task for all simulation_tasks, with the job id as group id,
+which unifies the results of all simulation_tasks once the group finished.
+"""
+@celery_app.task()
+def task__compute(simulation_input: dict, sim_type: SimType, job_id: str) -> str:
+    print(f"RECEIVED SIMULATION REQUEST OF TYPE {sim_type} FOR JOB {job_id}")
+
+    prepare_job(job_id, lambda: dispatch_simulation_tasks(simulation_input, sim_type, job_id))
+
+    return job_id
+
+
+"""
+Like task__compute, for a scenario submitted as delta (added, modified and removed buildings) to an earlier job.
+Only the tiles of the base job affected by the changed buildings (including their buffer) are simulated again,
+the other tiles are taken from the base job's cached tile results.
 """
 @celery_app.task()
-def task__compute(simulation_input: dict, sim_type: SimType) -> dict:
-    print(f"RECEIVED SIMULATION REQUEST OF TYPE {sim_type}")
-
-    # reproject buildings to metric system for internal use
-    simulation_input["buildings"] = reproject_geojson(
-        simulation_input["buildings"],
-        "EPSG:4326",
-        "EPSG:25832"
+def task__compute_delta(delta: dict, base_job_id: str, job_id: str) -> str:
+    print(f"RECEIVED DELTA TO JOB {base_job_id} FOR JOB {job_id}")
+
+    prepare_job(job_id, lambda: dispatch_delta_simulation_tasks(delta, base_job_id, job_id))
+
+    return job_id
+
+
+def prepare_job(job_id: str, dispatch: Callable[[], None]):
+    try:
+        dispatch()
+    except Exception as e:
+        logger.error(f"preparing job {job_id} failed with exception {e}")
+        update_job_info(job_id, phase=JobPhase.FAILED.value, error=str(e))
+        raise
+    else:
+        update_job_info(job_id, phase=JobPhase.DISPATCHED.value)
+
+
+def dispatch_simulation_tasks(simulation_input: dict, sim_type: SimType, job_id: str):
+    # buildings keep their id in later delta jobs
+    simulation_input["buildings"] = assign_building_ids(simulation_input["buildings"])
+    store_job_input(job_id, simulation_input, sim_type)
+
+    # reproject buildings to metric system for internal use, they are passed on encoded instead of as geojson
+    simulation_input["buildings"] = encode_buildings(to_metric_gdf(simulation_input["buildings"]))
+
+    # split request in several tiles with a simulation area of max 500m*500m, each tile is prepared in its own task
+    tile_defs = create_tile_definitions(simulation_input)
+    logger.info(f"This simulation is split into {len(tile_defs)} subtasks")
+
+    dispatch_tile_tasks(
+        job_id,
+        [simulation_chain(tile_def, sim_type, job_id, tile_index) for tile_index, tile_def in enumerate(tile_defs)],
+        [get_simulation_area_bounds(tile_def) for tile_def in tile_defs]
     )
 
-    # split request in several simulation tasks with a simulation area of max 500m*500m
-    simulation_tasks = create_simulation_tasks(simulation_input, sim_type)
-    logger.info(f"This simulation is split into {len(simulation_tasks)} subtasks")
-    all_project_uuids = get_all_cut_prototype_projects_uuids()
+
+def dispatch_delta_simulation_tasks(delta: dict, base_job_id: str, job_id: str):
+    base_job_input = get_job_input(base_job_id)
+    base_tiles = (get_job_info(base_job_id) or {}).get("tiles")
+    if not base_job_input or base_tiles is None:
+        raise ValueError(f"base job {base_job_id} is unknown or not dispatched yet")
+
+    sim_type = base_job_input["sim_type"]
+    buildings, replaced_buildings, new_buildings = apply_building_delta(
+        base_job_input["simulation_input"]["buildings"], delta, added_id_prefix=f"{job_id}:"
+    )
+    simulation_input = {**base_job_input["simulation_input"], "buildings": buildings}
+    store_job_input(job_id, simulation_input, sim_type)
+
+    # reproject buildings to metric system for internal use, they are passed on encoded instead of as geojson
+    simulation_input["buildings"] = encode_buildings(to_metric_gdf(buildings))
+    new_buildings_gdf = to_metric_gdf(new_buildings)
+    changed_buildings_gdf = gpd.GeoDataFrame(
+        geometry=[*to_metric_gdf(replaced_buildings).geometry, *new_buildings_gdf.geometry],
+        crs="EPSG:25832"
+    )
+
+    tile_tasks = []
+    tiles = []
+    bbox_matrix = []
+    base_tile_keys = get_tile_keys(base_job_id)
+    for base_tile_index, affected in enumerate(find_affected_bboxes(base_tiles, changed_buildings_gdf)):
+        celery_key = base_tile_keys.get(base_tile_index)
+        if not affected and celery_key and cache.exists(key=get_result_grid_cache_key(celery_key)):
+            tile_info = {"bounds": base_tiles[base_tile_index], "celery_key": celery_key}
+            tile_tasks.append(task__load_cached_tile_result.s(tile_info=tile_info, job_id=job_id))
+            store_tile_key(job_id, len(tiles), celery_key)
+            tiles.append(tile_info["bounds"])
+        else:
+            bbox_matrix.append(gpd.GeoDataFrame(geometry=[box(*base_tiles[base_tile_index])], crs="EPSG:25832"))
+
+    # new buildings outside of the base job's tiles need new tiles
+    bbox_matrix += create_bbox_matrix_for_uncovered(new_buildings_gdf, base_tiles)
+
+    tile_defs = create_tile_definitions(simulation_input, bbox_matrix=bbox_matrix)
+    logger.info(f"{len(tile_defs)} of {len(tiles) + len(tile_defs)} tiles are simulated again")
+
+    for tile_def in tile_defs:
+        tile_tasks.append(simulation_chain(tile_def, sim_type, job_id, tile_index=len(tiles)))
+        tiles.append(get_simulation_area_bounds(tile_def))
+
+    dispatch_tile_tasks(job_id, tile_tasks, tiles)
+
+
+def dispatch_tile_tasks(job_id: str, tile_tasks: List[Signature], tiles: List[Tuple[float, ...]]):
+    """
+    Runs the tasks of all tiles as group with the job id as group id
+    and unifies their results once all finished.
+    The bounds of the tiles are kept with the job, so the job can be the base of a delta job.
+    """
+    update_job_info(job_id, tiles=tiles)
 
     # trigger calculation and collect result for project in infrared_projects
-    task_group = group(
-        [
-            # create task for each bbox.
-            task__do_simulation.s(
-                project_uuid=find_idle_infrared_project(all_project_uuids),
-                sim_task=jsonable_encoder(simulation_task)
-            )
-            for simulation_task in simulation_tasks
-        ]
+    task_group = chord(tile_tasks, task_id=job_id)
+
+    # unify the results once all simulation tasks finished
+    unify_result = task_group(task__unify_job_result.s(job_id=job_id), task_id=uuid())
+    unify_result.parent.save()
+
+
+def simulation_chain(tile_def: dict, sim_type: SimType, job_id: str = None, tile_index: int = None) -> chain:
+    """
+    A tile is simulated in 3 stages on separate queues, so their workers can be sized independently:
+    preparing its buildings (CPU-bound), running the simulation at infrared (waiting on remote I/O)
+    and formatting its result (CPU-bound).
+    Tiles are prepared in parallel, the first tiles run at infrared while others are still being prepared.
+    """
+    return chain(
+        task__prepare_simulation_task.s(tile_def=tile_def, sim_type=sim_type, job_id=job_id, tile_index=tile_index),
+        task__run_simulation.s(job_id=job_id),
+        task__format_simulation_result.s()
     )
 
-    group_result = task_group()
-    group_result.save()
 
-    return group_result.id
+@celery_app.task()
+def task__prepare_simulation_task(
+        tile_def: dict,
+        sim_type: SimType,
+        job_id: str = None,
+        tile_index: int = None
+) -> dict:
+    """
+    CPU stage: Clips and simplifies the buildings of a tile. Returns the simulation task of the tile.
+    The cache key of the tile is kept with the job.
+    """
+    timings = {}
+    with timed(timings, "prepare_tile"):
+        simulation_task = create_simulation_task(tile_def, sim_type)
+    log_timings("prepare_simulation_task", timings)
+
+    if job_id is not None:
+        store_tile_key(job_id, tile_index, simulation_task.celery_key)
+
+    return jsonable_encoder(simulation_task)
 
 
 # trigger calculation for an infrared project
-@celery_app.task()
-def task__do_simulation(project_uuid: str, sim_task: dict) -> dict:
+@celery_app.task(bind=True, max_retries=10)
+def task__run_simulation(self, sim_task: dict, job_id: str = None) -> dict:
     """
-    Doing a simulation for a 500*500meters simulation area.
+    I/O stage: Runs the simulation for a 500*500meters simulation area at infrared.
+    An infrared project is only leased while the simulation runs at infrared.
+    Returns the raw result or the cached result grid, if a tile with the same buildings was simulated before.
+    Cache hits and misses are counted for the job.
     """
+    timings = {}
+    grid_cache_key = get_result_grid_cache_key(sim_task["celery_key"])
 
     # RETURN FROM CACHE IF POSSIBLE
-    if result := cache.get(key=sim_task["celery_key"]):
+    with timed(timings, "cache_lookup"):
+        cached_grid = cache.get_bytes(key=grid_cache_key)
+
+    # retries of the task do not count again
+    if job_id and not self.request.retries:
+        record_tile_cache_lookup(job_id, hit=bool(cached_grid))
+
+    if cached_grid:
         logger.info(
-            f"Result fetched from cache with key: {sim_task['celery_key']}"
+            f"Result fetched from cache with key: {grid_cache_key}"
         )
 
-        return result
+        return {
+            **encode_result_grid(move_cached_result(cached_grid, get_simulation_area_bounds(sim_task))),
+            "timings": {"run_simulation": log_timings("run_simulation", timings)}
+        }
+
+    with timed(timings, "prepare_buildings"):
+        tile_buildings = prepare_buildings(sim_task["buildings"], sim_task["simulation_area"])
+
+    try:
+        with timed(timings, "project_lease"):
+            # prefer a project that has most of the buildings loaded already (and sun activated for sun tiles)
+            project_uuid, lease_token = lease_idle_infrared_project(
+                building_hashes=list(tile_buildings),
+                capability=ProjectCapability.SUNLIGHT_HOURS.value if sim_task["sim_type"] == "sun" else None
+            )
+    except NoIdleProjectException as e:
+        # all projects busy for a long time, try again later
+        raise self.retry(exc=e, countdown=settings.infrared_communication.project_lease_wait_seconds)
 
     # RUN SIMULATION
     result = {}
+    # the project keeps its buildings for the next simulation, it only needs a cleanup if something failed
+    project_status = ProjectStatus.TO_BE_CLEANED
     try:
         logger.info(
-            f"Starting calculation ...  Result with key: {sim_task['celery_key']} not found in cache."
+            f"Starting calculation ...  Result with key: {grid_cache_key} not found in cache."
         )
-        result = do_simulation(
+        with timed(timings, "infrared"):
+            result["result_raw"] = run_simulation(
+                project_uuid=project_uuid,
+                sim_task=sim_task,
+                tile_buildings=tile_buildings,
+                renew_lease=lambda: renew_project_lease(project_uuid, lease_token)
+            )
+        # the format stage needs the simulation task to crop the result
+        result["sim_task"] = sim_task
+        project_status = ProjectStatus.IDLE
+    except BuildingsNotLoadedException as e:
+        # never simulate (and cache) the wrong buildings, try again once the project is cleaned up
+        logger.warning(f"buildings of sim_task {sim_task['celery_key']} not loaded: {e}")
+        raise self.retry(exc=e)
+    except LeaseLostException as e:
+        # the project is cleaned up by the reconciler meanwhile, try again with another project
+        logger.warning(f"sim_task {sim_task['celery_key']} lost its project: {e}")
+        raise self.retry(exc=e)
+    except Exception as e:
+        logger.error(
+            f"simulation for  sim_task {sim_task} failed with exception {e}"
+        )
+    finally:
+        # release project, no need to hold it while processing the result. A lost project is left alone.
+        lease_held = update_infrared_project_status_in_redis(
             project_uuid=project_uuid,
-            sim_task=sim_task
+            status=project_status.value,
+            lease_token=lease_token
         )
+        if lease_held and project_status == ProjectStatus.TO_BE_CLEANED:
+            enqueue_cleanup(project_uuid, lease_token, marked_at=time.time())
+
+    return {**result, "timings": {"run_simulation": log_timings("run_simulation", timings)}}
+
+
+@celery_app.task()
+def task__format_simulation_result(simulation_output: dict) -> dict:
+    """
+    CPU stage: Crops the raw result of a simulation to a result grid and caches it.
+    Returns the cropped result grid, encoded to be json serializable.
+    """
+    # cached grid or failed simulation, nothing to process
+    if "result_raw" not in simulation_output:
+        return simulation_output
+
+    sim_task = simulation_output["sim_task"]
+    timings = {}
+    result = {}
+    try:
+        with timed(timings, "format"):
+            result_grid = format_result(simulation_output["result_raw"], sim_task)
     except Exception as e:
         logger.error(
-            f"simulation for  sim_task {sim_task} failed with exception {e}"
+            f"formatting result of sim_task {sim_task} failed with exception {e}"
         )
     else:
         # cache valid results
-        if result and result.get("features", []):
-            cache.put(key=sim_task.get("celery_key"), value=result)
-            logger.info(f"Saved or renewed result with key {sim_task.get('celery_key')} to cache.")
+        if result_grid.grid.size:
+            grid_cache_key = get_result_grid_cache_key(sim_task["celery_key"])
+            with timed(timings, "cache_store"):
+                result_grid_bytes = result_grid.to_bytes()
+                cache.put_bytes(key=grid_cache_key, value=result_grid_bytes)
+            logger.info(f"Saved or renewed result with key {grid_cache_key} to cache.")
+            result = encode_result_grid(result_grid_bytes)
+
+    return {
+        **result,
+        "timings": {
+            **simulation_output["timings"],
+            "format_simulation_result": log_timings("format_simulation_result", timings)
+        }
+    }
+
+
+@celery_app.task()
+def task__load_cached_tile_result(tile_info: dict, job_id: str) -> dict:
+    """
+    Result of a tile of a delta job, which is not affected by the delta. Taken from the base job's cached result.
+    """
+    cached_grid = cache.get_bytes(key=get_result_grid_cache_key(tile_info["celery_key"]))
+    record_tile_cache_lookup(job_id, hit=bool(cached_grid))
+
+    if not cached_grid:
+        # expired since the job was dispatched
+        logger.error(f"cached result of tile {tile_info} not found")
+        return {}
+
+    return encode_result_grid(move_cached_result(cached_grid, tile_info["bounds"]))
+
+
+@celery_app.task()
+def task__unify_job_result(tile_results: List[dict], job_id: str) -> str:
+    """
+    Mosaics the results of all tiles of a job once the group finished
+    and stores the final result under the job id.
+    """
+    store_job_result(job_id, unify_tile_results(tile_results))
+    logger.info(f"Stored unified result for job {job_id}")
+
+    return job_id
+
+
+def renew_project_lease(project_uuid: str, lease_token: str):
+    if not project_pool.renew_lease(project_uuid, lease_token):
+        raise LeaseLostException(f"lease of project {project_uuid} expired and was reclaimed")
+
+
+def enqueue_cleanup(project_uuid: str, lease_token: str, marked_at: float = None) -> bool:
+    """
+    Enqueues the cleanup of a project leased for its cleanup, unless a cleanup of the project is pending already.
+    Returns whether the cleanup was enqueued.
+    """
+    if not project_pool.try_lock(
+            get_cleanup_lock_name(project_uuid), seconds=settings.infrared_communication.cleanup_pending_seconds
+    ):
+        return False
+
+    task__cleanup_project.delay(project_uuid=project_uuid, lease_token=lease_token, marked_at=marked_at)
+
+    return True
+
+
+@celery_app.task()
+def task__cleanup_project(project_uuid: str, lease_token: str, marked_at: float = None):
+    """
+    Cleans up a project right after a failed simulation, on its own queue.
+    The project stays leased until it is clean, so it is neither used nor cleaned up by the reconciler meanwhile.
+    The lease is renewed when the cleanup starts, it may have waited in the queue for a while.
+    If the lease expired and was reclaimed meanwhile, the project is cleaned up under its new lease instead.
+    """
+    start_time = time.time()
+    try:
+        if not project_pool.renew_lease(project_uuid, lease_token):
+            logger.warning(f"lease of project {project_uuid} expired before its cleanup, skipping the cleanup")
+            return
+        cleanup_project(project_uuid, lease_token)
+    finally:
+        project_pool.unlock(get_cleanup_lock_name(project_uuid))
+
+    metrics.observe("project_cleanup_seconds", time.time() - start_time)
+    if marked_at:
+        # time the project was out of the pool
+        metrics.observe("project_cleanup_turnaround_seconds", time.time() - marked_at)
+
+
+@celery_app.task()
+def task__autoscale_project_pool() -> int:
+    """
+    Scheduled by celery beat: scales the project pool with the tiles waiting for a project,
+    then tops up the projects with activated sunlight hours service.
+    Creating projects can take longer than the schedule interval, overlapping runs are skipped.
+    """
+    if not project_pool.try_lock("autoscale", seconds=settings.infrared_communication.project_lease_seconds):
+        return 0
+
+    try:
+        pool_size_change = autoscale_project_pool(pending_tiles=count_pending_tile_tasks())
+        preactivate_sun_projects()
+
+        return pool_size_change
     finally:
-        # mark project as completed
-        update_infrared_project_status_in_redis(project_uuid=project_uuid, status=ProjectStatus.TO_BE_CLEANED.value)
+        project_pool.unlock("autoscale")
+
+
+def count_pending_tile_tasks() -> int:
+    # tile simulations waiting in the broker for an io worker
+    with celery_app.connection_for_read() as connection:
+        return connection.default_channel.client.llen(settings.broker.io_queue)
+
+
+def get_cleanup_lock_name(project_uuid: str) -> str:
+    return f"cleanup:{project_uuid}"
+
+
+def get_result_grid_cache_key(celery_key: str) -> str:
+    return f"{celery_key}_grid"
+
+
+def to_metric_gdf(buildings: dict) -> gpd.GeoDataFrame:
+    return reproject_gdf(gpd.GeoDataFrame.from_features(buildings["features"], crs="EPSG:4326"), "EPSG:25832")
+
+
+@contextmanager
+def timed(timings: dict, step: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[step] = round(time.perf_counter() - start, 3)
+
+
+def log_timings(stage: str, timings: dict) -> dict:
+    logger.info(f"{stage} timings in seconds: {timings}")
 
-        return result
+    return timings
@@ -0,0 +1,19 @@
+import pytest
+
+
+def pytest_addoption(parser):
+    parser.addoption("--benchmark", action="store_true", default=False, help="run the wall-clock benchmarks")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: wall-clock benchmark, only run with --benchmark")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+
+    skip_benchmark = pytest.mark.skip(reason="benchmark, run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip_benchmark)
@@ -1,7 +1,10 @@
 import json
 import os
+
+import numpy as np
 import pytest
 
+from infrared_wrapper_api.config import settings
 from infrared_wrapper_api.infrared_wrapper.infrared.utils import reproject_geojson
 
 
@@ -15,9 +18,25 @@ def sample_simulation_area():
 
 @pytest.fixture
 def sample_simulation_result_raw():
-    print(os.getcwd())
-    with open("../infrared_wrapper_api/models/jsons/infrared_result_raw.json", "r") as f:
-        return json.load(f)
+    """
+    Synthetic raw infrared result: a value per grid point (one more than cells per side),
+    blocks of 5*5 cells share a value of 0, 0.2, .. 1.0 - like the discrete values of infrared.
+    """
+    size = settings.infrared_calculation.infrared_sim_area_size
+    points = size // settings.infrared_calculation.analysis_resolution + 1
+
+    block_values = np.random.default_rng(0).integers(0, 6, size=(points // 5 + 1, points // 5 + 1))
+    data = np.round(np.kron(block_values, np.ones((5, 5)))[:points, :points] * 0.2, 1)
+
+    return {
+        "analysisOutputN": size,
+        "analysisOutputE": size,
+        "analysisOutputS": 0,
+        "analysisOutputW": 0,
+        "analysisOutputX": points,
+        "analysisOutputY": points,
+        "analysisOutputData": data.tolist(),
+    }
 
 
 @pytest.fixture
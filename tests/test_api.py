@@ -1,10 +1,19 @@
 import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import fakeredis
+import numpy as np
 import pytest
 from fastapi.testclient import TestClient
 from unittest.mock import patch
 
 from infrared_wrapper_api.api.main import app
+from infrared_wrapper_api.api.utils import get_job_result_key, store_job_result, record_tile_cache_lookup
+from infrared_wrapper_api.infrared_wrapper.infrared.result_grid import ResultGrid
+from infrared_wrapper_api.metrics import Metrics
+from infrared_wrapper_api.tasks import task__unify_job_result
 from typing import List
 from tests.fixtures import sample_building_data_single_bbox, sample_simulation_input, ogc_desc_wind
 
@@ -39,6 +48,45 @@ class MockGroupResult:
         return "not implemented"
 
 
+class MockCache:
+    """in-memory stand-in for the redis cache"""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, *, key: str):
+        return self.values.get(key)
+
+    def put(self, *, key: str, value):
+        self.values[key] = value
+
+    def exists(self, *, key: str) -> bool:
+        return key in self.values
+
+    def put_bytes(self, *, key: str, value: bytes):
+        self.values[key] = value
+
+    def iter_bytes(self, *, key: str, chunk_size: int = 16):
+        value = self.values[key]
+        for start in range(0, len(value), chunk_size):
+            yield value[start:start + chunk_size]
+
+    def increment(self, *, key: str, field: str, amount: int = 1):
+        counts = self.values.setdefault(key, {})
+        counts[field] = counts.get(field, 0) + amount
+
+    def get_counts(self, *, key: str) -> dict:
+        return self.values.get(key, {})
+
+
+@pytest.fixture
+def mock_cache():
+    mock_cache = MockCache()
+    with patch("infrared_wrapper_api.api.endpoints.cache", mock_cache), \
+            patch("infrared_wrapper_api.api.utils.cache", mock_cache):
+        yield mock_cache
+
+
 @pytest.fixture
 def mock_result_not_ready():
     empty_mock_result = MockResult()
@@ -47,41 +95,13 @@ def mock_result_not_ready():
 
 @pytest.fixture
 def mock_result_ready():
-    mock_result_content = {"features": [
-        {
-            "type": "Feature",
-            "properties": {
-                "value": 1
-            },
-            "geometry": {
-                "coordinates": [
-                    [
-                        [
-                            9.991281970821717,
-                            53.508316561546536
-                        ],
-                        [
-                            9.989940009272715,
-                            53.50746527543134
-                        ],
-                        [
-                            9.99083465030509,
-                            53.50688000630859
-                        ],
-                        [
-                            9.993697501609802,
-                            53.50794412597509
-                        ],
-                        [
-                            9.991281970821717,
-                            53.508316561546536
-                        ]
-                    ]
-                ],
-                "type": "Polygon"
-            }
-        }
-    ]}
+    # cropped result grid of a single tile (EPSG:25832) with a single value
+    mock_result_content = ResultGrid(
+        grid=np.full((40, 40), 1.0),
+        minx=565000,
+        maxy=5930400,
+        resolution=10
+    ).to_dict()
     valid_single_result = MockResult(result=mock_result_content)
 
     return MockGroupResult(is_successful=True, failed=False, results=[valid_single_result])
@@ -95,23 +115,127 @@ def test_process_description(ogc_desc_wind):
     assert ogc_desc_wind == response.json()
 
 
-def test_wind(sample_simulation_input):
+def test_wind(sample_simulation_input, mock_cache):
     with patch("infrared_wrapper_api.tasks.task__compute", return_value={"foo": "bar"}) as mock_task:
         response = client.post("/infrared/processes/wind-comfort/execution", json=sample_simulation_input)
 
         assert response.status_code == 201
         print(response.json())
 
+        # job id is generated by the api, tiling and dispatching is left to the worker
+        job_id = response.json()["jobID"]
+        mock_task.apply_async.assert_called_once()
+        assert mock_task.apply_async.call_args.kwargs["kwargs"]["job_id"] == job_id
+        assert response.headers["Location"] == f"/infrared/jobs/{job_id}"
 
-def test_sun(sample_simulation_input):
+
+def test_sun(sample_simulation_input, mock_cache):
     with patch("infrared_wrapper_api.tasks.task__compute", return_value={"foo": "bar"}) as mock_task:
         response = client.post("/infrared/processes/sunlight-hours/execution", json=sample_simulation_input)
 
         assert response.status_code == 201
         print(response.json())
+        assert mock_task.apply_async.call_args.kwargs["kwargs"]["sim_type"] == "sun"
+
+
+def test_job_status_preparing(sample_simulation_input, mock_cache):
+    with patch("infrared_wrapper_api.tasks.task__compute"):
+        job_id = client.post("/infrared/processes/wind-comfort/execution", json=sample_simulation_input).json()["jobID"]
+
+    # the group of simulation tasks does not exist yet
+    with patch("celery.result.GroupResult.restore", return_value=None):
+        response = client.get(f"/infrared/jobs/{job_id}")
+
+        assert response.status_code == 200
+        assert response.json()["status"] == "accepted"
+        assert response.json()["phase"] == "preparing"
+
+        response = client.get(f"/infrared/jobs/{job_id}/results")
+        assert response.status_code == 404
+        assert json.loads(response.text).get("detail") == "result not ready"
+
+
+@pytest.mark.benchmark
+def test_submission_latency_under_concurrency(sample_simulation_input, mock_cache):
+    """
+    Load test: submissions must not wait for the worker preparing the job.
+    Latency should stay flat with increasing numbers of concurrent clients.
+    """
+    worker_time = 1.0
+
+    class SlowAsyncResult:
+        def get(self):
+            # the worker would need this long to tile and dispatch the job
+            time.sleep(worker_time)
+            return "job-id"
+
+    def submit(test_client: TestClient) -> float:
+        start_time = time.time()
+        response = test_client.post("/infrared/processes/wind-comfort/execution", json=sample_simulation_input)
+        assert response.status_code == 201
+        return time.time() - start_time
+
+    median_latencies = {}
+    with patch("infrared_wrapper_api.tasks.task__compute") as mock_task, TestClient(app) as test_client:
+        mock_task.delay.return_value = SlowAsyncResult()
+        mock_task.apply_async.return_value = SlowAsyncResult()
+
+        for concurrent_clients in [1, 5, 20]:
+            with ThreadPoolExecutor(max_workers=concurrent_clients) as executor:
+                latencies = list(executor.map(lambda _: submit(test_client), range(concurrent_clients * 2)))
+            median_latencies[concurrent_clients] = statistics.median(latencies)
+
+    print("median submission latency by concurrent clients", median_latencies)
+
+    assert all(latency < worker_time for latency in median_latencies.values())
+    assert median_latencies[20] < median_latencies[1] + worker_time / 2
+
+
+def test_delta(sample_simulation_input, mock_cache):
+    with patch("infrared_wrapper_api.tasks.task__compute"):
+        base_job_id = client.post(
+            "/infrared/processes/wind-comfort/execution", json=sample_simulation_input
+        ).json()["jobID"]
+
+    with patch("infrared_wrapper_api.tasks.task__compute_delta") as mock_task:
+        response = client.post(f"/infrared/jobs/{base_job_id}/delta", json={"removed": [0]})
+
+        assert response.status_code == 201
+        job_id = response.json()["jobID"]
+        assert job_id != base_job_id
+        assert response.headers["Location"] == f"/infrared/jobs/{job_id}"
+        assert mock_task.apply_async.call_args.kwargs["kwargs"] == {
+            "delta": {"added": None, "modified": None, "removed": [0]},
+            "base_job_id": base_job_id,
+            "job_id": job_id
+        }
+
+    with patch("celery.result.GroupResult.restore", return_value=None):
+        response = client.get(f"/infrared/jobs/{job_id}")
+
+        assert response.json()["phase"] == "preparing"
+
+
+def test_delta_modified_buildings_need_ids(mock_cache):
+    modified = {"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {}, "geometry": None}]}
+
+    with patch("infrared_wrapper_api.tasks.task__compute_delta") as mock_task:
+        response = client.post("/infrared/jobs/abc123/delta", json={"modified": modified})
+
+        assert response.status_code == 422
+        assert "modified buildings need the id" in response.text
+        mock_task.apply_async.assert_not_called()
+
 
+def test_delta_invalid_base_job_id(mock_cache):
+    with patch("infrared_wrapper_api.tasks.task__compute_delta") as mock_task:
+        response = client.post("/infrared/jobs/abc123/delta", json={"removed": [0]})
 
-def test_job_status_invalid_job_id():
+        assert response.status_code == 404
+        mock_task.apply_async.assert_not_called()
+
+
+def test_job_status_invalid_job_id(mock_cache):
     # Test invalid group task id
     with patch("celery.result.GroupResult.restore", return_value=None) as mock_restore:
         response = client.get("/infrared/jobs/abc123")
@@ -120,16 +244,29 @@ def test_job_status_invalid_job_id():
         assert json.loads(response.text).get("detail") == "no such job"
 
 
-def test_job_status_valid_job_id(mock_result_ready):
+def test_job_status_valid_job_id(mock_result_ready, mock_cache):
     # Test invalid group task id
     with patch("celery.result.GroupResult.restore", return_value=mock_result_ready) as mock_restore:
         response = client.get("/infrared/jobs/abc123")
 
         assert response.status_code == 200
-        assert response.json() == {'jobID': 'abc123', 'progress': 100, 'status': 'successful', 'type': 'process'}
+        assert response.json() == {
+            'jobID': 'abc123', 'progress': 100, 'status': 'successful', 'type': 'process', 'cache_hit_ratio': None
+        }
+
+
+def test_job_status_cache_hit_ratio(mock_result_ready, mock_cache):
+    with patch("infrared_wrapper_api.api.utils.metrics"):
+        for hit in [True, True, False, True]:
+            record_tile_cache_lookup("abc123", hit=hit)
+
+    with patch("celery.result.GroupResult.restore", return_value=mock_result_ready):
+        response = client.get("/infrared/jobs/abc123")
+
+        assert response.json()["cache_hit_ratio"] == 0.75
 
 
-def test_get_result_invalid_id():
+def test_get_result_invalid_id(mock_cache):
     # Test invalid group task id
     with patch("celery.result.GroupResult.restore", return_value=None) as mock_restore:
         response = client.get("/infrared/jobs/abc123/results")
@@ -137,7 +274,7 @@ def test_get_result_invalid_id():
         assert response.status_code == 404
 
 
-def test_get_result_not_ready(mock_result_not_ready):
+def test_get_result_not_ready(mock_result_not_ready, mock_cache):
     # test result not ready
     with patch("celery.result.GroupResult.restore", return_value=mock_result_not_ready) as mock_restore:
         response = client.get("/infrared/jobs/abc123/results")
@@ -146,13 +283,48 @@ def test_get_result_not_ready(mock_result_not_ready):
         assert json.loads(response.text).get("detail") == "result not ready"
 
 
-def test_get_result_ready(mock_result_ready):
-    # test result ready
-    with patch("celery.result.GroupResult.restore", return_value=mock_result_ready) as mock_restore:
+def test_get_result_ready(mock_result_ready, mock_cache):
+    # the tiles are done, the result is not ready until the chord callback stored it unified
+    with patch("celery.result.GroupResult.restore", return_value=mock_result_ready):
         response = client.get("/infrared/jobs/abc123/results")
 
-        assert response.status_code == 200
+        assert response.status_code == 404
+        assert json.loads(response.text).get("detail") == "result not ready"
+        # polls do not unify the result themselves
+        assert not mock_cache.exists(key=get_job_result_key("abc123"))
+
+    task__unify_job_result([result.get() for result in mock_result_ready.results], job_id="abc123")
 
-        # each MockResult had the same content, dissolves to 1 feature
+    with patch("celery.result.GroupResult.restore", return_value=mock_result_ready):
+        response = client.get("/infrared/jobs/abc123/results")
+
+        assert response.status_code == 200
+        # the single tile has the same value in all cells, polygonizes to 1 feature
         assert len(response.json()["result"]["geojson"]["features"]) == 1
 
+
+def test_get_stored_result(mock_cache):
+    # results of finished jobs are served as stored, without touching the group's results
+    store_job_result("abc123", {"type": "FeatureCollection", "features": []})
+
+    with patch("celery.result.GroupResult.restore") as mock_restore:
+        response = client.get("/infrared/jobs/abc123/results")
+
+        assert response.status_code == 200
+        assert response.json() == {"result": {"geojson": {"type": "FeatureCollection", "features": []}}}
+        mock_restore.assert_not_called()
+
+
+def test_metrics():
+    fake_metrics = Metrics(fakeredis.FakeRedis(decode_responses=True), key_prefix="test")
+    fake_metrics.observe("create_buildings_batch_size", 10)
+    fake_metrics.observe("create_buildings_batch_size", 20)
+    fake_metrics.increment("create_buildings_batch_failures")
+
+    with patch("infrared_wrapper_api.api.main.metrics", fake_metrics):
+        response = client.get("/infrared/metrics")
+
+    assert response.status_code == 200
+    assert response.json()["observations"]["create_buildings_batch_size"]["count"] == 2
+    assert response.json()["observations"]["create_buildings_batch_size"]["mean"] == 15
+    assert response.json()["counters"] == {"create_buildings_batch_failures": 1}
@@ -0,0 +1,155 @@
+import asyncio
+from collections import deque
+from typing import Callable, List
+
+import fakeredis
+import pytest
+
+from infrared_wrapper_api.infrared_wrapper.infrared.batching import AdaptiveBatchSize, send_in_batches_concurrently
+from infrared_wrapper_api.metrics import Metrics
+
+"""
+Tests adaptive batch sizes
+- grow while batches are fast and successful, shrink on errors and slow batches
+- batches are capped by their byte size
+- batch sizes and latencies are recorded as metrics
+- failed mutations are sent again, a bounded number of times
+"""
+
+
+@pytest.fixture
+def fake_metrics():
+    return Metrics(fakeredis.FakeRedis(decode_responses=True), key_prefix="test")
+
+
+def create_batch_size(fake_metrics: Metrics, **kwargs) -> AdaptiveBatchSize:
+    return AdaptiveBatchSize(
+        **{
+            "name": "test",
+            "metrics": fake_metrics,
+            "initial_size": 10,
+            "max_size": 40,
+            "max_bytes": 1000,
+            "increase": 5,
+            "target_seconds": 1,
+            **kwargs
+        }
+    )
+
+
+def send_one_batch_at_a_time(batch_size: AdaptiveBatchSize, mutations: List[str], send: Callable) -> bool:
+    # a single batch in flight, so the batches are taken in a deterministic order
+    async def send_async(batch: List[str]) -> List[str]:
+        return send(batch)
+
+    return asyncio.run(send_in_batches_concurrently(batch_size, mutations, send_async, concurrency=1))
+
+
+def test_batch_size_grows_and_shrinks(fake_metrics):
+    batch_size = create_batch_size(fake_metrics)
+
+    batch_size.record(batch_size=10, seconds=0.1, success=True)
+    assert batch_size.size == 15
+
+    for _ in range(10):
+        batch_size.record(batch_size=batch_size.size, seconds=0.1, success=True)
+    assert batch_size.size == 40
+
+    batch_size.record(batch_size=40, seconds=2, success=True)  # too slow
+    assert batch_size.size == 20
+
+    batch_size.record(batch_size=20, seconds=0.1, success=False)
+    assert batch_size.size == 10
+
+    for _ in range(10):
+        batch_size.record(batch_size=batch_size.size, seconds=0.1, success=False)
+    assert batch_size.size == 1
+
+
+def test_batch_capped_by_bytes(fake_metrics):
+    batch_size = create_batch_size(fake_metrics, max_bytes=250)
+    mutations = deque(["x" * 100] * 5 + ["y" * 500])
+
+    assert batch_size.take_batch(mutations) == ["x" * 100] * 2
+    assert batch_size.take_batch(mutations) == ["x" * 100] * 2
+    assert batch_size.take_batch(mutations) == ["x" * 100]
+    # a single mutation bigger than max_bytes is still sent
+    assert batch_size.take_batch(mutations) == ["y" * 500]
+    assert not mutations
+
+
+def test_fewer_round_trips_for_fast_responses(fake_metrics):
+    batch_size = create_batch_size(fake_metrics)
+    sent_batches = []
+
+    def send(batch):
+        sent_batches.append(batch)
+        return []
+
+    assert send_one_batch_at_a_time(batch_size, [str(i) for i in range(100)], send)
+
+    assert [len(batch) for batch in sent_batches] == [10, 15, 20, 25, 30]
+    assert sum(sent_batches, []) == [str(i) for i in range(100)]
+    assert fake_metrics.observations("test_batch_size") == [30, 25, 20, 15, 10]  # latest first
+    assert fake_metrics.summary("test_batch_seconds")["count"] == 5
+
+
+def test_failed_batch_shrinks_batch_size(fake_metrics):
+    batch_size = create_batch_size(fake_metrics)
+    sent_batches = []
+
+    def send(batch):
+        sent_batches.append(batch)
+        return batch if len(sent_batches) == 2 else []
+
+    assert send_one_batch_at_a_time(batch_size, [str(i) for i in range(50)], send)
+
+    # the failed batch of 15 is sent again in the smaller batches
+    assert [len(batch) for batch in sent_batches] == [10, 15, 7, 12, 17, 4]
+    assert sent_batches[2] + sent_batches[3][:8] == sent_batches[1]
+    assert sorted(sum(sent_batches[:1] + sent_batches[2:], []), key=int) == [str(i) for i in range(50)]
+    assert fake_metrics.counters() == {"test_batch_failures": 1}
+
+
+def test_only_failed_mutations_are_sent_again(fake_metrics):
+    batch_size = create_batch_size(fake_metrics)
+    sent_batches = []
+
+    def send(batch):
+        sent_batches.append(batch)
+        # odd mutations fail once
+        return [mutation for mutation in batch if int(mutation) % 2 and sum(sent_batches, []).count(mutation) == 1]
+
+    assert send_one_batch_at_a_time(batch_size, [str(i) for i in range(10)], send)
+
+    assert sent_batches == [[str(i) for i in range(10)], ["1", "3", "5", "7", "9"]]
+
+
+def test_mutations_failing_repeatedly_are_given_up(fake_metrics):
+    batch_size = create_batch_size(fake_metrics, max_attempts=3)
+    sent_mutations = []
+
+    def send(batch):
+        sent_mutations.extend(batch)
+        return [mutation for mutation in batch if mutation == "broken"]
+
+    assert not send_one_batch_at_a_time(batch_size, ["a", "broken", "b"], send)
+
+    assert sent_mutations.count("broken") == 3
+    assert sent_mutations.count("a") == sent_mutations.count("b") == 1
+    assert fake_metrics.counters()["test_failed_mutations"] == 1
+
+
+def test_concurrent_batches(fake_metrics):
+    batch_size = create_batch_size(fake_metrics)
+    sent_batches = []
+
+    async def send(batch):
+        await asyncio.sleep(0.01)
+        sent_batches.append(batch)
+        return []
+
+    asyncio.run(send_in_batches_concurrently(batch_size, [str(i) for i in range(100)], send, concurrency=3))
+
+    assert sorted(sum(sent_batches, []), key=int) == [str(i) for i in range(100)]
+    assert len(sent_batches) < 10
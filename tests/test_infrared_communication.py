@@ -1,7 +1,9 @@
+import time
+
 from infrared_wrapper_api.infrared_wrapper.infrared.infrared_connector import get_all_building_uuids_for_project, \
-    InfraredConnector, trigger_wind_simulation, get_analysis_output, \
-    trigger_sun_simulation, activate_sunlight_analysis_capability
+    InfraredConnector, trigger_wind_simulation, trigger_sun_simulation, activate_sunlight_analysis_capability
 from infrared_wrapper_api.infrared_wrapper.infrared.infrared_project import InfraredProject
+from infrared_wrapper_api.infrared_wrapper.infrared.polling import wait_for_analysis_output
 
 
 from infrared_wrapper_api.infrared_wrapper.infrared.utils import reproject_geojson
@@ -46,6 +48,7 @@ def test_update_and_delete_buildings_at_infrared(sample_building_data_single_bbo
         assert len(get_all_building_uuids_for_project(project.project_uuid, project.snapshot_uuid)) == building_count
 
         # Run wind simulation
+        triggered_at = time.monotonic()
         result_uuid = trigger_wind_simulation(
             snapshot_uuid=project.snapshot_uuid,
             wind_direction=45,
@@ -54,7 +57,10 @@ def test_update_and_delete_buildings_at_infrared(sample_building_data_single_bbo
         assert result_uuid is not None
 
         # and fetch result
-        result = get_analysis_output(project.project_uuid, project.snapshot_uuid, result_uuid)
+        result = wait_for_analysis_output(
+            project.project_uuid, project.snapshot_uuid, result_uuid,
+            sim_type="wind", building_count=building_count, triggered_at=triggered_at
+        )
 
         # check result looks like expected
         assert result is not None
@@ -83,12 +89,16 @@ def test_sun_sim():
     project = InfraredProject(project_uuid)
     # Run sun simulation
     activate_sunlight_analysis_capability(project_uuid)
+    triggered_at = time.monotonic()
     result_uuid = trigger_sun_simulation(
         snapshot_uuid=project.snapshot_uuid
     )
     assert result_uuid is not None
     # and fetch result
-    result = get_analysis_output(project.project_uuid, project.snapshot_uuid, result_uuid)
+    result = wait_for_analysis_output(
+        project.project_uuid, project.snapshot_uuid, result_uuid,
+        sim_type="sun", building_count=0, triggered_at=triggered_at  # buildings of the idle project are not counted
+    )
 
     # check result looks like expected
     assert result is not None
@@ -0,0 +1,378 @@
+import asyncio
+import json
+import re
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fakeredis
+import geopandas as gpd
+import pytest
+import requests
+from shapely.geometry import box
+from unittest.mock import patch, Mock
+
+from infrared_wrapper_api.config import settings
+from infrared_wrapper_api.infrared_wrapper.infrared.async_infrared_connector import AsyncInfraredConnector
+from infrared_wrapper_api.infrared_wrapper.infrared.batching import AdaptiveBatchSize
+from infrared_wrapper_api.infrared_wrapper.infrared.infrared_connector import InfraredConnector
+from infrared_wrapper_api.infrared_wrapper.infrared.infrared_project import InfraredProject, prepare_buildings, \
+    BuildingsNotLoadedException
+from infrared_wrapper_api.project_registry import ProjectRegistry
+from tests.fixtures import sample_simulation_area
+
+"""
+Tests the connector against a local stand-in for the infrared GraphQL api
+- queries reuse kept-alive connections
+- an expired login is refreshed once, also if many threads notice it at the same time
+- building batches are uploaded concurrently, but not more than max_concurrent_queries at a time
+- only the delta to the buildings loaded in a project is sent
+- a project that does not get exactly the tile's buildings is not simulated
+- the snapshot of a project is only looked up once
+- cleanup deletes the recorded buildings without listing them at infrared
+"""
+
+SUCCESS = {"data": {"query": {"success": True}}}
+
+
+class StandInInfrared(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.connections = 0
+        self.logins = 0
+        self.valid_token = "token_0"
+        self.lock = threading.Lock()
+        self.query_delay = 0
+        self.queries = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.building_count = 0
+        self.failing_mutation = None  # e.g. "deleteBuilding", these mutations do not succeed
+
+    def expire_token(self):
+        with self.lock:
+            self.valid_token = f"token_{self.logins + 1}"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True  # like real servers, otherwise kept-alive responses wait for delayed ACKs
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+
+        if self.path == "/":
+            with self.server.lock:
+                self.server.logins += 1
+                self.server.valid_token = f"token_{self.server.logins}"
+                token = self.server.valid_token
+            self.respond(200, {}, cookies={"InFraReDClientUuid": "user", "InFraReD": token})
+        elif self.headers["Cookie"] != f"InFraReD={self.server.valid_token}":
+            self.respond(401, {})
+        else:
+            self.respond(200, self.answer_query(json.loads(body)["query"]))
+
+    def answer_query(self, query: str) -> dict:
+        with self.server.lock:
+            self.server.queries.append(query)
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+
+        time.sleep(self.server.query_delay)
+
+        with self.server.lock:
+            self.server.in_flight -= 1
+
+        if "getSnapshotsByProjectUuid" in query:
+            snapshots = {"projectName": "CUT_project", "snapshots": {"snapshot": {}}}
+            return {
+                "data": {
+                    "getSnapshotsByProjectUuid": {
+                        "infraredSchema": {"clients": {"user": {"projects": {"project": snapshots}}}}
+                    }
+                }
+            }
+
+        if mutations := re.findall(r"(\w+): (createNewBuilding|deleteBuilding)", query):
+            with self.server.lock:
+                self.server.building_count += len(mutations)
+                first_uuid = self.server.building_count
+            return {
+                "data": {
+                    alias: {
+                        "success": mutation != self.server.failing_mutation,
+                        "uuid": f"building_{first_uuid + count}"
+                    }
+                    for count, (alias, mutation) in enumerate(mutations)
+                }
+            }
+
+        return {"data": {"query": {"success": True}}}
+
+    def respond(self, status: int, body: dict, cookies: dict = None):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (cookies or {}).items():
+            self.send_header("Set-Cookie", f"{name}={value}")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in_infrared():
+    server = StandInInfrared()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_queries_reuse_connection(stand_in_infrared):
+    connector = InfraredConnector(url=stand_in_infrared.url)
+
+    for _ in range(20):
+        assert connector.execute_query("query") == SUCCESS
+
+    # login and all queries over one kept-alive connection
+    assert stand_in_infrared.connections == 1
+
+
+def test_expired_login_is_refreshed_once(stand_in_infrared):
+    connector = InfraredConnector(url=stand_in_infrared.url)
+    stand_in_infrared.expire_token()
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        responses = list(executor.map(lambda _: connector.execute_query("query"), range(10)))
+
+    assert all(response == SUCCESS for response in responses)
+    assert stand_in_infrared.logins == 2
+    assert connector.token == f"InFraReD={stand_in_infrared.valid_token}"
+
+
+def test_query_latency_with_pooled_session(stand_in_infrared):
+    connector = InfraredConnector(url=stand_in_infrared.url)
+    headers = {"Cookie": connector.token}
+
+    def query_latency(post) -> float:
+        start_time = time.perf_counter()
+        post(f"{stand_in_infrared.url}/api", json={"query": "query"}, headers=headers)
+        return time.perf_counter() - start_time
+
+    # a new connection per query (as before) vs. kept-alive connections of the session
+    unpooled = statistics.median(query_latency(requests.post) for _ in range(50))
+    pooled = statistics.median(query_latency(connector.session.post) for _ in range(50))
+
+    print(f"median query latency: unpooled {unpooled * 1000:.2f}ms, pooled {pooled * 1000:.2f}ms")
+    assert stand_in_infrared.connections == 51
+
+
+def test_async_queries_are_bounded(stand_in_infrared):
+    stand_in_infrared.query_delay = 0.05
+    connector = InfraredConnector(url=stand_in_infrared.url)
+
+    async def run_queries():
+        async with AsyncInfraredConnector(connector, max_concurrent_queries=3) as async_connector:
+            return await asyncio.gather(*[async_connector.execute_query("query") for _ in range(12)])
+
+    assert asyncio.run(run_queries()) == [SUCCESS] * 12
+    assert stand_in_infrared.max_in_flight == 3
+
+
+def test_async_queries_refresh_expired_login_once(stand_in_infrared):
+    connector = InfraredConnector(url=stand_in_infrared.url)
+    stand_in_infrared.expire_token()
+
+    async def run_queries():
+        async with AsyncInfraredConnector(connector) as async_connector:
+            return await asyncio.gather(*[async_connector.execute_query("query") for _ in range(8)])
+
+    assert asyncio.run(run_queries()) == [SUCCESS] * 8
+    assert stand_in_infrared.logins == 2
+
+
+def create_buildings(simulation_area: dict, count: int, offset: int = 0) -> dict:
+    minx, miny, _, _ = gpd.GeoDataFrame.from_features(simulation_area["features"]).total_bounds
+    buildings = gpd.GeoDataFrame(
+        geometry=[
+            box(minx + (i % 19) * 20, miny + (i // 19) * 20, minx + (i % 19) * 20 + 10, miny + (i // 19) * 20 + 10)
+            for i in range(offset, offset + count)
+        ],
+        crs="EPSG:25832"
+    )
+    buildings["building_height"] = 10
+
+    return json.loads(buildings.to_json())
+
+
+@pytest.fixture
+def stand_in_project(stand_in_infrared):
+    connector = InfraredConnector(url=stand_in_infrared.url)
+    registry = ProjectRegistry(fakeredis.FakeRedis(decode_responses=True), key_prefix="test")
+    registry.mark_empty("project")
+
+    with patch("infrared_wrapper_api.infrared_wrapper.infrared.infrared_project.connector", connector), \
+            patch("infrared_wrapper_api.infrared_wrapper.infrared.infrared_connector.connector", connector), \
+            patch("infrared_wrapper_api.infrared_wrapper.infrared.infrared_project.project_registry", registry), \
+            patch("infrared_wrapper_api.infrared_wrapper.infrared.infrared_project.create_batch_size",
+                  AdaptiveBatchSize.from_settings("create_buildings", Mock())), \
+            patch("infrared_wrapper_api.infrared_wrapper.infrared.infrared_project.delete_batch_size",
+                  AdaptiveBatchSize.from_settings("delete_buildings", Mock(), initial_size=50)):
+        yield registry
+
+
+def test_building_batches_uploaded_concurrently(stand_in_infrared, stand_in_project, sample_simulation_area):
+    stand_in_infrared.query_delay = 0.05
+
+    # 95 buildings -> 10 chunks of 10 buildings
+    tile_buildings = prepare_buildings(create_buildings(sample_simulation_area, 95), sample_simulation_area)
+
+    start_time = time.perf_counter()
+    project = InfraredProject.with_buildings("project", tile_buildings, activate_sun=True)
+    upload_time = time.perf_counter() - start_time
+
+    building_uploads = [query for query in stand_in_infrared.queries if "createNewBuilding" in query]
+    print(f"uploaded {len(building_uploads)} batches in {upload_time:.2f}s")
+
+    assert project.snapshot_uuid == "snapshot"
+    # all buildings in fewer round trips than with fixed chunks of 10
+    assert sum(query.count("createNewBuilding") for query in building_uploads) == 95
+    assert len(building_uploads) < 10
+    assert any("modifyProject" in query for query in stand_in_infrared.queries)
+    assert stand_in_infrared.max_in_flight == settings.infrared_communication.max_concurrent_queries
+    # sequential uploads would take at least 11 * query_delay
+    assert upload_time < 11 * stand_in_infrared.query_delay
+    assert len(stand_in_project.loaded_buildings("project")) == 95
+
+
+def test_only_building_delta_is_sent(stand_in_infrared, stand_in_project, sample_simulation_area):
+    InfraredProject.with_buildings(
+        "project",
+        prepare_buildings(create_buildings(sample_simulation_area, 40), sample_simulation_area)
+    )
+    loaded_buildings = stand_in_project.loaded_buildings("project")
+    stand_in_infrared.queries.clear()
+
+    # edited scenario: first 5 buildings removed, 3 buildings added
+    tile_buildings = prepare_buildings(create_buildings(sample_simulation_area, 38, offset=5), sample_simulation_area)
+    InfraredProject.with_buildings("project", tile_buildings)
+
+    sent_mutations = "".join(stand_in_infrared.queries)
+    assert sent_mutations.count("deleteBuilding") == 5
+    assert sent_mutations.count("createNewBuilding") == 3
+
+    updated_buildings = stand_in_project.loaded_buildings("project")
+    assert set(updated_buildings) == set(tile_buildings)
+    # kept buildings were not touched
+    assert all(updated_buildings[h] == loaded_buildings[h] for h in set(loaded_buildings) & set(tile_buildings))
+
+
+def test_buildings_of_unknown_project_are_replaced(stand_in_infrared, stand_in_project, sample_simulation_area):
+    stand_in_project.forget("project")
+    tile_buildings = prepare_buildings(create_buildings(sample_simulation_area, 10), sample_simulation_area)
+
+    with patch(
+            "infrared_wrapper_api.infrared_wrapper.infrared.infrared_project.get_all_building_uuids_for_project",
+            return_value=["old_0", "old_1"]
+    ):
+        InfraredProject.with_buildings("project", tile_buildings)
+
+    sent_mutations = "".join(stand_in_infrared.queries)
+    assert sent_mutations.count("deleteBuilding") == 2
+    assert sent_mutations.count("createNewBuilding") == 10
+    assert set(stand_in_project.loaded_buildings("project")) == set(tile_buildings)
+
+
+def test_failed_deletions_raise(stand_in_infrared, stand_in_project, sample_simulation_area):
+    InfraredProject.with_buildings(
+        "project",
+        prepare_buildings(create_buildings(sample_simulation_area, 10), sample_simulation_area)
+    )
+    stand_in_infrared.failing_mutation = "deleteBuilding"
+
+    with pytest.raises(BuildingsNotLoadedException):
+        InfraredProject.with_buildings(
+            "project",
+            prepare_buildings(create_buildings(sample_simulation_area, 10, offset=5), sample_simulation_area)
+        )
+
+    # which buildings are left is unknown
+    assert stand_in_project.loaded_buildings("project") is None
+
+
+def test_failed_creations_raise(stand_in_infrared, stand_in_project, sample_simulation_area):
+    stand_in_infrared.failing_mutation = "createNewBuilding"
+
+    with pytest.raises(BuildingsNotLoadedException):
+        InfraredProject.with_buildings(
+            "project",
+            prepare_buildings(create_buildings(sample_simulation_area, 10), sample_simulation_area)
+        )
+
+    # none of the buildings were created
+    assert stand_in_project.loaded_buildings("project") == {}
+
+
+def test_snapshot_looked_up_once(stand_in_infrared, stand_in_project, sample_simulation_area):
+    for offset in range(3):
+        tile_buildings = prepare_buildings(create_buildings(sample_simulation_area, 5, offset), sample_simulation_area)
+        assert InfraredProject.with_buildings("project", tile_buildings).snapshot_uuid == "snapshot"
+
+    assert InfraredProject("project").snapshot_uuid == "snapshot"
+    assert sum("getSnapshotsByProjectUuid" in query for query in stand_in_infrared.queries) == 1
+    assert stand_in_project.project_metadata("project") == {"snapshot_uuid": "snapshot", "name": "CUT_project"}
+
+
+def test_sun_activated_once(stand_in_infrared, stand_in_project, sample_simulation_area):
+    for offset in range(3):
+        tile_buildings = prepare_buildings(create_buildings(sample_simulation_area, 5, offset), sample_simulation_area)
+        InfraredProject.with_buildings("project", tile_buildings, activate_sun=True)
+
+    assert sum("modifyProject" in query for query in stand_in_infrared.queries) == 1
+    assert stand_in_project.capabilities("project") == {"sunlight_hours"}
+
+
+def test_cleanup_deletes_recorded_buildings(stand_in_infrared, stand_in_project, sample_simulation_area):
+    InfraredProject.with_buildings(
+        "project",
+        prepare_buildings(create_buildings(sample_simulation_area, 40), sample_simulation_area)
+    )
+    stand_in_infrared.queries.clear()
+
+    with patch(
+            "infrared_wrapper_api.infrared_wrapper.infrared.infrared_project.get_all_building_uuids_for_project"
+    ) as mock_list_buildings:
+        InfraredProject("project").delete_all_buildings()
+
+    mock_list_buildings.assert_not_called()
+    # all deletions in one batch
+    assert len(stand_in_infrared.queries) == 1
+    assert stand_in_infrared.queries[0].count("deleteBuilding") == 40
+    assert stand_in_project.loaded_buildings("project") == {}
+
+
+def test_cleanup_lists_unknown_buildings(stand_in_infrared, stand_in_project):
+    stand_in_project.forget("project")
+
+    with patch(
+            "infrared_wrapper_api.infrared_wrapper.infrared.infrared_project.get_all_building_uuids_for_project",
+            return_value=["old_0", "old_1"]
+    ):
+        InfraredProject("project").delete_all_buildings()
+
+    assert "".join(stand_in_infrared.queries).count("deleteBuilding") == 2
+    assert stand_in_project.loaded_buildings("project") == {}
@@ -1,8 +1,12 @@
+import pytest
 import geopandas as gpd
+import numpy as np
 
 from infrared_wrapper_api.config import settings
 from infrared_wrapper_api.infrared_wrapper.infrared.infrared_result import InfraredResult, crop_buffer, \
     georeference_infrared_result
+from infrared_wrapper_api.infrared_wrapper.infrared.result_grid import ResultGrid, mosaic_result_grids, \
+    result_grid_to_geojson
 from tests.fixtures import sample_simulation_result_raw, sample_simulation_area
 
 
@@ -38,3 +42,103 @@ def test_getting_final_georeferenced_result(sample_simulation_result_raw, sample
 
     # check that the result really is within the simulation area.
     assert result_gdf.within(sim_area_gdf.to_crs("EPSG:4326").unary_union.convex_hull).all()
+
+
+def test_raster_polygons_match_per_cell_reference(sample_simulation_result_raw, sample_simulation_area):
+    infrared_result = InfraredResult.from_raw_result(sample_simulation_result_raw)
+    sim_area_gdf = gpd.GeoDataFrame.from_features(sample_simulation_area["features"], "EPSG:25832")
+    geo_minx, geo_miny, _, _ = sim_area_gdf.total_bounds
+
+    # reference: a feature per cell, translated, cropped by clipping and dissolved by value
+    reference_gdf = gpd.GeoDataFrame.from_features(infrared_result.result_to_geojson()["features"])
+    reference_gdf["geometry"] = reference_gdf.translate(geo_minx, geo_miny)
+    reference_gdf = crop_buffer(reference_gdf).dissolve(by="value").reset_index()
+
+    raster_gdf = infrared_result.result_to_polygons(sim_area_gdf.total_bounds)
+
+    assert sorted(raster_gdf["value"]) == sorted(reference_gdf["value"])
+    assert list(raster_gdf.total_bounds) == pytest.approx(list(reference_gdf.total_bounds))
+
+    # sourcery skip: no-loop-in-tests
+    for value in reference_gdf["value"]:
+        reference_geom = reference_gdf.loc[reference_gdf["value"] == value].geometry.iloc[0]
+        raster_geom = raster_gdf.loc[raster_gdf["value"] == value].geometry.iloc[0]
+        assert raster_geom.symmetric_difference(reference_geom).area == pytest.approx(0, abs=1e-3)
+
+
+def test_georeferenced_grid_drops_buffer_cells(sample_simulation_result_raw, sample_simulation_area):
+    infrared_result = InfraredResult.from_raw_result(sample_simulation_result_raw)
+    sim_area_gdf = gpd.GeoDataFrame.from_features(sample_simulation_area["features"], "EPSG:25832")
+    geo_minx, geo_miny, _, _ = sim_area_gdf.total_bounds
+
+    result_grid = infrared_result.georeferenced_grid(sim_area_gdf.total_bounds)
+
+    resolution = settings.infrared_calculation.analysis_resolution
+    buffer = settings.infrared_calculation.simulation_area_buffer
+    cropped_size = settings.infrared_calculation.infrared_sim_area_size - 2 * buffer
+
+    assert result_grid.grid.shape == (cropped_size // resolution, cropped_size // resolution)
+    # upper left corner of the cropped grid
+    assert (result_grid.minx, result_grid.maxy) == pytest.approx((geo_minx + buffer, geo_miny + buffer + cropped_size))
+
+    # each cell has the raw value at its position: rows of the raw data go south to north from the area's origin
+    rows, cols = np.indices(result_grid.grid.shape)
+    center_x = result_grid.minx + (cols + 0.5) * resolution
+    center_y = result_grid.maxy - (rows + 0.5) * resolution
+    raw_data = np.array(sample_simulation_result_raw["analysisOutputData"])
+    expected = raw_data[
+        ((center_y - geo_miny) // resolution).astype(int),
+        ((center_x - geo_minx) // resolution).astype(int)
+    ]
+    assert np.array_equal(result_grid.grid, expected)
+
+
+def test_georeferenced_result_methods_match(sample_simulation_result_raw, sample_simulation_area):
+    sim_area_gdf = gpd.GeoDataFrame.from_features(sample_simulation_area["features"], "EPSG:25832")
+
+    raster_result = georeference_infrared_result(sample_simulation_result_raw, sim_area_gdf.total_bounds)
+    reference_result = georeference_infrared_result(
+        sample_simulation_result_raw, sim_area_gdf.total_bounds, method="per_cell"
+    )
+
+    raster_gdf = gpd.GeoDataFrame.from_features(raster_result["features"])
+    reference_gdf = gpd.GeoDataFrame.from_features(reference_result["features"])
+
+    assert sorted(raster_gdf["value"]) == sorted(reference_gdf["value"])
+    assert raster_gdf.unary_union.area == pytest.approx(reference_gdf.unary_union.area, rel=1e-3)
+
+
+def test_result_grid_bytes_roundtrip():
+    # non-square, with a cell without value, values not exactly representable as float32 (restored by rounding)
+    grid = np.round(np.random.default_rng(0).integers(0, 6, size=(40, 30)) * 0.2, 1)
+    grid[3, 7] = np.nan
+    result_grid = ResultGrid(grid=grid, minx=565123.5, maxy=5930400.25, resolution=10)
+
+    restored = ResultGrid.from_bytes(result_grid.to_bytes())
+
+    assert restored.grid.shape == (40, 30)
+    assert np.array_equal(restored.grid, grid, equal_nan=True)
+    assert (restored.minx, restored.maxy, restored.resolution) == \
+           (result_grid.minx, result_grid.maxy, result_grid.resolution)
+    # header + float32 cells
+    assert len(result_grid.to_bytes()) < result_grid.grid.size * 4 + 64
+
+
+def test_mosaic_result_grids():
+    size = settings.infrared_calculation.cropped_simulation_area_size
+    resolution = settings.infrared_calculation.analysis_resolution
+    cells = size // resolution
+
+    # two neighboring tiles with the same value meet at the tile border
+    left = ResultGrid(grid=np.full((cells, cells), 0.4), minx=565000, maxy=5930400, resolution=resolution)
+    right = ResultGrid(grid=np.full((cells, cells), 0.4), minx=565000 + size, maxy=5930400, resolution=resolution)
+
+    mosaic = mosaic_result_grids([left, right])
+
+    assert mosaic.grid.shape == (cells, 2 * cells)
+    assert not np.isnan(mosaic.grid).any()
+
+    # no seam between the tiles
+    result = result_grid_to_geojson(mosaic)
+    assert len(result["features"]) == 1
+    assert gpd.GeoDataFrame.from_features(result["features"]).geometry.iloc[0].geom_type == "Polygon"
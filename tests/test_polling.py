@@ -0,0 +1,125 @@
+import time
+from typing import Callable
+from unittest.mock import patch, Mock
+
+import fakeredis
+import pytest
+
+from infrared_wrapper_api.completion_times import CompletionTimes
+from infrared_wrapper_api.config import settings
+from infrared_wrapper_api.infrared_wrapper.infrared.infrared_connector import InfraredException
+from infrared_wrapper_api.infrared_wrapper.infrared.polling import wait_for_analysis_output
+from infrared_wrapper_api.metrics import Metrics
+from infrared_wrapper_api.project_pool import LeaseLostException
+
+"""
+Tests waiting for simulation results
+- completion times are learned per sim type and building count
+- the first poll is scheduled near the expected completion
+- the result is polled at a short interval until it is written
+- polls and time to result are recorded as metrics
+- the lease of the project is renewed while waiting
+"""
+
+RESULT = {"result": "raw"}
+
+
+@pytest.fixture
+def fake_completion_times():
+    fake_redis = fakeredis.FakeRedis(decode_responses=True)
+    fake_completion_times = CompletionTimes(fake_redis, key_prefix="test", default_seconds=0.2)
+    fake_metrics = Metrics(fake_redis, key_prefix="test")
+
+    with patch("infrared_wrapper_api.infrared_wrapper.infrared.polling.completion_times", fake_completion_times), \
+            patch("infrared_wrapper_api.infrared_wrapper.infrared.polling.metrics", fake_metrics), \
+            patch.object(settings.infrared_communication, "poll_interval_seconds", 0.05), \
+            patch.object(settings.infrared_communication, "result_timeout_seconds", 1):
+        yield fake_completion_times, fake_metrics
+
+
+class StandInResult:
+    """
+    A result that is ready after ready_seconds
+    """
+
+    def __init__(self, ready_seconds: float):
+        self.ready_at = time.monotonic() + ready_seconds
+        self.reads = []
+
+    def read(self, project_uuid: str, snapshot_uuid: str, result_uuid: str) -> dict:
+        self.reads.append(time.monotonic())
+        if time.monotonic() < self.ready_at:
+            raise KeyError("result not ready")
+        return RESULT
+
+
+def wait_for(result: StandInResult, building_count: int = 10, renew_lease: Callable = None) -> dict:
+    with patch("infrared_wrapper_api.infrared_wrapper.infrared.polling.read_analysis_output", result.read):
+        return wait_for_analysis_output(
+            "project", "snapshot", "result", sim_type="wind", building_count=building_count,
+            triggered_at=time.monotonic(), renew_lease=renew_lease
+        )
+
+
+def test_completion_times_are_learned():
+    completion_times = CompletionTimes(fakeredis.FakeRedis(decode_responses=True), "test", default_seconds=3)
+    assert completion_times.expected_seconds("wind", 100) == 3
+
+    completion_times.record("wind", 100, 10)
+    completion_times.record("wind", 100, 20)
+
+    assert completion_times.expected_seconds("wind", 100) == pytest.approx(13)
+    # similar building counts share their completion time, other sim types do not
+    assert completion_times.expected_seconds("wind", 120) == pytest.approx(13)
+    assert completion_times.expected_seconds("wind", 10) == 3
+    assert completion_times.expected_seconds("sun", 100) == 3
+
+
+def test_first_poll_near_expected_completion(fake_completion_times):
+    completion_times, _ = fake_completion_times
+    completion_times.record("wind", 10, 0.3)
+    result = StandInResult(ready_seconds=0.3)
+    start_time = time.monotonic()
+
+    assert wait_for(result) == RESULT
+    assert result.reads[0] - start_time >= 0.9 * 0.3
+    assert len(result.reads) <= 3
+
+
+def test_result_polled_until_ready(fake_completion_times):
+    completion_times, metrics = fake_completion_times
+    result = StandInResult(ready_seconds=0.4)
+
+    assert wait_for(result) == RESULT
+    assert len(result.reads) > 1
+
+    assert metrics.observations("wind_polls_per_tile") == [len(result.reads)]
+    assert metrics.observations("wind_seconds_to_result")[0] >= 0.4
+    # the default of 0.2s moved towards the observed completion time
+    assert completion_times.expected_seconds("wind", 10) > 0.2
+
+
+def test_result_timeout(fake_completion_times):
+    _, metrics = fake_completion_times
+
+    with pytest.raises(InfraredException):
+        wait_for(StandInResult(ready_seconds=5))
+
+    assert metrics.counters() == {"wind_result_timeouts": 1}
+
+
+def test_lease_renewed_while_polling(fake_completion_times):
+    result = StandInResult(ready_seconds=0.4)
+    renew_lease = Mock()
+
+    assert wait_for(result, renew_lease=renew_lease) == RESULT
+    assert renew_lease.call_count == len(result.reads)
+
+
+def test_polling_stops_when_lease_lost(fake_completion_times):
+    result = StandInResult(ready_seconds=0.4)
+
+    with pytest.raises(LeaseLostException):
+        wait_for(result, renew_lease=Mock(side_effect=LeaseLostException("lease of project expired")))
+
+    assert result.reads == []
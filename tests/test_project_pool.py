@@ -0,0 +1,215 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fakeredis
+import pytest
+
+from infrared_wrapper_api.project_pool import ProjectPool, NoIdleProjectException
+
+"""
+Tests leasing of infrared projects against a local fake redis
+- no project is leased twice at the same time
+- waiting for a released project
+- reclaiming expired leases
+- claiming preferred projects
+- leasing projects for their cleanup
+- lost leases cannot be released or renewed
+- demand for projects and maintenance locks of the pool
+"""
+
+
+@pytest.fixture
+def fake_redis_server():
+    return fakeredis.FakeServer()
+
+
+def create_pool(fake_redis_server, lease_seconds: int = 60) -> ProjectPool:
+    return ProjectPool(
+        fakeredis.FakeRedis(server=fake_redis_server, decode_responses=True),
+        key_prefix="test",
+        lease_seconds=lease_seconds
+    )
+
+
+def test_no_double_assignment_under_parallel_claims(fake_redis_server):
+    project_uuids = [f"project_{i}" for i in range(5)]
+    setup_pool = create_pool(fake_redis_server)
+    for project_uuid in project_uuids:
+        setup_pool.register(project_uuid)
+
+    in_use = set()
+    in_use_lock = threading.Lock()
+    double_assignments = []
+
+    def simulate():
+        # each worker has its own connection
+        pool = create_pool(fake_redis_server)
+        project_uuid, lease_token = pool.acquire(timeout=10)
+
+        with in_use_lock:
+            if project_uuid in in_use:
+                double_assignments.append(project_uuid)
+            in_use.add(project_uuid)
+
+        time.sleep(0.01)
+
+        with in_use_lock:
+            in_use.remove(project_uuid)
+        pool.release(project_uuid, lease_token)
+
+        return project_uuid
+
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        leased = list(executor.map(lambda _: simulate(), range(100)))
+
+    assert not double_assignments
+    assert set(leased) == set(project_uuids)
+    # all projects are back in the pool
+    assert sorted(setup_pool.idle_projects()) == project_uuids
+    assert setup_pool.leased_projects() == []
+
+
+def test_acquire_times_out(fake_redis_server):
+    pool = create_pool(fake_redis_server)
+    pool.register("project_0")
+    pool.acquire(timeout=1)
+
+    with pytest.raises(NoIdleProjectException):
+        pool.acquire(timeout=1)
+
+
+def test_waiting_claim_gets_released_project(fake_redis_server):
+    pool = create_pool(fake_redis_server)
+    pool.register("project_0")
+    _, lease_token = pool.acquire(timeout=1)
+
+    threading.Timer(0.2, lambda: create_pool(fake_redis_server).release("project_0", lease_token)).start()
+
+    assert pool.acquire(timeout=5)[0] == "project_0"
+
+
+def test_register_does_not_add_leased_projects(fake_redis_server):
+    pool = create_pool(fake_redis_server)
+    pool.register("project_0")
+    pool.acquire(timeout=1)
+
+    assert not pool.register("project_0")
+    assert pool.idle_projects() == []
+
+
+def test_expired_leases_are_reclaimed(fake_redis_server):
+    pool = create_pool(fake_redis_server, lease_seconds=0)
+    pool.register("project_0")
+    pool.register("project_1")
+    pool.acquire(timeout=1)
+
+    assert pool.reclaim_expired_leases() == ["project_0"]
+    assert pool.leased_projects() == []
+    # reclaimed projects need a cleanup before they are idle again
+    assert pool.idle_projects() == ["project_1"]
+
+
+def test_project_leased_once_for_cleanup(fake_redis_server):
+    pool = create_pool(fake_redis_server)
+    pool.register("idle")
+
+    # projects to be cleaned are neither idle nor leased
+    lease_tokens = [create_pool(fake_redis_server).lease("to_be_cleaned") for _ in range(3)]
+    assert lease_tokens[0] and lease_tokens[1:] == [None, None]
+    assert not pool.lease("idle")
+    assert pool.leased_projects() == ["to_be_cleaned"]
+
+    # released once clean
+    assert pool.release("to_be_cleaned", lease_tokens[0])
+    assert pool.idle_projects() == ["idle", "to_be_cleaned"]
+
+
+def test_renewed_lease_does_not_expire(fake_redis_server):
+    pool = create_pool(fake_redis_server, lease_seconds=0)
+    pool.register("project_0")
+    _, lease_token = pool.acquire(timeout=1)
+    assert not pool.renew_lease("project_1", lease_token)  # not leased, stays so
+
+    pool._lease_seconds = 60
+    assert pool.renew_lease("project_0", lease_token)
+
+    assert pool.reclaim_expired_leases() == []
+    assert pool.leased_projects() == ["project_0"]
+
+
+def test_lost_lease_is_not_released(fake_redis_server):
+    pool = create_pool(fake_redis_server, lease_seconds=0)
+    pool.register("project_0")
+    _, expired_token = pool.acquire(timeout=1)
+
+    # the lease expired, the project is reclaimed and leased for its cleanup
+    assert pool.reclaim_expired_leases() == ["project_0"]
+    pool._lease_seconds = 60
+    cleanup_token = pool.lease("project_0")
+
+    # the former holder can neither return the project to the idle projects nor keep it
+    assert not pool.release("project_0", expired_token)
+    assert not pool.renew_lease("project_0", expired_token)
+    assert not pool.end_lease("project_0", expired_token)
+    assert pool.idle_projects() == []
+    assert pool.leased_projects() == ["project_0"]
+
+    assert pool.release("project_0", cleanup_token)
+    assert pool.idle_projects() == ["project_0"]
+
+
+def test_preferred_project_is_claimed(fake_redis_server):
+    pool = create_pool(fake_redis_server)
+    for project_uuid in ["project_0", "project_1", "project_2"]:
+        pool.register(project_uuid)
+
+    assert pool.acquire(timeout=1, rank=lambda idle_projects: ["project_2", "project_0"])[0] == "project_2"
+    # falls back to the next preferred project, then to any idle project
+    assert pool.acquire(timeout=1, rank=lambda idle_projects: ["project_2", "project_0"])[0] == "project_0"
+    assert pool.acquire(timeout=1, rank=lambda idle_projects: ["project_2"])[0] == "project_1"
+    assert sorted(pool.leased_projects()) == ["project_0", "project_1", "project_2"]
+
+
+def test_waiting_claims_are_counted(fake_redis_server):
+    pool = create_pool(fake_redis_server)
+    pool.register("project_0")
+    _, lease_token = pool.acquire(timeout=1)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        waiting = [executor.submit(create_pool(fake_redis_server).acquire, timeout=5) for _ in range(2)]
+        time.sleep(0.3)
+        assert pool.waiting_claims() == 2
+
+        pool.release("project_0", lease_token)
+        time.sleep(0.3)
+        assert pool.waiting_claims() == 1
+        pool.release(*next(future for future in waiting if future.done()).result())
+
+    assert pool.waiting_claims() == 0
+
+
+def test_expired_waiting_claims_are_not_counted(fake_redis_server):
+    pool = create_pool(fake_redis_server)
+    pool._redis.zadd(pool._waiting_key, {"crashed_worker": time.time() - 1})
+
+    assert pool.waiting_claims() == 0
+
+
+def test_last_demand(fake_redis_server):
+    pool = create_pool(fake_redis_server)
+    assert pool.last_demand() is None
+
+    pool.record_demand()
+    assert time.time() - pool.last_demand() < 1
+
+
+def test_maintenance_lock(fake_redis_server):
+    pool = create_pool(fake_redis_server)
+
+    assert pool.try_lock("autoscale", seconds=60)
+    assert not create_pool(fake_redis_server).try_lock("autoscale", seconds=60)
+    assert pool.try_lock("other", seconds=60)
+
+    pool.unlock("autoscale")
+    assert create_pool(fake_redis_server).try_lock("autoscale", seconds=60)
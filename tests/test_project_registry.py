@@ -0,0 +1,98 @@
+import fakeredis
+import pytest
+
+from infrared_wrapper_api.project_registry import ProjectRegistry
+
+"""
+Tests remembering the buildings loaded in infrared projects
+- unknown vs. empty projects
+- ranking projects by the delta to load a tile's buildings
+- metadata of projects
+- service capabilities of projects
+"""
+
+
+@pytest.fixture
+def registry():
+    return ProjectRegistry(fakeredis.FakeRedis(decode_responses=True), key_prefix="test")
+
+
+def test_loaded_buildings(registry):
+    assert registry.loaded_buildings("project_0") is None
+
+    registry.mark_empty("project_0")
+    assert registry.loaded_buildings("project_0") == {}
+
+    registry.set_loaded_buildings("project_0", {"hash_a": "uuid_a", "hash_b": "uuid_b"})
+    assert registry.loaded_buildings("project_0") == {"hash_a": "uuid_a", "hash_b": "uuid_b"}
+
+    registry.set_loaded_buildings("project_0", {"hash_c": "uuid_c"})
+    assert registry.loaded_buildings("project_0") == {"hash_c": "uuid_c"}
+
+    registry.forget("project_0")
+    assert registry.loaded_buildings("project_0") is None
+
+
+def test_rank_projects_by_delta(registry):
+    registry.set_loaded_buildings("similar", {"a": "1", "b": "2", "c": "3", "x": "4"})
+    registry.set_loaded_buildings("other", {"x": "5", "y": "6", "z": "7"})
+    registry.mark_empty("empty")
+
+    ranked = registry.rank_projects(["unknown", "other", "empty", "similar"], ["a", "b", "c", "d"])
+
+    # similar: delete 1 + create 1, empty: create 4, other: delete 3 + create 4, unknown: last
+    assert ranked == ["similar", "empty", "other", "unknown"]
+
+
+def test_rank_projects_without_buildings(registry):
+    registry.set_loaded_buildings("full", {"a": "1"})
+    registry.mark_empty("empty")
+
+    assert registry.rank_projects(["full", "empty"], []) == ["empty", "full"]
+    assert registry.rank_projects([], ["a"]) == []
+
+
+def test_project_metadata(registry):
+    assert registry.project_metadata("project_0") is None
+
+    registry.set_project_metadata("project_0", snapshot_uuid="snapshot_0", name="CUT_0")
+    registry.set_loaded_buildings("project_0", {"a": "1"})
+    assert registry.project_metadata("project_0") == {"snapshot_uuid": "snapshot_0", "name": "CUT_0"}
+
+    # shared via redis with other processes, metadata stays while buildings change
+    other_registry = ProjectRegistry(registry._redis, key_prefix="test")
+    other_registry.forget("project_0")
+    assert other_registry.project_metadata("project_0") == {"snapshot_uuid": "snapshot_0", "name": "CUT_0"}
+
+    registry.remove("project_0")
+    assert registry.project_metadata("project_0") is None
+    assert registry.loaded_buildings("project_0") is None
+
+
+def test_capabilities(registry):
+    assert registry.capabilities("project_0") == set()
+
+    registry.add_capability("project_0", "sunlight_hours")
+    registry.forget("project_0")
+    # capabilities stay while buildings change
+    assert registry.capabilities("project_0") == {"sunlight_hours"}
+    assert registry.with_capability(["project_1", "project_0"], "sunlight_hours") == ["project_0"]
+
+    registry.remove("project_0")
+    assert registry.capabilities("project_0") == set()
+
+
+def test_rank_projects_with_capability_first(registry):
+    registry.set_loaded_buildings("similar", {"a": "1", "b": "2"})
+    registry.mark_empty("empty_sun")
+    registry.mark_empty("empty")
+    registry.add_capability("empty_sun", "sunlight_hours")
+    registry.add_capability("unknown_sun", "sunlight_hours")
+
+    project_uuids = ["unknown", "unknown_sun", "empty", "similar", "empty_sun"]
+    assert registry.rank_projects(project_uuids, ["a", "b"]) == [
+        "similar", "empty", "empty_sun", "unknown", "unknown_sun"
+    ]
+    assert registry.rank_projects(project_uuids, ["a", "b"], capability="sunlight_hours") == [
+        "empty_sun", "similar", "empty", "unknown_sun", "unknown"
+    ]
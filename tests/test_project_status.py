@@ -1,11 +1,18 @@
+import time
 from unittest.mock import patch
 
-from infrared_wrapper_api.infrared_wrapper.infrared.infrared_connector import get_all_cut_prototype_projects_uuids
-from infrared_wrapper_api.api.utils import find_idle_infrared_project, update_infrared_project_status_in_redis
+import fakeredis
+import numpy as np
+
+from infrared_wrapper_api.api.utils import lease_idle_infrared_project, update_infrared_project_status_in_redis
 from infrared_wrapper_api.infrared_wrapper.infrared.models import ProjectStatus
+from infrared_wrapper_api.infrared_wrapper.infrared.result_grid import ResultGrid
+from infrared_wrapper_api.infrared_wrapper.infrared.setup.setup_infrared import cleanup_infrared_projects, \
+    autoscale_project_pool, preactivate_sun_projects, setup_infrared
 from infrared_wrapper_api.models.calculation_input import WindSimulationTask
-from infrared_wrapper_api.tasks import task__do_simulation
-from tests.utils import get_idle_project_id
+from infrared_wrapper_api.project_pool import ProjectPool
+from infrared_wrapper_api.project_registry import ProjectRegistry
+from tests.utils import get_idle_project_id, run_simulation_chain
 from tests.fixtures import sample_simulation_area, sample_building_data_single_bbox
 
 
@@ -15,50 +22,58 @@ def test_update_project_status():
     """
     project_uuid = get_idle_project_id()
 
-    with patch("infrared_wrapper_api.dependencies.cache.put") as mock_cache_put:
+    with patch("infrared_wrapper_api.dependencies.cache.put") as mock_cache_put, \
+            patch("infrared_wrapper_api.api.utils.project_pool") as mock_project_pool:
         # set project as idle.
-        update_infrared_project_status_in_redis(project_uuid, ProjectStatus.IDLE.value)
+        update_infrared_project_status_in_redis(project_uuid, ProjectStatus.IDLE.value, lease_token="token")
         mock_cache_put.assert_called_once_with(key=project_uuid, value={"status": ProjectStatus.IDLE.value})
+        # and returned to the pool
+        mock_project_pool.release.assert_called_once_with(project_uuid, "token")
 
 
 def test_getting_idle_project():
     """
     Test the communication with redis, when choosing an infrared project that is idle.
-    We are documenting the project state (busy, not busy) in the redis db on our side,
+    We are leasing projects from a pool in the redis db on our side,
     in order to avoid using the same InfraredProject by 2 simultaneous requests
 
     This test
-    - should check if the project is busy
+    - should lease a project from the pool
     - selected project should be marked as busy upon selection
     """
+    project_pool = ProjectPool(fakeredis.FakeRedis(decode_responses=True), key_prefix="test", lease_seconds=60)
+    project_pool.register("abc123")
 
     # Mock functions that require a redis instance to run.
-    with patch("infrared_wrapper_api.api.utils.update_infrared_project_status_in_redis") as mock_update_status, \
-            patch("infrared_wrapper_api.dependencies.cache.put") as mock_cache_put, \
-            patch(
-                "infrared_wrapper_api.dependencies.cache.get",
-                return_value={"status": ProjectStatus.IDLE.value}
-            ) as mocK_cache_get:
-        project_uuid = find_idle_infrared_project(get_all_cut_prototype_projects_uuids())
+    project_registry = ProjectRegistry(fakeredis.FakeRedis(decode_responses=True), key_prefix="test")
+    with patch("infrared_wrapper_api.api.utils.project_pool", project_pool), \
+            patch("infrared_wrapper_api.api.utils.project_registry", project_registry), \
+            patch("infrared_wrapper_api.dependencies.cache.put") as mock_cache_put:
+        project_uuid, lease_token = lease_idle_infrared_project()
 
-        # Assert that selected project will be marked busy.
-        mocK_cache_get.assert_called()
-        mock_update_status.assert_called_once_with(project_uuid=project_uuid, status=ProjectStatus.BUSY.value)
-        assert project_uuid is not None
+        # Assert that selected project will be marked busy and is leased.
+        assert project_uuid == "abc123"
+        assert lease_token
+        mock_cache_put.assert_called_once_with(key=project_uuid, value={"status": ProjectStatus.BUSY.value})
+        assert project_pool.leased_projects() == ["abc123"]
+        assert project_pool.idle_projects() == []
 
 
-def test_mark_completed_after_simulation(sample_simulation_area, sample_building_data_single_bbox):
+def test_idle_after_simulation(sample_simulation_area, sample_building_data_single_bbox):
     """
     This test
     - mocks a simulation task is being executed.
-    - tests if the infrared project is marked "completed" at the end of the simulation
+    - tests if the infrared project is idle again at the end of the simulation, keeping its buildings
     """
 
-    mock_result = {"features": [{"id": "test"}]}
+    mock_result = ResultGrid(grid=np.full((40, 40), 0.2), minx=565000, maxy=5930400, resolution=10)
 
     # Mock functions that require a redis instance to run.
-    with patch("infrared_wrapper_api.tasks.cache.get", return_value={}) as mock_cache_get, \
-            patch("infrared_wrapper_api.tasks.do_simulation", return_value=mock_result) as mock_do_sim, \
+    with patch("infrared_wrapper_api.tasks.cache.get_bytes", return_value=None) as mock_cache_get, \
+            patch("infrared_wrapper_api.tasks.run_simulation", return_value={}) as mock_do_sim, \
+            patch("infrared_wrapper_api.tasks.format_result", return_value=mock_result), \
+            patch("infrared_wrapper_api.dependencies.cache.put_bytes") as mock_cache_put_bytes, \
+            patch("infrared_wrapper_api.api.utils.project_pool") as mock_project_pool, \
             patch("infrared_wrapper_api.dependencies.cache.put") as mock_cache_put:
         mock_project_uuid = "abc123"
         sample_wind_sim_task = WindSimulationTask(
@@ -67,9 +82,168 @@ def test_mark_completed_after_simulation(sample_simulation_area, sample_building
             wind_speed=15,
             wind_direction=15
         )
-        result = task__do_simulation(mock_project_uuid, sample_wind_sim_task.dict())
+        mock_project_pool.acquire.return_value = (mock_project_uuid, "token")
+        result = run_simulation_chain(sample_wind_sim_task.dict())
 
         # Assert that selected project will be marked busy.
         mock_cache_get.assert_called()
         mock_do_sim.assert_called()
-        mock_cache_put.assert_called_with(key=mock_project_uuid, value={"status": ProjectStatus.TO_BE_CLEANED.value})
+        mock_cache_put.assert_called_with(key=mock_project_uuid, value={"status": ProjectStatus.IDLE.value})
+        mock_project_pool.release.assert_called_once_with(mock_project_uuid, "token")
+        mock_project_pool.end_lease.assert_not_called()
+
+
+def test_reconciler_cleans_up_lost_projects_once():
+    """
+    Projects to be cleaned, whose cleanup task is not pending (not leased), are cleaned up once by the reconciler.
+    """
+    project_pool = ProjectPool(fakeredis.FakeRedis(decode_responses=True), key_prefix="test", lease_seconds=60)
+    project_pool.lease("pending_cleanup")
+    statuses = {
+        "idle": {"status": ProjectStatus.IDLE.value},
+        "pending_cleanup": {"status": ProjectStatus.TO_BE_CLEANED.value},
+        "lost_cleanup": {"status": ProjectStatus.TO_BE_CLEANED.value},
+    }
+    cleaned_up = []
+
+    def cleanup(project_uuid: str, lease_token: str) -> bool:
+        cleaned_up.append(project_uuid)
+        return True
+
+    setup_infrared = "infrared_wrapper_api.infrared_wrapper.infrared.setup.setup_infrared"
+    with patch(f"{setup_infrared}.project_pool", project_pool), \
+            patch(f"{setup_infrared}.get_all_cut_prototype_projects_uuids", return_value=list(statuses)), \
+            patch(f"{setup_infrared}.cache.get", side_effect=lambda key: statuses[key]):
+        cleanup_infrared_projects(cleanup=cleanup)
+        cleanup_infrared_projects(cleanup=cleanup)
+
+    assert cleaned_up == ["lost_cleanup"]
+    assert project_pool.idle_projects() == ["idle"]
+    assert sorted(project_pool.leased_projects()) == ["lost_cleanup", "pending_cleanup"]
+
+
+def test_reconciler_leaves_project_to_pending_cleanup():
+    """
+    If a cleanup of an expired lease is still pending, the reconciler does not hold the project leased meanwhile.
+    """
+    project_pool = ProjectPool(fakeredis.FakeRedis(decode_responses=True), key_prefix="test", lease_seconds=60)
+
+    setup_infrared = "infrared_wrapper_api.infrared_wrapper.infrared.setup.setup_infrared"
+    with patch(f"{setup_infrared}.project_pool", project_pool), \
+            patch(f"{setup_infrared}.get_all_cut_prototype_projects_uuids", return_value=["pending_cleanup"]), \
+            patch(f"{setup_infrared}.cache.get", return_value={"status": ProjectStatus.TO_BE_CLEANED.value}):
+        assert cleanup_infrared_projects(cleanup=lambda project_uuid, lease_token: False) == []
+
+    # leased again by the next reconciliation, once the pending cleanup skipped the project
+    assert project_pool.leased_projects() == []
+    assert project_pool.idle_projects() == []
+
+
+def test_project_pool_scales_with_demand():
+    """
+    The pool grows while tiles wait for projects, up to the max. size, by at most a step per scaling.
+    Surplus idle projects are retired after the cool-down time without demand, down to the min. size.
+    """
+    project_pool = ProjectPool(fakeredis.FakeRedis(decode_responses=True), key_prefix="test", lease_seconds=60)
+    for count in range(2):
+        project_pool.register(f"project_{count}")
+    created = []
+
+    def create_new_empty_project():
+        created.append(f"new_project_{len(created)}")
+        project_pool.register(created[-1])
+
+    setup_infrared = "infrared_wrapper_api.infrared_wrapper.infrared.setup.setup_infrared"
+    with patch(f"{setup_infrared}.project_pool", project_pool), \
+            patch(f"{setup_infrared}.create_new_empty_project", side_effect=create_new_empty_project), \
+            patch(f"{setup_infrared}.InfraredProject") as mock_infrared_project, \
+            patch(f"{setup_infrared}.MIN_EMPTY_PROJECT_COUNT", 2), \
+            patch(f"{setup_infrared}.MAX_PROJECT_COUNT", 6), \
+            patch(f"{setup_infrared}.settings.infrared_communication.pool_scale_step", 3):
+        assert autoscale_project_pool(pending_tiles=10) == 3
+        assert autoscale_project_pool(pending_tiles=10) == 1
+        assert autoscale_project_pool(pending_tiles=10) == 0
+        assert len(project_pool.idle_projects()) == 6
+
+        # enough idle projects for the demand
+        assert autoscale_project_pool(pending_tiles=0) == 0
+
+        # no demand for the cool-down time
+        project_pool.record_demand()
+        project_pool.acquire(timeout=0)
+        with patch(f"{setup_infrared}.time.time", return_value=time.time() + 3600):
+            assert autoscale_project_pool(pending_tiles=0) == -3
+            assert autoscale_project_pool(pending_tiles=0) == -1
+            assert autoscale_project_pool(pending_tiles=0) == 0
+
+    assert len(created) == 4
+    assert mock_infrared_project.return_value.delete_this_project.call_count == 4
+    # leased projects are not retired, but count for the min. size
+    assert len(project_pool.idle_projects()) == 1
+    assert len(project_pool.leased_projects()) == 1
+
+
+def test_share_of_projects_preactivated_for_sun():
+    """
+    Idle projects get the sunlight hours service activated until the configured share of the pool has it.
+    """
+    fake_redis = fakeredis.FakeRedis(decode_responses=True)
+    project_pool = ProjectPool(fake_redis, key_prefix="test", lease_seconds=60)
+    project_registry = ProjectRegistry(fake_redis, key_prefix="test")
+    for count in range(5):
+        project_pool.register(f"project_{count}")
+    project_registry.add_capability("project_0", "sunlight_hours")
+    project_pool.acquire(timeout=0, rank=lambda idle_projects: ["project_1"])
+
+    setup_infrared = "infrared_wrapper_api.infrared_wrapper.infrared.setup.setup_infrared"
+    with patch(f"{setup_infrared}.project_pool", project_pool), \
+            patch(f"{setup_infrared}.project_registry", project_registry), \
+            patch(f"{setup_infrared}.activate_sunlight_analysis_capability", return_value=True) as mock_activate, \
+            patch(f"{setup_infrared}.settings.infrared_communication.sun_activated_projects_share", 0.6):
+        assert preactivate_sun_projects() == 2
+        assert preactivate_sun_projects() == 0
+
+    # 3 of 5 projects, the leased one is not touched
+    assert mock_activate.call_count == 2
+    assert "project_1" not in [call.args[0] for call in mock_activate.call_args_list]
+    assert len(project_registry.with_capability(project_pool.idle_projects(), "sunlight_hours")) == 3
+    assert project_pool.leased_projects() == ["project_1"]
+
+
+def test_setup_counts_idle_projects_with_buildings():
+    """
+    Idle projects keep their buildings, setup only creates the projects missing for the min. size of the pool,
+    within its max. size.
+    """
+    project_pool = ProjectPool(fakeredis.FakeRedis(decode_responses=True), key_prefix="test", lease_seconds=60)
+    statuses = {
+        "idle_with_buildings": {"status": ProjectStatus.IDLE.value},
+        "busy": {"status": ProjectStatus.BUSY.value},
+        "without_status": None,
+    }
+    created = []
+
+    def update_status(project_uuid, status):
+        statuses[project_uuid] = {"status": status}
+        project_pool.register(project_uuid)
+
+    module = "infrared_wrapper_api.infrared_wrapper.infrared.setup.setup_infrared"
+    with patch(f"{module}.project_pool", project_pool), \
+            patch(f"{module}.get_all_cut_prototype_projects_uuids", side_effect=lambda: list(statuses)), \
+            patch(f"{module}.cache.get", side_effect=lambda key: statuses[key]), \
+            patch(f"{module}.get_project_metadata", return_value={"name": "CUT_project"}), \
+            patch(f"{module}.InfraredProject"), \
+            patch(f"{module}.get_all_building_uuids_for_project", return_value=["building"]), \
+            patch(f"{module}.update_infrared_project_status_in_redis", side_effect=update_status), \
+            patch(f"{module}.create_new_empty_project", side_effect=lambda: created.append(1)), \
+            patch(f"{module}.MIN_EMPTY_PROJECT_COUNT", 4), \
+            patch(f"{module}.MAX_PROJECT_COUNT", 4):
+        setup_infrared()
+
+        # 2 idle projects, 2 missing, but only 1 more within the max. size
+        assert len(created) == 1
+        assert sorted(project_pool.idle_projects()) == ["idle_with_buildings", "without_status"]
+
+        with patch(f"{module}.MIN_EMPTY_PROJECT_COUNT", 2):
+            setup_infrared()
+        assert len(created) == 1
@@ -1,19 +1,40 @@
+import json
+import math
+import time
+from typing import Callable, Tuple
+
+import fakeredis
 import pytest
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
-from unittest.mock import patch
+from fastapi.encoders import jsonable_encoder
+from shapely.geometry import box
+from unittest.mock import patch, Mock, call, ANY
 
-from infrared_wrapper_api.api.utils import find_idle_infrared_project
-from infrared_wrapper_api.infrared_wrapper.data_preparation import create_simulation_tasks, create_bbox_matrix
+from infrared_wrapper_api import tasks
+from infrared_wrapper_api.infrared_wrapper.data_preparation import create_simulation_tasks, create_bbox_matrix, \
+    apply_building_delta, create_tile_definitions, assign_building_ids
+from infrared_wrapper_api.infrared_wrapper.infrared.building_interchange import read_buildings, encode_buildings
 from infrared_wrapper_api.infrared_wrapper.infrared.infrared_connector import get_all_cut_prototype_projects_uuids
+from infrared_wrapper_api.infrared_wrapper.infrared.infrared_project import prepare_buildings, \
+    BuildingsNotLoadedException
+from infrared_wrapper_api.infrared_wrapper.infrared.infrared_result import cropped_grid_origin
 from infrared_wrapper_api.infrared_wrapper.infrared.models import ProjectStatus
+from infrared_wrapper_api.infrared_wrapper.infrared.result_grid import ResultGrid, result_grid_to_geojson
 from infrared_wrapper_api.infrared_wrapper.infrared.setup.setup_infrared import cleanup_project
 from infrared_wrapper_api.infrared_wrapper.infrared.simulation import do_simulation
+from infrared_wrapper_api.infrared_wrapper.infrared.utils import reproject_geojson
 from infrared_wrapper_api.models.calculation_input import WindSimulationTask
 from infrared_wrapper_api.config import settings
-from infrared_wrapper_api.tasks import task__do_simulation
+from infrared_wrapper_api.dependencies import celery_app
+from infrared_wrapper_api.tasks import get_result_grid_cache_key, simulation_chain, task__run_simulation, \
+    dispatch_simulation_tasks, dispatch_delta_simulation_tasks, task__load_cached_tile_result, \
+    task__prepare_simulation_task, task__format_simulation_result
+from infrared_wrapper_api.project_pool import ProjectPool
+from tests.utils import get_idle_project_id, run_simulation_chain
 from tests.fixtures import sample_simulation_input, sample_simulation_area, sample_building_data_multiple_bbox, \
     sample_building_data_single_bbox, sample_simulation_result_single_bbox_geojson, \
     sample_simulation_input_multiple_bboxes
@@ -68,30 +89,193 @@ def test_create_bbox_matrix_single_bbox(sample_building_data_single_bbox):
     assert set(list(bbox_matrix[0].total_bounds)) == set(list(buildings_gdf.total_bounds))
 
 
+def test_create_bbox_matrix_aligned(sample_building_data_multiple_bbox):
+    buildings_gdf = gpd.GeoDataFrame.from_features(sample_building_data_multiple_bbox["features"], crs="EPSG:25832")
+    size = settings.infrared_calculation.cropped_simulation_area_size
+    buffer = settings.infrared_calculation.simulation_area_buffer
+
+    with patch.object(settings.infrared_calculation, "aligned_tiling", True):
+        bbox_matrix = create_bbox_matrix(buildings_gdf)
+        # a request for a part of the area
+        partial_bbox_matrix = create_bbox_matrix(buildings_gdf.iloc[:len(buildings_gdf) // 2])
+
+    bboxes = {tuple(bbox.total_bounds) for bbox in bbox_matrix}
+    for minx, miny, maxx, maxy in bboxes:
+        assert (minx + buffer) % size == 0 and (miny + buffer) % size == 0
+        assert pytest.approx(maxx - minx) == settings.infrared_calculation.infrared_sim_area_size
+
+    # the same area always yields the same bbox
+    assert {tuple(bbox.total_bounds) for bbox in partial_bbox_matrix} <= bboxes
+
+
+def test_aligned_tiling_recomputes_changed_tiles_only(sample_building_data_multiple_bbox):
+    changed_buildings = json.loads(json.dumps(sample_building_data_multiple_bbox))
+    changed_buildings["features"][0]["properties"]["building_height"] += 30
+
+    with patch.object(settings.infrared_calculation, "aligned_tiling", True):
+        celery_keys = [
+            sim_task.celery_key for sim_task in create_simulation_tasks(
+                {"buildings": sample_building_data_multiple_bbox, "wind_speed": 10, "wind_direction": 40}, "wind"
+            )
+        ]
+        changed_celery_keys = [
+            sim_task.celery_key for sim_task in create_simulation_tasks(
+                {"buildings": changed_buildings, "wind_speed": 10, "wind_direction": 40}, "wind"
+            )
+        ]
+
+    assert len(celery_keys) == len(changed_celery_keys)
+    # only the bboxes containing the changed building (incl. their buffer) need a new simulation
+    assert 1 <= len(set(changed_celery_keys) - set(celery_keys)) <= 4
+
+
 def test_create_simulation_tasks(sample_simulation_input):
     sim_tasks = create_simulation_tasks(sample_simulation_input, "wind")
 
     for test_sim_task in sim_tasks:
         assert type(test_sim_task) == WindSimulationTask
-        assert len(test_sim_task.buildings["features"]) > 0
+        buildings_gdf = read_buildings(test_sim_task.buildings)
+        assert len(buildings_gdf) > 0
 
         # test building in bbox
-        sim_area_gdf = gpd.GeoDataFrame.from_features(test_sim_task.simulation_area["features"])
-        buildings_gdf = gpd.GeoDataFrame.from_features(test_sim_task.buildings["features"])
+        sim_area_gdf = gpd.GeoDataFrame.from_features(test_sim_task.simulation_area["features"], crs="EPSG:25832")
 
         assert buildings_gdf.intersects(sim_area_gdf.unary_union.convex_hull).all()
 
 
+def create_synthetic_buildings(count: int) -> dict:
+    # a square grid of 12*12m buildings 25m apart (EPSG:25832)
+    side = math.ceil(math.sqrt(count))
+    buildings_gdf = gpd.GeoDataFrame(
+        geometry=[
+            box(565000 + (i % side) * 25, 5930000 + (i // side) * 25,
+                565000 + (i % side) * 25 + 12, 5930000 + (i // side) * 25 + 12)
+            for i in range(count)
+        ],
+        crs="EPSG:25832"
+    )
+    buildings_gdf["building_height"] = [10 + (i % 7) * 5 for i in range(count)]
+
+    return json.loads(buildings_gdf.to_json())
+
+
+@pytest.mark.benchmark
+def test_tiling_time_scales_with_tiles():
+    """
+    Benchmark: each tile only clips the buildings it intersects, the time per tile does not grow with the input.
+    """
+    seconds_per_tile = {}
+    for building_count in [2_500, 10_000]:
+        task_def = {"buildings": create_synthetic_buildings(building_count), "wind_speed": 10, "wind_direction": 40}
+
+        start_time = time.perf_counter()
+        sim_tasks = create_simulation_tasks(task_def, "wind")
+        seconds = time.perf_counter() - start_time
+
+        seconds_per_tile[building_count] = seconds / len(sim_tasks)
+        print(f"{building_count} buildings, {len(sim_tasks)} tiles: {seconds:.2f}s")
+
+    assert seconds_per_tile[10_000] < 2 * seconds_per_tile[2_500]
+
+
+def geojson_round_trip(buildings_gdf: gpd.GeoDataFrame) -> Tuple[str, gpd.GeoDataFrame]:
+    payload = json.dumps(json.loads(buildings_gdf.to_json()))
+    return payload, gpd.GeoDataFrame.from_features(json.loads(payload)["features"], crs="EPSG:25832")
+
+
+def encoded_round_trip(buildings_gdf: gpd.GeoDataFrame) -> Tuple[str, gpd.GeoDataFrame]:
+    payload = json.dumps(encode_buildings(buildings_gdf))
+    return payload, read_buildings(json.loads(payload))
+
+
+def best_time(func: Callable, *args, repeat: int = 5) -> float:
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def test_tile_buildings_payload():
+    """
+    A tile's buildings passed between tasks survive the encoded round trip and are smaller than as geojson.
+    """
+    buildings_gdf = read_buildings(create_synthetic_buildings(2_500))
+
+    geojson_payload, _ = geojson_round_trip(buildings_gdf)
+    encoded_payload, decoded_gdf = encoded_round_trip(buildings_gdf)
+
+    print(f"2500 buildings: geojson {len(geojson_payload) / 1000:.0f}kB, encoded {len(encoded_payload) / 1000:.0f}kB")
+
+    assert decoded_gdf.geom_equals_exact(buildings_gdf.geometry, tolerance=0).all()
+    assert decoded_gdf["building_height"].tolist() == buildings_gdf["building_height"].tolist()
+    assert len(encoded_payload) < len(geojson_payload)
+
+
+@pytest.mark.benchmark
+def test_tile_buildings_payload_time():
+    """
+    Benchmark: (de)serialization time of a tile's buildings passed between tasks, geojson vs. encoded.
+    """
+    buildings_gdf = read_buildings(create_synthetic_buildings(2_500))
+
+    geojson_seconds = best_time(geojson_round_trip, buildings_gdf)
+    encoded_seconds = best_time(encoded_round_trip, buildings_gdf)
+
+    print(f"2500 buildings: geojson {geojson_seconds * 1000:.1f}ms, encoded {encoded_seconds * 1000:.1f}ms")
+
+    assert encoded_seconds < geojson_seconds
+
+
+def round_trip_to_metric_gdf(buildings: dict) -> gpd.GeoDataFrame:
+    gdf = gpd.GeoDataFrame.from_features(buildings["features"]).set_crs("EPSG:4326")
+    return gpd.GeoDataFrame.from_features(json.loads(gdf.to_crs("EPSG:25832").to_json()), crs="EPSG:25832")
+
+
+def test_reprojection():
+    """
+    Reprojecting the buildings input (EPSG:4326) to EPSG:25832 vectorized matches the geojson round trip.
+    """
+    buildings_gdf = read_buildings(create_synthetic_buildings(2_500))
+    buildings = reproject_geojson(json.loads(buildings_gdf.to_json()), "EPSG:25832", "EPSG:4326")
+
+    metric_gdf = tasks.to_metric_gdf(buildings)
+
+    assert metric_gdf.crs == "EPSG:25832"
+    assert metric_gdf.geom_equals_exact(round_trip_to_metric_gdf(buildings).geometry, tolerance=1e-6).all()
+    assert metric_gdf.geom_equals_exact(buildings_gdf.geometry, tolerance=1e-6).all()
+
+
+@pytest.mark.benchmark
+def test_reprojection_time():
+    """
+    Benchmark: reprojecting the buildings input (EPSG:4326) to EPSG:25832, via geojson round trip vs. vectorized.
+    """
+    buildings_gdf = read_buildings(create_synthetic_buildings(10_000))
+    buildings = reproject_geojson(json.loads(buildings_gdf.to_json()), "EPSG:25832", "EPSG:4326")
+
+    round_trip_seconds = best_time(round_trip_to_metric_gdf, buildings, repeat=1)
+    vectorized_seconds = best_time(tasks.to_metric_gdf, buildings, repeat=1)
+
+    print(f"10000 buildings: geojson round trip {round_trip_seconds:.2f}s, vectorized {vectorized_seconds:.2f}s")
+
+    assert vectorized_seconds < round_trip_seconds / 2
+
+
 def test_task_not_cached(sample_simulation_area, sample_building_data_single_bbox):
     # Mock functions that require a redis instance to run.
-    mock_result = {"features": [{"id": "test"}]}
+    mock_result = ResultGrid(grid=np.full((40, 40), 0.2), minx=565000, maxy=5930400, resolution=10)
+    mock_result_raw = {"analysisOutputData": [], "resolution": {"x": 51, "y": 51}}
     with patch(
-            "infrared_wrapper_api.tasks.do_simulation",
-            return_value=mock_result
-    ) as mock_do_sim, \
-            patch("infrared_wrapper_api.tasks.cache.get", return_value={}) as mock_cache_get, \
+            "infrared_wrapper_api.tasks.run_simulation",
+            return_value=mock_result_raw
+    ) as mock_run_sim, \
+            patch("infrared_wrapper_api.tasks.format_result", return_value=mock_result) as mock_format_result, \
+            patch("infrared_wrapper_api.tasks.lease_idle_infrared_project", return_value=("abc123", "token")), \
+            patch("infrared_wrapper_api.tasks.cache.get_bytes", return_value=None) as mock_cache_get, \
             patch("infrared_wrapper_api.tasks.update_infrared_project_status_in_redis") as mock_update_status, \
-            patch("infrared_wrapper_api.tasks.cache.put") as mock_cache_put:
+            patch("infrared_wrapper_api.tasks.cache.put_bytes") as mock_cache_put:
         # call function
         mock_project_uuid = "abc123"
         sample_wind_sim_task = WindSimulationTask(
@@ -101,44 +285,531 @@ def test_task_not_cached(sample_simulation_area, sample_building_data_single_bbo
             wind_direction=15
         )
 
-        result = task__do_simulation(mock_project_uuid, sample_wind_sim_task.dict())
+        result = run_simulation_chain(sample_wind_sim_task.dict())
 
         # Assert checking in cache
         mock_cache_get.assert_called()
-        mock_cache_get.assert_called_once_with(key=sample_wind_sim_task.celery_key)
-        # Assert wind simulation is called, as result of task is not cached
-        mock_do_sim.assert_called_once_with(project_uuid=mock_project_uuid, sim_task=sample_wind_sim_task.dict())
-        assert result == mock_result
+        mock_cache_get.assert_called_once_with(key=get_result_grid_cache_key(sample_wind_sim_task.celery_key))
+        # Assert wind simulation is called on the leased project, as result of task is not cached
+        mock_run_sim.assert_called_once_with(
+            project_uuid=mock_project_uuid,
+            sim_task=sample_wind_sim_task.dict(),
+            tile_buildings=prepare_buildings(sample_building_data_single_bbox, sample_simulation_area),
+            renew_lease=ANY
+        )
+        mock_format_result.assert_called_once_with(mock_result_raw, sample_wind_sim_task.dict())
+        assert result["grid"] == mock_result.to_dict()["grid"]
 
         mock_update_status.assert_called()
 
-        # Assert caching of result
+        # Assert caching of the result grid
         mock_cache_put.assert_called()
-        mock_cache_put.assert_called_with(key=sample_wind_sim_task.celery_key, value=mock_result)
+        mock_cache_put.assert_called_with(
+            key=get_result_grid_cache_key(sample_wind_sim_task.celery_key),
+            value=mock_result.to_bytes()
+        )
 
 
 def test_task_is_cached(sample_simulation_area, sample_building_data_single_bbox):
     # Mock functions that require a redis instance to run.
-    mock_result_from_cache = {"features": [{"id": "test"}]}
-    with patch("infrared_wrapper_api.tasks.cache.get", return_value=mock_result_from_cache) as mock_cache_get, \
-            patch("infrared_wrapper_api.tasks.do_simulation") as mock_do_sim:
+    mock_result_from_cache = ResultGrid(grid=np.full((40, 40), 0.2), minx=565000, maxy=5930400, resolution=10)
+    with patch(
+            "infrared_wrapper_api.tasks.cache.get_bytes",
+            return_value=mock_result_from_cache.to_bytes()
+    ) as mock_cache_get, \
+            patch("infrared_wrapper_api.tasks.lease_idle_infrared_project") as mock_lease_project, \
+            patch("infrared_wrapper_api.tasks.run_simulation") as mock_run_sim:
         # call function
-        mock_project_uuid = "abc123"
         sample_wind_sim_task = WindSimulationTask(
             simulation_area=sample_simulation_area,
             buildings=sample_building_data_single_bbox,
             wind_speed=15,
             wind_direction=15
         )
-        result = task__do_simulation(mock_project_uuid, sample_wind_sim_task.dict())
+        result = run_simulation_chain(sample_wind_sim_task.dict())
 
         # Assert checking in cache
         mock_cache_get.assert_called()
-        # Assert wind simulation is NOT called, as we found result of task in cache
-        mock_do_sim.assert_not_called()
+        # Assert no project is leased and wind simulation is NOT called, as we found result of task in cache
+        mock_lease_project.assert_not_called()
+        mock_run_sim.assert_not_called()
+
+        # Asser returned result is the mock result, positioned in this tile
+        result_grid = ResultGrid.from_dict(result)
+        np.testing.assert_array_equal(result_grid.grid, mock_result_from_cache.grid)
+        assert (result_grid.minx, result_grid.miny) == cropped_grid_origin(
+            gpd.GeoDataFrame.from_features(sample_simulation_area["features"]).total_bounds
+        )
 
-        # Asser returned result is the mock result
-        assert result == mock_result_from_cache
+
+def test_cache_key_ignores_feature_order_float_noise_and_tile_origin(
+        sample_simulation_area, sample_building_data_single_bbox
+):
+    def wind_sim_task(buildings: dict, simulation_area: dict) -> WindSimulationTask:
+        return WindSimulationTask(
+            simulation_area=simulation_area, buildings=buildings, wind_speed=15, wind_direction=15
+        )
+
+    def translated(geojson: dict, x: float, y: float) -> dict:
+        gdf = gpd.GeoDataFrame.from_features(geojson["features"])
+        gdf["geometry"] = gdf.translate(x, y)
+        return json.loads(gdf.to_json())
+
+    sim_task = wind_sim_task(sample_building_data_single_bbox, sample_simulation_area)
+
+    reordered_buildings = {
+        **sample_building_data_single_bbox,
+        "features": list(reversed(sample_building_data_single_bbox["features"]))
+    }
+    noisy_buildings = translated(sample_building_data_single_bbox, 1e-7, -1e-7)
+    # the same buildings in a tile 3km further east
+    moved_task = wind_sim_task(
+        translated(sample_building_data_single_bbox, 3000, 0), translated(sample_simulation_area, 3000, 0)
+    )
+
+    assert wind_sim_task(reordered_buildings, sample_simulation_area).celery_key == sim_task.celery_key
+    assert wind_sim_task(noisy_buildings, sample_simulation_area).celery_key == sim_task.celery_key
+    assert moved_task.celery_key == sim_task.celery_key
+
+    # buildings moved within the tile are a different configuration
+    moved_buildings = translated(sample_building_data_single_bbox, 50, 0)
+    assert wind_sim_task(moved_buildings, sample_simulation_area).celery_key != sim_task.celery_key
+    # ... as are other wind settings
+    assert WindSimulationTask(**{**sim_task.dict(), "wind_speed": 10}).celery_key != sim_task.celery_key
+
+
+def test_cache_key_counts_small_buildings(sample_simulation_area, sample_building_data_single_bbox):
+    minx, miny, _, _ = gpd.GeoDataFrame.from_features(sample_simulation_area["features"]).total_bounds
+    # a kiosk, smaller than a cell of the analysis resolution
+    kiosk = json.loads(
+        gpd.GeoDataFrame(
+            {"building_height": [5]}, geometry=[box(minx + 101, miny + 101, minx + 104, miny + 103)], crs="EPSG:25832"
+        ).to_json()
+    )["features"][0]
+    buildings_with_kiosk = {
+        **sample_building_data_single_bbox,
+        "features": sample_building_data_single_bbox["features"] + [kiosk]
+    }
+
+    def celery_key(buildings: dict) -> str:
+        return WindSimulationTask(
+            simulation_area=sample_simulation_area, buildings=buildings, wind_speed=15, wind_direction=15
+        ).celery_key
+
+    assert celery_key(buildings_with_kiosk) != celery_key(sample_building_data_single_bbox)
+
+
+def test_cache_lookups_counted_for_job(sample_simulation_area, sample_building_data_single_bbox):
+    mock_result_from_cache = ResultGrid(grid=np.full((40, 40), 0.2), minx=565000, maxy=5930400, resolution=10)
+    with patch("infrared_wrapper_api.tasks.cache.get_bytes", return_value=mock_result_from_cache.to_bytes()), \
+            patch("infrared_wrapper_api.tasks.record_tile_cache_lookup") as mock_record_lookup:
+        sample_wind_sim_task = WindSimulationTask(
+            simulation_area=sample_simulation_area,
+            buildings=sample_building_data_single_bbox,
+            wind_speed=15,
+            wind_direction=15
+        )
+        task__run_simulation(sample_wind_sim_task.dict(), job_id="job")
+
+        mock_record_lookup.assert_called_once_with("job", hit=True)
+
+
+def test_project_released_before_formatting_result(sample_simulation_area, sample_building_data_single_bbox):
+    """
+    The infrared project is only leased while the simulation runs at infrared,
+    it is released before the result is cropped.
+    The project preferred for the lease is chosen by the buildings of the tile.
+    """
+    mock_result = ResultGrid(grid=np.full((40, 40), 0.2), minx=565000, maxy=5930400, resolution=10)
+    calls = Mock()
+    calls.format_result.return_value = mock_result
+    with patch("infrared_wrapper_api.tasks.cache.get_bytes", return_value=None), \
+            patch("infrared_wrapper_api.tasks.cache.put_bytes"), \
+            patch("infrared_wrapper_api.tasks.lease_idle_infrared_project", calls.lease_project), \
+            patch("infrared_wrapper_api.tasks.run_simulation", calls.run_simulation), \
+            patch("infrared_wrapper_api.tasks.update_infrared_project_status_in_redis", calls.update_status), \
+            patch("infrared_wrapper_api.tasks.format_result", calls.format_result):
+        calls.lease_project.return_value = ("abc123", "token")
+        sample_wind_sim_task = WindSimulationTask(
+            simulation_area=sample_simulation_area,
+            buildings=sample_building_data_single_bbox,
+            wind_speed=15,
+            wind_direction=15
+        )
+        result = run_simulation_chain(sample_wind_sim_task.dict())
+
+        assert result["grid"] == mock_result.to_dict()["grid"]
+        assert [name for name, _, _ in calls.mock_calls] == [
+            "lease_project", "run_simulation", "update_status", "format_result"
+        ]
+        calls.lease_project.assert_called_once_with(
+            building_hashes=list(prepare_buildings(sample_building_data_single_bbox, sample_simulation_area)),
+            capability=None  # wind tile, no service to activate
+        )
+        # project keeps its buildings for the next simulation, no cleanup
+        calls.update_status.assert_called_once_with(
+            project_uuid="abc123",
+            status=ProjectStatus.IDLE.value,
+            lease_token="token"
+        )
+
+
+@pytest.fixture
+def fake_project_pool():
+    fake_project_pool = ProjectPool(fakeredis.FakeRedis(decode_responses=True), key_prefix="test", lease_seconds=60)
+    with patch("infrared_wrapper_api.tasks.project_pool", fake_project_pool):
+        yield fake_project_pool
+
+
+def test_project_released_when_simulation_fails(
+        sample_simulation_area, sample_building_data_single_bbox, fake_project_pool
+):
+    with patch("infrared_wrapper_api.tasks.cache.get_bytes", return_value=None), \
+            patch("infrared_wrapper_api.tasks.cache.put_bytes") as mock_cache_put, \
+            patch("infrared_wrapper_api.tasks.lease_idle_infrared_project", return_value=("abc123", "token")), \
+            patch("infrared_wrapper_api.tasks.run_simulation", side_effect=Exception("infrared failed")), \
+            patch("infrared_wrapper_api.tasks.task__cleanup_project") as mock_cleanup_task, \
+            patch("infrared_wrapper_api.tasks.update_infrared_project_status_in_redis") as mock_update_status:
+        sample_wind_sim_task = WindSimulationTask(
+            simulation_area=sample_simulation_area,
+            buildings=sample_building_data_single_bbox,
+            wind_speed=15,
+            wind_direction=15
+        )
+        result = run_simulation_chain(sample_wind_sim_task.dict())
+
+        assert "grid" not in result
+        mock_cache_put.assert_not_called()
+        mock_update_status.assert_called_once_with(
+            project_uuid="abc123",
+            status=ProjectStatus.TO_BE_CLEANED.value,
+            lease_token="token"
+        )
+        # cleaned up right away, under the lease of the simulation
+        mock_cleanup_task.delay.assert_called_once()
+        assert mock_cleanup_task.delay.call_args.kwargs["project_uuid"] == "abc123"
+        assert mock_cleanup_task.delay.call_args.kwargs["lease_token"] == "token"
+
+
+def test_simulation_retried_when_buildings_not_loaded(
+        sample_simulation_area, sample_building_data_single_bbox, fake_project_pool
+):
+    """
+    A project without exactly the tile's buildings is cleaned up, the simulation runs again in another lease.
+    """
+    mock_result = ResultGrid(grid=np.full((40, 40), 0.2), minx=565000, maxy=5930400, resolution=10)
+    with patch("infrared_wrapper_api.tasks.cache.get_bytes", return_value=None), \
+            patch("infrared_wrapper_api.tasks.cache.put_bytes") as mock_cache_put, \
+            patch("infrared_wrapper_api.tasks.lease_idle_infrared_project",
+                  side_effect=[("abc123", "token"), ("def456", "token")]), \
+            patch("infrared_wrapper_api.tasks.run_simulation", side_effect=[
+                BuildingsNotLoadedException("could not create 1 buildings"), {"raw": "result"}
+            ]), \
+            patch("infrared_wrapper_api.tasks.format_result", return_value=mock_result), \
+            patch("infrared_wrapper_api.tasks.task__cleanup_project") as mock_cleanup_task, \
+            patch("infrared_wrapper_api.tasks.update_infrared_project_status_in_redis") as mock_update_status:
+        sample_wind_sim_task = WindSimulationTask(
+            simulation_area=sample_simulation_area,
+            buildings=sample_building_data_single_bbox,
+            wind_speed=15,
+            wind_direction=15
+        )
+        # eagerly, like a worker, with retries
+        simulation_output = task__run_simulation.apply(kwargs={"sim_task": sample_wind_sim_task.dict()}).get()
+        result = task__format_simulation_result(simulation_output)
+
+        assert result["grid"] == mock_result.to_dict()["grid"]
+        # only the result of the retry is cached
+        mock_cache_put.assert_called_once()
+        assert mock_update_status.call_args_list == [
+            call(project_uuid="abc123", status=ProjectStatus.TO_BE_CLEANED.value, lease_token="token"),
+            call(project_uuid="def456", status=ProjectStatus.IDLE.value, lease_token="token"),
+        ]
+        assert mock_cleanup_task.delay.call_args.kwargs["project_uuid"] == "abc123"
+
+
+def test_one_pending_cleanup_per_project(fake_project_pool):
+    """
+    A project is enqueued for cleanup once until its cleanup ran, which renews its lease first.
+    """
+    lease_token = fake_project_pool.lease("project")
+
+    with patch("infrared_wrapper_api.tasks.task__cleanup_project.delay") as mock_delay:
+        assert tasks.enqueue_cleanup("project", lease_token, marked_at=1)
+        # e.g. the reconciler, after the lease expired while the cleanup waited in the queue
+        assert not tasks.enqueue_cleanup("project", "reconciler_token")
+        assert mock_delay.call_count == 1
+
+    # the lease expired while the cleanup waited in the queue
+    fake_project_pool._redis.zadd(fake_project_pool._leases_key, {"project": 0})
+    reclaimed_during_cleanup = []
+    with patch("infrared_wrapper_api.tasks.cleanup_project",
+               lambda project_uuid, lease_token: reclaimed_during_cleanup.extend(
+                   fake_project_pool.reclaim_expired_leases()
+               )), \
+            patch("infrared_wrapper_api.tasks.metrics"):
+        tasks.task__cleanup_project("project", lease_token, marked_at=1)
+
+    assert reclaimed_during_cleanup == []
+    assert fake_project_pool.leased_projects() == ["project"]
+
+    # cleaned up, the next cleanup can be enqueued
+    with patch("infrared_wrapper_api.tasks.task__cleanup_project.delay") as mock_delay:
+        assert tasks.enqueue_cleanup("project", lease_token)
+
+
+def test_cleanup_skipped_when_lease_lost(fake_project_pool):
+    """
+    A cleanup whose lease expired and was reclaimed leaves the project to the cleanup of its new lease.
+    """
+    expired_token = fake_project_pool.lease("project")
+    fake_project_pool._redis.zadd(fake_project_pool._leases_key, {"project": 0})
+    fake_project_pool.reclaim_expired_leases()
+    fake_project_pool.lease("project")
+
+    with patch("infrared_wrapper_api.tasks.cleanup_project") as mock_cleanup, \
+            patch("infrared_wrapper_api.tasks.metrics"):
+        tasks.task__cleanup_project("project", expired_token)
+
+    mock_cleanup.assert_not_called()
+    assert fake_project_pool.leased_projects() == ["project"]
+    assert fake_project_pool.try_lock(tasks.get_cleanup_lock_name("project"), seconds=60)
+
+
+def test_simulation_retried_when_lease_lost(
+        sample_simulation_area, sample_building_data_single_bbox, fake_project_pool
+):
+    """
+    A simulation that outlasts its lease stops, once the reconciler reclaimed its project for a cleanup.
+    It neither returns the project to the idle projects nor enqueues another cleanup, and runs again in a new lease.
+    """
+    fake_project_pool.register("abc123")
+    fake_project_pool.register("def456")
+    mock_result = ResultGrid(grid=np.full((40, 40), 0.2), minx=565000, maxy=5930400, resolution=10)
+    simulated_projects = []
+
+    def run_simulation(project_uuid: str, sim_task: dict, tile_buildings: dict, renew_lease: Callable) -> dict:
+        simulated_projects.append(project_uuid)
+        if len(simulated_projects) == 1:
+            # the lease expired while polling, the reconciler reclaimed the project for its cleanup
+            fake_project_pool._redis.zadd(fake_project_pool._leases_key, {project_uuid: 0})
+            fake_project_pool.reclaim_expired_leases()
+            fake_project_pool.lease(project_uuid)
+        renew_lease()
+        return {"raw": "result"}
+
+    api_utils = "infrared_wrapper_api.api.utils"
+    with patch("infrared_wrapper_api.tasks.cache.get_bytes", return_value=None), \
+            patch("infrared_wrapper_api.tasks.cache.put_bytes"), \
+            patch("infrared_wrapper_api.tasks.run_simulation", run_simulation), \
+            patch("infrared_wrapper_api.tasks.format_result", return_value=mock_result), \
+            patch("infrared_wrapper_api.tasks.task__cleanup_project") as mock_cleanup_task, \
+            patch(f"{api_utils}.project_pool", fake_project_pool), \
+            patch(f"{api_utils}.project_registry.rank_projects", return_value=[]), \
+            patch(f"{api_utils}.cache"), \
+            patch(f"{api_utils}.metrics"):
+        sample_wind_sim_task = WindSimulationTask(
+            simulation_area=sample_simulation_area,
+            buildings=sample_building_data_single_bbox,
+            wind_speed=15,
+            wind_direction=15
+        )
+        simulation_output = task__run_simulation.apply(kwargs={"sim_task": sample_wind_sim_task.dict()}).get()
+        result = task__format_simulation_result(simulation_output)
+
+    assert result["grid"] == mock_result.to_dict()["grid"]
+    assert simulated_projects == ["abc123", "def456"]
+    mock_cleanup_task.delay.assert_not_called()
+    # the reclaimed project stays leased for its cleanup
+    assert fake_project_pool.leased_projects() == ["abc123"]
+    assert fake_project_pool.idle_projects() == ["def456"]
+
+
+def test_simulation_stages_report_timings(sample_simulation_area, sample_building_data_single_bbox):
+    mock_result = ResultGrid(grid=np.full((40, 40), 0.2), minx=565000, maxy=5930400, resolution=10)
+    with patch("infrared_wrapper_api.tasks.cache.get_bytes", return_value=None), \
+            patch("infrared_wrapper_api.tasks.cache.put_bytes"), \
+            patch("infrared_wrapper_api.tasks.lease_idle_infrared_project", return_value=("abc123", "token")), \
+            patch("infrared_wrapper_api.tasks.run_simulation", return_value={}), \
+            patch("infrared_wrapper_api.tasks.update_infrared_project_status_in_redis"), \
+            patch("infrared_wrapper_api.tasks.format_result", return_value=mock_result):
+        sample_wind_sim_task = WindSimulationTask(
+            simulation_area=sample_simulation_area,
+            buildings=sample_building_data_single_bbox,
+            wind_speed=15,
+            wind_direction=15
+        )
+        result = run_simulation_chain(sample_wind_sim_task.dict())
+
+        assert set(result["timings"]["run_simulation"]) == {
+            "cache_lookup", "prepare_buildings", "project_lease", "infrared"
+        }
+        assert set(result["timings"]["format_simulation_result"]) == {"format", "cache_store"}
+
+
+def test_simulation_stages_run_on_separate_queues(sample_simulation_input):
+    tile_def, = create_tile_definitions(sample_simulation_input)
+    prepare_stage, run_stage, format_stage = simulation_chain(tile_def, "wind", job_id="job", tile_index=0).tasks
+    router = celery_app.amqp.router
+
+    assert router.route({}, prepare_stage.task)["queue"].name == settings.broker.cpu_queue
+    assert router.route({}, run_stage.task)["queue"].name == settings.broker.io_queue
+    assert router.route({}, format_stage.task)["queue"].name == settings.broker.cpu_queue
+
+
+def test_tiles_prepared_in_own_tasks(sample_simulation_input_multiple_bboxes):
+    """
+    task__compute only selects the buildings of each tile, clipping and simplifying is left to the tile's first stage.
+    """
+    tile_defs = create_tile_definitions(sample_simulation_input_multiple_bboxes)
+    all_buildings = read_buildings(sample_simulation_input_multiple_bboxes["buildings"])
+    all_geometries = set(all_buildings.geometry.to_wkb())
+
+    for tile_def, sim_task in zip(tile_defs, create_simulation_tasks(sample_simulation_input_multiple_bboxes, "wind")):
+        # unclipped candidates only
+        tile_buildings = read_buildings(tile_def["buildings"])
+        assert 0 < len(tile_buildings) < len(all_buildings)
+        assert set(tile_buildings.geometry.to_wkb()) <= all_geometries
+
+        with patch("infrared_wrapper_api.tasks.store_tile_key") as mock_store_tile_key:
+            prepared_sim_task = task__prepare_simulation_task(tile_def, "wind", job_id="job", tile_index=3)
+
+        assert prepared_sim_task == jsonable_encoder(sim_task)
+        mock_store_tile_key.assert_called_once_with("job", 3, sim_task.celery_key)
+
+
+@pytest.fixture
+def dispatched_jobs():
+    """
+    Dispatches jobs without celery and redis, keeps the tile tasks and tiles of each job
+    """
+    job_inputs = {}
+    dispatched = {}
+
+    tile_keys = {}
+
+    def store_tile_key(job_id, tile_index, celery_key):
+        tile_keys.setdefault(job_id, {})[tile_index] = celery_key
+
+    def dispatch_tile_tasks(job_id, tile_tasks, tiles):
+        dispatched[job_id] = {"tile_tasks": tile_tasks, "tiles": tiles}
+        # prepare the tiles, as their first stage would
+        for tile_task in tile_tasks:
+            if tile_task.task == "celery.chain":
+                prepare_stage = tile_task.tasks[0]
+                prepare_stage.type(**prepare_stage.kwargs)
+
+    with patch("infrared_wrapper_api.tasks.store_job_input",
+               lambda job_id, simulation_input, sim_type: job_inputs.update(
+                   {job_id: json.loads(json.dumps({"simulation_input": simulation_input, "sim_type": sim_type}))}
+               )), \
+            patch("infrared_wrapper_api.tasks.get_job_input", job_inputs.get), \
+            patch("infrared_wrapper_api.tasks.get_job_info", dispatched.get), \
+            patch("infrared_wrapper_api.tasks.dispatch_tile_tasks", dispatch_tile_tasks), \
+            patch("infrared_wrapper_api.tasks.store_tile_key", store_tile_key), \
+            patch("infrared_wrapper_api.tasks.get_tile_keys", lambda job_id: tile_keys.get(job_id, {})), \
+            patch("infrared_wrapper_api.tasks.cache.exists", return_value=True):
+        yield dispatched
+
+
+def test_delta_job_simulates_affected_tiles_only(dispatched_jobs):
+    with open("../infrared_wrapper_api/models/jsons/buildings_multiple_bboxes.json", "r") as f:
+        buildings = json.load(f)
+    dispatch_simulation_tasks({"buildings": buildings, "wind_speed": 10, "wind_direction": 45}, "wind", "base")
+
+    modified_building = json.loads(json.dumps(buildings["features"][0]))
+    modified_building["properties"]["building_height"] += 30
+    dispatch_delta_simulation_tasks(
+        {"modified": {"type": "FeatureCollection", "features": [modified_building]}, "removed": [1]},
+        base_job_id="base",
+        job_id="delta"
+    )
+
+    base_tiles = dispatched_jobs["base"]["tiles"]
+    delta_tiles = dispatched_jobs["delta"]["tiles"]
+    reused_tiles = [
+        tile_task.kwargs["tile_info"] for tile_task in dispatched_jobs["delta"]["tile_tasks"]
+        if tile_task.task == task__load_cached_tile_result.name
+    ]
+    reused_bounds = [tile["bounds"] for tile in reused_tiles]
+    base_tile_keys = tasks.get_tile_keys("base")
+    delta_tile_keys = tasks.get_tile_keys("delta")
+
+    # same tiles as the base job, only the tiles around the changed buildings are simulated again
+    assert sorted(delta_tiles) == sorted(base_tiles)
+    assert 1 <= len(delta_tiles) - len(reused_tiles) <= 4
+    assert all(tile["celery_key"] in base_tile_keys.values() for tile in reused_tiles)
+    assert not any(
+        celery_key in base_tile_keys.values()
+        for tile_index, celery_key in delta_tile_keys.items() if delta_tiles[tile_index] not in reused_bounds
+    )
+
+
+def test_delta_job_adds_tiles_for_new_buildings(dispatched_jobs):
+    with open("../infrared_wrapper_api/models/jsons/buildings_single_bbox.json", "r") as f:
+        buildings = json.load(f)
+    dispatch_simulation_tasks({"buildings": buildings, "wind_speed": 10, "wind_direction": 45}, "wind", "base")
+
+    # a building about 2km north of the base scenario
+    new_building = json.loads(json.dumps(buildings["features"][0]))
+    new_building["geometry"]["coordinates"] = [
+        [[x, y + 0.02] for x, y in ring] for ring in new_building["geometry"]["coordinates"]
+    ]
+    dispatch_delta_simulation_tasks(
+        {"added": {"type": "FeatureCollection", "features": [new_building]}},
+        base_job_id="base",
+        job_id="delta"
+    )
+
+    assert len(dispatched_jobs["delta"]["tiles"]) == len(dispatched_jobs["base"]["tiles"]) + 1
+    assert len(dispatched_jobs["delta"]["tile_tasks"]) == len(dispatched_jobs["delta"]["tiles"])
+
+
+def test_apply_building_delta():
+    buildings = {
+        "type": "FeatureCollection",
+        "features": [{"id": i, "properties": {"building_height": 10}, "geometry": None} for i in range(3)]
+    }
+    modified = {"id": 1, "properties": {"building_height": 20}, "geometry": None}
+    added = {"properties": {"building_height": 30}, "geometry": None}
+
+    updated, replaced, new = apply_building_delta(
+        buildings,
+        {"added": {"features": [added]}, "modified": {"features": [modified]}, "removed": ["2"]},
+        added_id_prefix="delta:"
+    )
+
+    assert updated["features"] == [buildings["features"][0], modified, {**added, "id": "delta:0"}]
+    assert sorted(feature["id"] for feature in replaced["features"]) == [1, 2]
+    assert new["features"] == [modified, {**added, "id": "delta:0"}]
+
+    with pytest.raises(ValueError):
+        apply_building_delta(buildings, {"removed": [5]}, added_id_prefix="delta:")
+    with pytest.raises(ValueError):
+        apply_building_delta(buildings, {"modified": {"features": [added]}}, added_id_prefix="delta:")
+    with pytest.raises(ValueError):
+        apply_building_delta(buildings, {"added": {"features": [modified]}}, added_id_prefix="delta:")
+
+
+def test_building_ids_stable_across_deltas():
+    """
+    Buildings submitted without id keep the id of their submitted position, also after deltas reordered them.
+    """
+    buildings = assign_building_ids({
+        "type": "FeatureCollection",
+        "features": [{"properties": {"building_height": height}, "geometry": None} for height in [10, 11, 12, 13]]
+    })
+    assert [feature["id"] for feature in buildings["features"]] == [0, 1, 2, 3]
+
+    first, _, _ = apply_building_delta(
+        buildings,
+        {"modified": {"features": [{"id": 0, "properties": {"building_height": 20}, "geometry": None}]}},
+        added_id_prefix="first:"
+    )
+    second, replaced, _ = apply_building_delta(first, {"removed": [2, 0]}, added_id_prefix="second:")
+
+    assert sorted(feature["properties"]["building_height"] for feature in replaced["features"]) == [12, 20]
+    assert [feature["properties"]["building_height"] for feature in second["features"]] == [11, 13]
 
 
 def test_simulation_result_single_bbox(sample_simulation_input, sample_simulation_result_single_bbox_geojson):
@@ -161,14 +832,17 @@ def test_simulation_result_single_bbox(sample_simulation_input, sample_simulatio
             "infrared_wrapper_api.dependencies.cache.get",
             return_value={"status": ProjectStatus.IDLE.value}
     ) as mock_cache_get, \
-        patch("infrared_wrapper_api.dependencies.cache.put") as mock_cache_put:
-        project_uuid = find_idle_infrared_project(get_all_cut_prototype_projects_uuids())
+        patch("infrared_wrapper_api.dependencies.cache.put") as mock_cache_put, \
+        patch("infrared_wrapper_api.api.utils.project_pool") as mock_project_pool:
+        project_uuid = get_idle_project_id()
 
         print("running simulation on Infrared project {}".format(project_uuid))
 
-        result = do_simulation(
-            project_uuid=project_uuid,
-            sim_task=simulation_tasks[0].dict()
+        result = result_grid_to_geojson(
+            do_simulation(
+                project_uuid=project_uuid,
+                sim_task=simulation_tasks[0].dict()
+            )
         )
 
         print("SIMULATION TIME TOOK {:.2f} seconds".format(time.time() - start_time))
@@ -178,7 +852,7 @@ def test_simulation_result_single_bbox(sample_simulation_input, sample_simulatio
             assert feat["properties"] == sample_simulation_result_single_bbox_geojson["features"][feat_id]["properties"]
 
         # dont forget to clean up project_uuid
-        cleanup_project(project_uuid)
+        cleanup_project(project_uuid, lease_token="test")
 
 
 def test_live_simulation_result_single_bbox_sun(sample_simulation_input):
@@ -202,14 +876,17 @@ def test_live_simulation_result_single_bbox_sun(sample_simulation_input):
             "infrared_wrapper_api.dependencies.cache.get",
             return_value={"status": ProjectStatus.IDLE.value}
     ) as mock_cache_get, \
-        patch("infrared_wrapper_api.dependencies.cache.put") as mock_cache_put:
-        project_uuid = find_idle_infrared_project(get_all_cut_prototype_projects_uuids())
+        patch("infrared_wrapper_api.dependencies.cache.put") as mock_cache_put, \
+        patch("infrared_wrapper_api.api.utils.project_pool") as mock_project_pool:
+        project_uuid = get_idle_project_id()
 
         print("running simulation on Infrared project {}".format(project_uuid))
 
-        result = do_simulation(
-            project_uuid=project_uuid,
-            sim_task=simulation_tasks[0].dict()
+        result = result_grid_to_geojson(
+            do_simulation(
+                project_uuid=project_uuid,
+                sim_task=simulation_tasks[0].dict()
+            )
         )
 
         print("SIMULATION TIME TOOK {:.2f} seconds".format(time.time() - start_time))
@@ -217,7 +894,7 @@ def test_live_simulation_result_single_bbox_sun(sample_simulation_input):
         assert len(result["features"]) > 0
 
         # dont forget to clean up project_uuid
-        cleanup_project(project_uuid)
+        cleanup_project(project_uuid, lease_token="test")
 
 
 def test_live_simulation_result_multiple_bbox(sample_simulation_input_multiple_bboxes):
@@ -257,9 +934,11 @@ def test_live_simulation_result_multiple_bbox(sample_simulation_input_multiple_b
             print(f"SIM TASK {sim_task_id} - running simulation on Infrared project {test_uuids[sim_task_id]}")
             start_time = time.time()
 
-            result = do_simulation(
-                project_uuid=test_uuids[sim_task_id],
-                sim_task=simulation_task.dict()
+            result = result_grid_to_geojson(
+                do_simulation(
+                    project_uuid=test_uuids[sim_task_id],
+                    sim_task=simulation_task.dict()
+                )
             )
             print("SIMULATION TIME TOOK {:.2f} seconds".format(time.time() - start_time))
 
@@ -272,6 +951,6 @@ def test_live_simulation_result_multiple_bbox(sample_simulation_input_multiple_b
         # finally clean up
         for uuid in test_uuids:
             try:
-                cleanup_project(uuid)
+                cleanup_project(uuid, lease_token="test")
             except:
                 print("cannot clean up project {}".format(uuid))
@@ -1,17 +1,21 @@
-from unittest.mock import patch
+import fakeredis
 
-from infrared_wrapper_api.api.utils import find_idle_infrared_project
 from infrared_wrapper_api.infrared_wrapper.infrared.infrared_connector import get_all_cut_prototype_projects_uuids
-from infrared_wrapper_api.infrared_wrapper.infrared.models import ProjectStatus
+from infrared_wrapper_api.project_pool import ProjectPool
+from infrared_wrapper_api.tasks import task__run_simulation, task__format_simulation_result
 
 
 def get_idle_project_id():
-    # Mock functions so that the projects are not marked busy!
-    with patch("infrared_wrapper_api.api.utils.update_infrared_project_status_in_redis") as mock_update_status, \
-            patch("infrared_wrapper_api.dependencies.cache.put") as mock_cache_put, \
-            patch(
-                "infrared_wrapper_api.dependencies.cache.get",
-                return_value={"status": ProjectStatus.IDLE.value}
-            ) as mocK_cache_get:
-        return find_idle_infrared_project(get_all_cut_prototype_projects_uuids())
+    # Lease from a throw-away pool, so that the projects are not marked busy!
+    pool = ProjectPool(fakeredis.FakeRedis(decode_responses=True), key_prefix="test", lease_seconds=60)
+    for project_uuid in get_all_cut_prototype_projects_uuids():
+        pool.register(project_uuid)
 
+    project_uuid, _ = pool.acquire(timeout=1)
+
+    return project_uuid
+
+
+def run_simulation_chain(sim_task: dict) -> dict:
+    # runs both stages of a tile simulation in process, like the chain on the workers
+    return task__format_simulation_result(task__run_simulation(sim_task))